@@ -0,0 +1,594 @@
+#
+#  asyncforward.py
+#
+# License: Copyright (c) 2016 Hologram All Rights Reserved.
+#
+# Released under the MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Event loop forwarding engine. Drop-in replacement for portforward that
+# runs every listener and every channel of every forward on one asyncio loop
+# instead of spawning a thread per accepted connection. Requires Python 3.5+.
+
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import socket
+import threading
+import time
+
+from SpaceBridge.portforward import (MIN_BUFSIZE, MAX_BUFSIZE,
+        CHANNEL_RETRY_INTERVAL, MAX_WORKERS, MAX_TOTAL_CHANNELS, MAX_QUEUE,
+        QUEUE_TIMEOUT, FORWARD_POOL_METRICS, ReadSizer, channel_payload_size,
+        enable_keepalive)
+from SpaceBridge.channelpool import ChannelPool, WARM_TTL
+from SpaceBridge.transportpool import close_channel
+from SpaceBridge.sbmetrics import get_metrics
+from SpaceBridge.ratelimit import FAIR_QUANTUM, Limit, limiters
+
+# Most data queued for a local socket before reading from its channel
+# stops, in bytes
+MAX_PENDING = 1048576
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _run_loop(loop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+
+def get_loop():
+    # All forwards share one loop, started on a daemon thread the first time
+    # it is needed so the UI keeps the main thread like the threaded engine.
+    # Channels are watched with add_reader, which the proactor loop Windows
+    # defaults to doesn't have, so always ask for a selector loop.
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.SelectorEventLoop()
+            loop_thread = threading.Thread(target=_run_loop, args=(_loop,))
+            loop_thread.daemon = True
+            loop_thread.start()
+        return _loop
+
+
+class ChannelProtocol(asyncio.Protocol):
+    # Bridges one accepted local connection to one direct-tcpip channel.
+    # Paramiko channels have no write readiness, so sends into a full window
+    # are retried on a timer while reading from the local side is paused.
+    # Reads from the local side are sized by asyncio itself; reads from the
+    # channel use the same adaptive sizing as the threaded engine and stop
+    # while the local write buffer holds more than max_pending bytes.
+    # With a rate limit, either side stops being read for as long as its
+    # buckets need to refill. asyncio reads the local side in chunks of its
+    # own choosing, so that direction is metered after the fact unless
+    # MeteredChannelProtocol is available to size the reads.
+
+    def __init__(self, loop, chain_host, chain_port, ssh_transport,
+                 min_bufsize=MIN_BUFSIZE, max_bufsize=MAX_BUFSIZE,
+                 max_pending=MAX_PENDING, limit=None, keepalive=0, idle_timeout=0,
+                 channel_pool=None, metrics_name=None, upstream_limit=None,
+                 downstream_limit=None):
+        self.loop = loop
+        self.metrics_name = metrics_name
+        self.upstream_limit = upstream_limit
+        self.downstream_limit = downstream_limit
+        # Bytes asyncio was asked to read for the last data_received call
+        self.requested = FAIR_QUANTUM
+        self.local_throttle = None
+        self.chan_throttle = None
+        self.metrics = None
+        self.open_started = None
+        self.limit = limit if limit is not None else ChannelLimit(0)
+        self.holds_slot = False
+        self.channel_pool = channel_pool
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.last_active = time.time()
+        self.idle_handle = None
+        self.chain_host = chain_host
+        self.chain_port = chain_port
+        self.ssh_transport = ssh_transport
+        self.logger = logging.getLogger('forwardhandler')
+        self.transport = None
+        self.peername = None
+        self.chan = None
+        self.max_pending = max_pending
+        self.pending = bytearray()
+        self.downstream = ReadSizer(min_bufsize, max_bufsize)
+        self.retry_handle = None
+        self.local_paused = False
+        self.reading_chan = False
+        self.writing_paused = False
+        self.eof = False
+        self.closed = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.transport.set_write_buffer_limits(high=self.max_pending)
+        self.peername = transport.get_extra_info('peername')
+        if self.keepalive:
+            enable_keepalive(transport.get_extra_info('socket'), self.keepalive,
+                             user_timeout=False)
+        # Nothing is read from the client until its channel is open
+        self._pause_local()
+        get_forward_pool().submit(self)
+
+    def rejected(self, reason):
+        # Called by the pool instead of admitted()
+        self.logger.warning('Rejected connection from %r to %s:%d: %s',
+                self.peername, self.chain_host, self.chain_port, reason,
+                extra={'fields': {'event': 'rejected', 'forward': self.metrics_name,
+                                  'reason': reason}})
+        get_metrics().rejected(self.metrics_name, self.chain_host)
+        self.closed = True
+        self.transport.close()
+
+    def admitted(self):
+        # Called by the pool once the connection holds a channel slot
+        self.holds_slot = True
+        self.open_started = time.time()
+        chan = None
+        if self.channel_pool is not None:
+            chan = self.channel_pool.take()
+        if chan is not None:
+            future = self.loop.create_future()
+            future.set_result(chan)
+        else:
+            future = get_forward_pool().open_channel(self.ssh_transport,
+                    (self.chain_host, self.chain_port), self.peername)
+        future.add_done_callback(self._channel_opened)
+
+    def _channel_opened(self, future):
+        latency = time.time() - self.open_started
+        try:
+            chan = future.result()
+        except Exception as e:
+            get_metrics().open_failed(self.metrics_name, self.chain_host, latency)
+            if not self.closed:
+                self.logger.warning('Incoming request to %s:%d failed: %r',
+                        self.chain_host, self.chain_port, e,
+                        extra={'fields': {'event': 'open_failed',
+                                          'forward': self.metrics_name}})
+            self.close()
+            return
+        if chan is None:
+            self.logger.warning('Incoming request to %s:%d was rejected by the server.',
+                    self.chain_host, self.chain_port,
+                    extra={'fields': {'event': 'open_refused',
+                                      'forward': self.metrics_name}})
+            get_metrics().open_failed(self.metrics_name, self.chain_host, latency)
+            self.close()
+            return
+        if self.closed:
+            # The local client gave up while the channel was being opened
+            close_channel(chan)
+            return
+
+        chan.setblocking(0)
+        self.chan = chan
+        self.metrics = get_metrics().opened(self.metrics_name, self.chain_host, latency)
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info('Connected!  Tunnel open %r -> %r -> %r', self.peername,
+                    chan.getpeername(), (self.chain_host, self.chain_port),
+                    extra={'fields': {'event': 'tunnel_open',
+                                      'forward': self.metrics_name}})
+        self._resume_chan()
+        if self.idle_timeout:
+            self.last_active = time.time()
+            self.idle_handle = self.loop.call_later(self.idle_timeout,
+                    self._check_idle)
+        if self.eof:
+            self.close()
+        else:
+            self._resume_local()
+
+    def data_received(self, data):
+        self.last_active = time.time()
+        self.pending += data
+        if self.metrics is not None:
+            self.metrics.transferred(len(data), 0)
+        if self.upstream_limit is not None:
+            self.upstream_limit.consume(self.requested, len(data))
+            delay = self.upstream_limit.delay()
+            if delay and self.local_throttle is None:
+                self._pause_local()
+                self.local_throttle = self.loop.call_later(delay, self._unthrottle_local)
+        self._flush_chan()
+
+    def eof_received(self):
+        self.eof = True
+        if self.chan is None or not self.pending:
+            self.close()
+        # Keep the transport around until pending data reaches the channel
+        return True
+
+    def connection_lost(self, exc):
+        self.close()
+
+    def pause_writing(self):
+        self.writing_paused = True
+        self._pause_chan()
+
+    def resume_writing(self):
+        self.writing_paused = False
+        self._resume_chan()
+
+    def _unthrottle_local(self):
+        self.local_throttle = None
+        if not self.pending:
+            # Otherwise _flush_chan resumes reading once the data is sent
+            self._resume_local()
+
+    def _throttle_chan(self):
+        self._pause_chan()
+        if self.chan_throttle is None:
+            self.chan_throttle = self.loop.call_later(self.downstream_limit.delay(),
+                                                      self._unthrottle_chan)
+
+    def _unthrottle_chan(self):
+        self.chan_throttle = None
+        self._resume_chan()
+
+    def _flush_chan(self):
+        self.retry_handle = None
+        if self.closed or self.chan is None:
+            return
+        packet = channel_payload_size(self.chan) or len(self.pending)
+        while self.pending:
+            try:
+                sent = self.chan.send(bytes(self.pending[:packet]))
+            except socket.timeout:
+                break
+            if sent == 0:
+                # The channel was closed underneath us
+                self.close()
+                return
+            del self.pending[:sent]
+        if self.pending:
+            self._pause_local()
+            if self.retry_handle is None:
+                self.retry_handle = self.loop.call_later(CHANNEL_RETRY_INTERVAL,
+                        self._flush_chan)
+        elif self.eof:
+            self.close()
+        else:
+            self._resume_local()
+
+    def _chan_readable(self):
+        size = self.downstream.read_size()
+        if self.downstream_limit is not None:
+            size = min(size, self.downstream_limit.allowance())
+            if size <= 0:
+                self._throttle_chan()
+                return
+        try:
+            data = self.chan.recv(size)
+        except socket.timeout:
+            return
+        if len(data) == 0:
+            self.close()
+            return
+        self.last_active = time.time()
+        self.downstream.update(size, len(data))
+        self.transport.write(data)
+        self.metrics.transferred(0, len(data))
+        if self.downstream_limit is not None:
+            self.downstream_limit.consume(size, len(data))
+            if self.downstream_limit.delay() and not self.closed:
+                self._throttle_chan()
+
+    def _check_idle(self):
+        self.idle_handle = None
+        idle = time.time() - self.last_active
+        if idle >= self.idle_timeout:
+            self.logger.info('Closing tunnel idle for over %ds', self.idle_timeout,
+                    extra={'fields': {'event': 'idle_closed'}})
+            self.close()
+        else:
+            self.idle_handle = self.loop.call_later(self.idle_timeout - idle,
+                    self._check_idle)
+
+    def _pause_local(self):
+        if not self.local_paused:
+            self.local_paused = True
+            self.transport.pause_reading()
+
+    def _resume_local(self):
+        if self.local_paused and not self.closed and self.local_throttle is None:
+            self.local_paused = False
+            self.transport.resume_reading()
+
+    def _pause_chan(self):
+        if self.reading_chan:
+            self.reading_chan = False
+            self.loop.remove_reader(self.chan.fileno())
+
+    def _resume_chan(self):
+        if (not self.reading_chan and self.chan is not None and not self.closed and
+                not self.writing_paused and self.chan_throttle is None):
+            self.reading_chan = True
+            self.loop.add_reader(self.chan.fileno(), self._chan_readable)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.holds_slot:
+            get_forward_pool().release(self.limit)
+        else:
+            get_forward_pool().cancel(self)
+        if self.retry_handle is not None:
+            self.retry_handle.cancel()
+            self.retry_handle = None
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+            self.idle_handle = None
+        for handle in (self.local_throttle, self.chan_throttle):
+            if handle is not None:
+                handle.cancel()
+        if self.chan is not None:
+            self._pause_chan()
+            close_channel(self.chan)
+            self.logger.info('Tunnel closed from %r', self.peername,
+                    extra={'fields': {'event': 'tunnel_closed',
+                                      'forward': self.metrics_name}})
+        if self.metrics is not None:
+            self.metrics.close()
+        self.transport.close()
+
+
+if hasattr(asyncio, 'BufferedProtocol'):
+    class MeteredChannelProtocol(ChannelProtocol, asyncio.BufferedProtocol):
+        # Reads the local side of a rate limited channel into a buffer no
+        # larger than its buckets allow, so one read can't overdraw them
+        # and hold up the interactive channels sharing them (Python 3.7+)
+
+        def __init__(self, *args, **kwargs):
+            ChannelProtocol.__init__(self, *args, **kwargs)
+            self.read_buffer = memoryview(bytearray(FAIR_QUANTUM))
+
+        def get_buffer(self, sizehint):
+            # Reading is paused while the buckets are empty, but another
+            # channel may have spent the tokens since
+            self.requested = max(self.upstream_limit.allowance(), 1)
+            return self.read_buffer[:self.requested]
+
+        def buffer_updated(self, nbytes):
+            self.data_received(self.read_buffer[:nbytes])
+else:
+    MeteredChannelProtocol = None
+
+
+class ChannelLimit:
+    # Channel count and cap of one forward, kept by the ForwardPool
+
+    def __init__(self, max_channels):
+        self.max_channels = max_channels
+        self.active = 0
+
+
+class ForwardPool:
+    # Admission control for the async engine, with the limits and counters
+    # of the threaded engine's pool. A new connection waits, without being
+    # read from, until both its forward and the engine as a whole are under
+    # their channel limits, and channels are opened on an executor of
+    # max_workers threads. Connections that arrive while the queue is full
+    # or wait longer than queue_timeout are closed. Apart from configure()
+    # and stats(), only used on the loop thread.
+
+    def __init__(self, max_workers=MAX_WORKERS, max_channels=MAX_TOTAL_CHANNELS,
+                 max_queue=MAX_QUEUE, queue_timeout=QUEUE_TIMEOUT):
+        self.max_workers = max_workers
+        self.max_channels = max_channels
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.lock = threading.Lock()
+        self.executor = None
+        self.queue = collections.deque()
+        self.expire_handle = None
+        self.opening = 0
+        self.active_channels = 0
+        self.admitted = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+        self.max_queue_depth = 0
+
+    def configure(self, max_workers=None, max_channels=None, max_queue=None,
+                  queue_timeout=None):
+        # (Takes effect for the executor only before the first channel.)
+        with self.lock:
+            if max_workers is not None:
+                self.max_workers = max(1, max_workers)
+            if max_channels is not None:
+                self.max_channels = max_channels
+            if max_queue is not None:
+                self.max_queue = max_queue
+            if queue_timeout is not None:
+                self.queue_timeout = queue_timeout
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': min(self.opening, self.max_workers),
+                'queue_depth': len(self.queue),
+                'max_queue_depth': self.max_queue_depth,
+                'active_channels': self.active_channels,
+                'admitted': self.admitted,
+                'rejected_queue_full': self.rejected_full,
+                'rejected_timeout': self.rejected_timeout,
+            }
+
+    def admissible(self, limit):
+        if self.max_channels and self.active_channels >= self.max_channels:
+            return False
+        if limit.max_channels and limit.active >= limit.max_channels:
+            return False
+        return True
+
+    def admit(self, protocol):
+        # (Called with the lock held.)
+        protocol.limit.active += 1
+        self.active_channels += 1
+        self.admitted += 1
+
+    def submit(self, protocol):
+        # Anything already queued is waiting for a slot of its own forward,
+        # so a connection that is admissible now goes ahead of it
+        with self.lock:
+            admitted = self.admissible(protocol.limit)
+            full = not admitted and self.max_queue and len(self.queue) >= self.max_queue
+            if admitted:
+                self.admit(protocol)
+            elif full:
+                self.rejected_full += 1
+            else:
+                self.queue.append((time.time(), protocol))
+                self.max_queue_depth = max(self.max_queue_depth, len(self.queue))
+        if admitted:
+            protocol.admitted()
+        elif full:
+            protocol.rejected('queue full')
+        else:
+            self.schedule_expiry()
+
+    def cancel(self, protocol):
+        # The client went away while waiting
+        with self.lock:
+            for item in self.queue:
+                if item[1] is protocol:
+                    self.queue.remove(item)
+                    break
+
+    def release(self, limit):
+        with self.lock:
+            limit.active -= 1
+            self.active_channels -= 1
+        self.dispatch()
+
+    def dispatch(self):
+        # Drop entries that have waited too long and admit the oldest ones
+        # that fit under the limits
+        now = time.time()
+        admitted = []
+        expired = []
+        with self.lock:
+            remaining = collections.deque()
+            for item in self.queue:
+                if self.queue_timeout and now - item[0] > self.queue_timeout:
+                    expired.append(item[1])
+                elif self.admissible(item[1].limit):
+                    self.admit(item[1])
+                    admitted.append(item[1])
+                else:
+                    remaining.append(item)
+            self.queue = remaining
+            self.rejected_timeout += len(expired)
+        for protocol in expired:
+            protocol.rejected('timed out in queue')
+        for protocol in admitted:
+            protocol.admitted()
+        self.schedule_expiry()
+
+    def schedule_expiry(self):
+        # Wake up in time to expire the oldest queued entry
+        if self.expire_handle is not None:
+            self.expire_handle.cancel()
+            self.expire_handle = None
+        with self.lock:
+            if not self.queue or not self.queue_timeout:
+                return
+            delay = max(self.queue[0][0] + self.queue_timeout - time.time(), 0.01)
+        self.expire_handle = get_loop().call_later(delay, self.dispatch)
+
+    def open_channel(self, transport, destination, origin):
+        # Returns a future for transport.open_channel() run on the executor
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.max_workers)
+        with self.lock:
+            self.opening += 1
+        future = get_loop().run_in_executor(self.executor, transport.open_channel,
+                                            'direct-tcpip', destination, origin)
+        future.add_done_callback(self.opened)
+        return future
+
+    def opened(self, future):
+        with self.lock:
+            self.opening -= 1
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_forward_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ForwardPool()
+            get_metrics().register('forward_pool', _pool.stats, FORWARD_POOL_METRICS,
+                                   {'engine': 'async'})
+        return _pool
+
+
+def forward_tunnel(local_host, local_port, remote_host, remote_port, transport,
+                   min_bufsize=MIN_BUFSIZE, max_bufsize=MAX_BUFSIZE,
+                   max_pending=MAX_PENDING, max_channels=0, keepalive=0,
+                   idle_timeout=0, warm_channels=0, warm_ttl=WARM_TTL, rate_limit=0):
+    loop = get_loop()
+    limit = ChannelLimit(max_channels)
+    channel_pool = None
+    metrics_name = '%s:%d' % (local_host, local_port)
+    forward_limit = None
+    if rate_limit:
+        forward_limit = Limit(rate_limit)
+
+    def protocol_factory():
+        upstream_limit, downstream_limit = limiters(forward_limit, remote_host)
+        protocol = ChannelProtocol
+        if upstream_limit is not None and MeteredChannelProtocol is not None:
+            protocol = MeteredChannelProtocol
+        return protocol(loop, remote_host, remote_port, transport,
+                        min_bufsize, max_bufsize, max_pending, limit,
+                        keepalive, idle_timeout, channel_pool, metrics_name,
+                        upstream_limit, downstream_limit)
+
+    # Bind synchronously so errors such as a port already in use surface to
+    # the caller just like they do with the threaded engine
+    coro = loop.create_server(protocol_factory, local_host, local_port,
+            reuse_address=True)
+    server = asyncio.run_coroutine_threadsafe(coro, loop).result()
+    if warm_channels:
+        # The pool starts pre-opening channels on the first connection
+        channel_pool = ChannelPool(transport, remote_host, remote_port,
+                                   warm_channels, warm_ttl, metrics_name)
+    server.channel_pool = channel_pool
+    return server
+
+
+def close_tunnel(server):
+    # Stop listening; open connections keep their protocols and carry on
+    loop = get_loop()
+    loop.call_soon_threadsafe(server.close)
+    if server.channel_pool is not None:
+        server.channel_pool.close()
@@ -0,0 +1,175 @@
+#
+#  channelpool.py
+#
+# License: Copyright (c) 2016 Hologram All Rights Reserved.
+#
+# Released under the MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import logging
+import threading
+import time
+
+from SpaceBridge.sbmetrics import get_metrics
+from SpaceBridge.transportpool import close_channel
+
+# How long a pre-opened channel is kept before being replaced, in seconds.
+# Devices and the tunnel server may give up on a connection nobody talks on.
+WARM_TTL = 30.0
+# How long to wait before trying again when opening a channel fails
+REFILL_RETRY_DELAY = 5.0
+# Source address reported for channels opened before a client connects
+WARM_ORIGIN = ('127.0.0.1', 0)
+# What of ChannelPool.stats() is exported with the connection metrics
+CHANNEL_POOL_METRICS = [
+    ('warm', 'warm', 'gauge', 'Pre-opened channels ready to hand out'),
+    ('hits', 'hits_total', 'counter', 'Connections given a pre-opened channel'),
+    ('misses', 'misses_total', 'counter', 'Connections that had to open their own channel'),
+    ('expired', 'expired_total', 'counter', 'Pre-opened channels dropped unused'),
+]
+
+
+class ChannelPool:
+    # Keeps a few direct-tcpip channels to one forward's destination open
+    # ahead of time so an accepted connection can start relaying at once
+    # instead of paying a round trip through the tunnel server to the device.
+    # A filler thread tops the pool back up after every take and replaces
+    # channels that have gone stale or outlived the TTL. Unless start() is
+    # called first, it starts with the first take, so forwards nobody uses
+    # never open channels. Given the forward's name, the pool's counters are
+    # exported with the metrics until it is closed.
+
+    def __init__(self, transport, remote_host, remote_port, size, ttl=WARM_TTL,
+                 name=None):
+        self.transport = transport
+        self.remote_host = remote_host
+        self.remote_port = remote_port
+        self.size = size
+        self.ttl = ttl
+        self.logger = logging.getLogger('forwardhandler')
+        self.cond = threading.Condition()
+        # (opened_at, channel), oldest first
+        self.warm = []
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.closed = False
+        self.started = False
+        self.metrics = None
+        if name is not None:
+            self.metrics = get_metrics().register('warm_channels', self.stats,
+                    CHANNEL_POOL_METRICS, {'forward': name})
+
+    def start(self):
+        self.started = True
+        filler = threading.Thread(target=self.fill,
+                                  name='channel-pool-%s:%d' % (self.remote_host,
+                                                               self.remote_port))
+        filler.daemon = True
+        filler.start()
+        return self
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            warm, self.warm = self.warm, []
+            self.cond.notify_all()
+        for opened_at, chan in warm:
+            self.discard(chan)
+        if self.metrics is not None:
+            get_metrics().unregister(self.metrics)
+
+    def take(self):
+        # Returns a ready channel, or None if the caller has to open its own
+        with self.cond:
+            if not self.started and not self.closed:
+                self.start()
+            now = time.time()
+            while self.warm:
+                opened_at, chan = self.warm.pop(0)
+                if self.usable(chan, opened_at, now):
+                    self.hits += 1
+                    self.cond.notify_all()
+                    return chan
+                self.expired += 1
+                self.discard(chan)
+            self.misses += 1
+            self.cond.notify_all()
+            return None
+
+    def usable(self, chan, opened_at, now):
+        return (not chan.closed and not chan.eof_received
+                and now - opened_at < self.ttl)
+
+    def discard(self, chan):
+        close_channel(chan)
+
+    def prune(self, now):
+        # Called with the lock held. Drops channels that can't be handed out
+        # any more and returns how long until the next one expires.
+        keep = []
+        for opened_at, chan in self.warm:
+            if self.usable(chan, opened_at, now):
+                keep.append((opened_at, chan))
+            else:
+                self.expired += 1
+                self.discard(chan)
+        self.warm = keep
+        if keep:
+            return max(0, keep[0][0] + self.ttl - now)
+        return None
+
+    def fill(self):
+        while True:
+            with self.cond:
+                if self.closed:
+                    return
+                wait = self.prune(time.time())
+                if len(self.warm) >= self.size:
+                    self.cond.wait(wait)
+                    continue
+            try:
+                chan = self.transport.open_channel('direct-tcpip',
+                        (self.remote_host, self.remote_port), WARM_ORIGIN)
+            except Exception as e:
+                chan = None
+                self.logger.debug('Could not pre-open channel to %s:%d: %r',
+                        self.remote_host, self.remote_port, e)
+            if chan is None:
+                with self.cond:
+                    self.cond.wait(REFILL_RETRY_DELAY)
+                continue
+            with self.cond:
+                if self.closed:
+                    self.discard(chan)
+                    return
+                self.warm.append((time.time(), chan))
+
+    def stats(self):
+        with self.cond:
+            taken = self.hits + self.misses
+            return {
+                'warm': len(self.warm),
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'hit_rate': float(self.hits) / taken if taken else 0.0,
+            }
@@ -0,0 +1,108 @@
+#
+#  linkindex.py
+#
+# License: Copyright (c) 2016 Hologram All Rights Reserved.
+#
+# Released under the MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import bisect
+
+
+class LinkIndex:
+    # In-memory index over link records from the Dashboard API. Lookups by
+    # link id and device id are dict lookups; device name search uses a
+    # sorted list of lowercased names for prefix matches and falls back to a
+    # substring scan. Links can be added a page at a time as they load.
+
+    def __init__(self, links=()):
+        self.by_id = {}
+        self.by_deviceid = {}
+        # (lowercased devicename, link id), kept sorted for bisect
+        self.names = []
+        self.add(links)
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __contains__(self, linkid):
+        return linkid in self.by_id
+
+    def add(self, links):
+        added = []
+        for link in links:
+            if link['id'] in self.by_id:
+                continue
+            self.by_id[link['id']] = link
+            self.by_deviceid[link['deviceid']] = link
+            added.append((self.name_key(link), link['id']))
+        if added:
+            self.names.extend(added)
+            self.names.sort()
+
+    def name_key(self, link):
+        return (link.get('devicename') or '').lower()
+
+    def get(self, linkid):
+        return self.by_id.get(linkid)
+
+    def get_by_deviceid(self, deviceid):
+        return self.by_deviceid.get(deviceid)
+
+    def find_name(self, name):
+        # All links whose device name is exactly name, ignoring case
+        key = name.lower()
+        start = bisect.bisect_left(self.names, (key,))
+        result = []
+        for name_key, linkid in self.names[start:]:
+            if name_key != key:
+                break
+            result.append(self.by_id[linkid])
+        return result
+
+    def search(self, text, limit=None):
+        # Links matching text, best matches first: an exact link or device
+        # id, then device names starting with text, then device names
+        # containing it. At most limit links are returned.
+        text = text.strip()
+        result = []
+        seen = set()
+
+        def take(link):
+            if link is not None and link['id'] not in seen:
+                seen.add(link['id'])
+                result.append(link)
+            return limit is not None and len(result) >= limit
+
+        if text.isdigit():
+            if take(self.get(int(text))) or take(self.get_by_deviceid(int(text))):
+                return result
+        key = text.lower()
+        start = bisect.bisect_left(self.names, (key,))
+        for name_key, linkid in self.names[start:]:
+            if not name_key.startswith(key):
+                break
+            if take(self.by_id[linkid]):
+                return result
+        for name_key, linkid in self.names:
+            if key in name_key and take(self.by_id[linkid]):
+                return result
+        return result
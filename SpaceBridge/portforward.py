@@ -29,61 +29,1038 @@
 # Special thanks to the Paramiko project.
 #
 
+import collections
+import errno
 import socket
 import select
 import logging
 import threading
+import time
+
+import paramiko
 
 try:
     import SocketServer
 except ImportError:
     import socketserver as SocketServer
 
-class ForwardServer (SocketServer.ThreadingTCPServer):
-    daemon_threads = True
+try:
+    import selectors
+except ImportError:
+    # Python 2 has no selectors module; relays fall back to running their
+    # own select loop on the handler thread
+    selectors = None
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, which has no per-process descriptor limit
+    resource = None
+
+from SpaceBridge.channelpool import ChannelPool, WARM_TTL
+from SpaceBridge.transportpool import close_channel
+from SpaceBridge.sbmetrics import get_metrics
+from SpaceBridge.ratelimit import Limit, limiters
+
+# Bounds for relay read sizes, in bytes. Each direction of a relay starts
+# reading MIN_BUFSIZE at a time and grows towards MAX_BUFSIZE while reads
+# keep filling the buffer.
+MIN_BUFSIZE = 16384
+MAX_BUFSIZE = 262144
+# Relay buffers kept for reuse once no relay needs them, per buffer size
+MAX_FREE_BUFFERS = 64
+# Paramiko channels can't be selected for writing, so a relay waiting for
+# the remote window to open polls it at this interval, in seconds.
+CHANNEL_RETRY_INTERVAL = 0.01
+# Admission control. Accepted connections wait in a queue of at most
+# MAX_QUEUE entries for one of MAX_WORKERS threads to open their channel,
+# and are turned away after QUEUE_TIMEOUT seconds. MAX_TOTAL_CHANNELS caps
+# channels across all forwards. 0 disables a limit.
+MAX_WORKERS = 16
+MAX_TOTAL_CHANNELS = 0
+MAX_QUEUE = 1024
+QUEUE_TIMEOUT = 10.0
+# How often relays are checked against their idle timeout, in seconds
+IDLE_CHECK_INTERVAL = 1.0
+# How long close_tunnel waits for the poller to close a listener, in seconds
+UNLISTEN_TIMEOUT = 5.0
+# Unanswered TCP keepalive probes before a connection is considered dead
+KEEPALIVE_PROBES = 3
+
+
+class ReadSizer:
+    # Picks read sizes for one direction of a relay. The size doubles each
+    # time a read fills it and halves once reads come back mostly empty, so
+    # bulk transfers get large reads while interactive traffic stays small.
+
+    def __init__(self, min_size=MIN_BUFSIZE, max_size=MAX_BUFSIZE):
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.size = min_size
+
+    def read_size(self, window=0, packet=0):
+        # When reading data bound for a channel, don't read more than the
+        # remote window will take and round down to whole packets so a read
+        # never ends in a runt packet.
+        size = self.size
+        if window > 0:
+            size = min(size, window)
+        if packet > 0 and size > packet:
+            size -= size % packet
+        return size
+
+    def update(self, requested, received):
+        if received >= requested and requested == self.size:
+            self.size = min(self.size * 2, self.max_size)
+        elif received < requested // 4:
+            self.size = max(self.size // 2, self.min_size)
+
+
+def raise_fd_limit(needed):
+    # Every forward holds a listening socket and every open tunnel two more
+    # descriptors. Raise the soft limit towards the hard one when the
+    # default (often 1024) is too small for what was asked for.
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY or soft >= needed:
+        return
+    if hard == resource.RLIM_INFINITY:
+        target = needed
+    else:
+        target = min(needed, hard)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+    except (ValueError, OSError) as e:
+        logging.getLogger('forwardhandler').warning(
+                'Could not raise the open file limit to %d: %s', target, e)
+        return
+    if target < needed:
+        logging.getLogger('forwardhandler').warning(
+                'Open file limit is %d, which may not be enough for %d descriptors',
+                target, needed)
+
+
+def enable_keepalive(sock, idle, probes=KEEPALIVE_PROBES, user_timeout=True):
+    # Turn on TCP keepalive with a probe after idle seconds of silence and
+    # every idle seconds after that, using whichever knobs the platform has.
+    # With user_timeout, unacknowledged data gets the same overall deadline
+    # where supported. That is only wanted on the tunnel server connection:
+    # a local client that stops reading for a while is not a dead peer.
+    idle = max(1, int(idle))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+    elif hasattr(socket, 'TCP_KEEPALIVE'):
+        # macOS
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle)
+    if hasattr(socket, 'TCP_KEEPINTVL'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, idle)
+    if hasattr(socket, 'TCP_KEEPCNT'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, probes)
+    if user_timeout and hasattr(socket, 'TCP_USER_TIMEOUT'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT,
+                        idle * (probes + 1) * 1000)
+    if hasattr(socket, 'SIO_KEEPALIVE_VALS'):
+        # Windows
+        sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, idle * 1000, idle * 1000))
+
+
+def channel_payload_size(chan):
+    # Largest payload paramiko puts in a single channel data packet
+    return max(chan.out_max_packet_size - 64, 0)
+
+
+def channel_takes_views():
+    # Recent paramiko releases copy any buffer they are given into the
+    # packet; older ones only accept bytes
+    try:
+        m = paramiko.Message()
+        m.add_string(memoryview(b'ok'))
+        return m.asbytes() == b'\0\0\0\x02ok'
+    except Exception:
+        return False
+
+CHANNEL_TAKES_VIEWS = channel_takes_views()
+
+
+class BufferPool:
+    # Free list of relay buffers of one size. Relays only hold a buffer
+    # while they have data waiting, so busy relays keep reusing the same
+    # few buffers and idle ones don't hold any.
+
+    def __init__(self, size, max_free=MAX_FREE_BUFFERS):
+        self.size = size
+        self.max_free = max_free
+        self.free = collections.deque()
+
+    def get(self):
+        try:
+            return self.free.pop()
+        except IndexError:
+            return memoryview(bytearray(self.size))
+
+    def put(self, view):
+        if len(self.free) < self.max_free:
+            self.free.append(view)
+
+
+_buffer_pools = {}
+_buffer_pools_lock = threading.Lock()
+
+
+def get_buffer_pool(size):
+    with _buffer_pools_lock:
+        if size not in _buffer_pools:
+            _buffer_pools[size] = BufferPool(size)
+        return _buffer_pools[size]
+
+
+class RelayBuffer:
+    # Data waiting to be sent in one direction of a relay. Data from the
+    # local socket is received straight into the buffer with recv_into,
+    # and both sides are sent memoryview slices of it, so steady-state
+    # relaying neither allocates nor copies on our side.
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.view = None
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def space(self):
+        return self.pool.size - len(self)
+
+    def reserve(self, size):
+        # Writable view of up to size bytes after the pending data
+        if self.view is None:
+            self.view = self.pool.get()
+        elif self.pool.size - self.end < size and self.start:
+            # Make room by moving the pending data to the front. Slice
+            # assignment between views of one buffer is a memmove, so the
+            # overlap is safe.
+            pending = self.end - self.start
+            self.view[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+        return self.view[self.end:self.end + min(size, self.pool.size - self.end)]
+
+    def recv_from(self, sock, size):
+        try:
+            received = sock.recv_into(self.reserve(size))
+        except Exception:
+            self.trim()
+            raise
+        self.end += received
+        self.trim()
+        return received
+
+    def append(self, data):
+        # (The caller makes sure there is room.)
+        self.reserve(len(data))[:len(data)] = data
+        self.end += len(data)
+
+    def data(self, limit):
+        return self.view[self.start:min(self.end, self.start + limit)]
+
+    def consume(self, size):
+        self.start += size
+        self.trim()
+
+    def trim(self):
+        # Hand the buffer back as soon as it is empty
+        if self.view is not None and self.start == self.end:
+            self.pool.put(self.view)
+            self.view = None
+            self.start = self.end = 0
+
+
+class Relay:
+    # Pumps data both ways between a local socket and a channel without ever
+    # blocking on either one. Anything a side couldn't take yet is kept in a
+    # pending buffer for that direction, and reading from the sending side
+    # stops while that buffer is full so a slow peer can't make us drop data
+    # or buffer without bound. Either side closing ends the relay once the
+    # data already read from it has been delivered, and so does going
+    # idle_timeout seconds without reading anything from either side.
+    #
+    # A direction with a rate limiter only reads what its buckets allow
+    # and stops reading while they are empty. readers() leaves it out then
+    # and sets throttled to the seconds until it may read again.
+
+    def __init__(self, sock, chan, min_bufsize=MIN_BUFSIZE,
+                 max_bufsize=MAX_BUFSIZE, on_close=None,
+                 idle_timeout=0, metrics=None, upstream_limit=None,
+                 downstream_limit=None):
+        self.sock = sock
+        self.chan = chan
+        self.on_close = on_close
+        self.metrics = metrics
+        self.upstream_limit = upstream_limit
+        self.downstream_limit = downstream_limit
+        self.throttled = None
+        self.idle_timeout = idle_timeout
+        self.last_active = time.time()
+        self.upstream = ReadSizer(min_bufsize, max_bufsize)
+        self.downstream = ReadSizer(min_bufsize, max_bufsize)
+        # A direction stops reading once its buffer is full, so the largest
+        # read size also bounds what is queued for a slow peer
+        buffers = get_buffer_pool(max(1, max_bufsize))
+        self.to_chan = RelayBuffer(buffers)
+        self.to_sock = RelayBuffer(buffers)
+        self.sock_eof = False
+        self.chan_eof = False
+        self.failed = False
+        self.closed = False
+        sock.setblocking(0)
+        chan.setblocking(0)
+
+    def finished(self):
+        return (self.failed or (self.sock_eof and not self.to_chan) or
+                (self.chan_eof and not self.to_sock))
+
+    def wants_sock(self):
+        return not self.sock_eof and self.to_chan.space()
+
+    def wants_chan(self):
+        return not self.chan_eof and self.to_sock.space()
+
+    def readers(self):
+        r = []
+        self.throttled = None
+        if self.wants_sock() and not self.held_back(self.upstream_limit):
+            r.append(self.sock)
+        if self.wants_chan() and not self.held_back(self.downstream_limit):
+            r.append(self.chan)
+        return r
+
+    def held_back(self, limit):
+        # Whether limit keeps a direction from reading right now
+        if limit is None:
+            return False
+        delay = limit.delay()
+        if delay <= 0:
+            return False
+        if self.throttled is None or delay < self.throttled:
+            self.throttled = delay
+        return True
+
+    def bulk(self):
+        # Whether either direction is moving data as fast as it is allowed
+        return ((self.upstream_limit is not None and self.upstream_limit.bulk) or
+                (self.downstream_limit is not None and self.downstream_limit.bulk))
+
+    def writers(self):
+        if self.to_sock:
+            return [self.sock]
+        return []
+
+    def timeout(self):
+        # Only pending channel writes, rate limits and the idle timeout need
+        # polling. (Call after readers().)
+        if self.to_chan:
+            return CHANNEL_RETRY_INTERVAL
+        timeouts = [self.throttled]
+        if self.idle_timeout:
+            timeouts.append(IDLE_CHECK_INTERVAL)
+        timeouts = [t for t in timeouts if t is not None]
+        if not timeouts:
+            return None
+        return min(timeouts)
+
+    def expire_if_idle(self, now):
+        if self.idle_timeout and now - self.last_active > self.idle_timeout:
+            self.failed = True
+            return True
+        return False
+
+    def run(self):
+        # Pump on the calling thread until the relay is done
+        while not self.finished():
+            readers = self.readers()
+            r, w, x = select.select(readers, self.writers(), [], self.timeout())
+            self.pump(r, w)
+            if self.expire_if_idle(time.time()):
+                logging.getLogger('forwardhandler').info(
+                        'Closing tunnel idle for over %ds', self.idle_timeout,
+                        extra={'fields': {'event': 'idle_closed'}})
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        close_channel(self.chan)
+        self.sock.close()
+        # Return the buffers of anything left undelivered
+        self.to_chan.consume(len(self.to_chan))
+        self.to_sock.consume(len(self.to_sock))
+        if self.metrics is not None:
+            self.metrics.close()
+        if self.on_close is not None:
+            self.on_close()
+
+    def pump(self, readable, writable):
+        try:
+            if self.sock in readable:
+                self.read_sock()
+            if self.chan in readable:
+                self.read_chan()
+            if self.to_sock and self.sock in writable:
+                self.write_sock()
+            if self.to_chan:
+                self.write_chan()
+        except socket.error:
+            self.failed = True
+
+    def read_sock(self):
+        size = self.upstream.read_size(self.chan.out_window_size,
+                                       channel_payload_size(self.chan))
+        size = min(size, self.to_chan.space())
+        if self.upstream_limit is not None:
+            size = min(size, self.upstream_limit.allowance())
+            if size <= 0:
+                # Another relay spent the tokens since we were polled
+                return
+        try:
+            received = self.to_chan.recv_from(self.sock, size)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+        if received == 0:
+            self.sock_eof = True
+            return
+        self.last_active = time.time()
+        self.upstream.update(size, received)
+        if self.upstream_limit is not None:
+            self.upstream_limit.consume(size, received)
+        if self.metrics is not None:
+            self.metrics.transferred(received, 0)
+
+    def read_chan(self):
+        size = self.downstream.read_size()
+        size = min(size, self.to_sock.space())
+        if self.downstream_limit is not None:
+            size = min(size, self.downstream_limit.allowance())
+            if size <= 0:
+                return
+        try:
+            # Paramiko has no recv_into, so this is the one allocation
+            data = self.chan.recv(size)
+        except socket.timeout:
+            return
+        if len(data) == 0:
+            self.chan_eof = True
+            return
+        self.last_active = time.time()
+        self.downstream.update(size, len(data))
+        if self.downstream_limit is not None:
+            self.downstream_limit.consume(size, len(data))
+        if self.metrics is not None:
+            self.metrics.transferred(0, len(data))
+        if self.to_sock:
+            self.to_sock.append(data)
+            return
+        # Nothing is queued ahead of it, so try the socket right away and
+        # only buffer what it won't take
+        sent = self.send_sock(data)
+        if sent < len(data):
+            self.to_sock.append(memoryview(data)[sent:])
+
+    def send_sock(self, data):
+        try:
+            return self.sock.send(data)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return 0
+            raise
+
+    def write_sock(self):
+        self.to_sock.consume(self.send_sock(self.to_sock.data(len(self.to_sock))))
+
+    def write_chan(self):
+        packet = channel_payload_size(self.chan) or len(self.to_chan)
+        while self.to_chan:
+            data = self.to_chan.data(packet)
+            if not CHANNEL_TAKES_VIEWS:
+                data = data.tobytes()
+            try:
+                sent = self.chan.send(data)
+            except socket.timeout:
+                # The remote window is full
+                return
+            if sent == 0:
+                # The channel has been closed
+                self.failed = True
+                return
+            self.to_chan.consume(sent)
+
+
+class RelayPoller:
+    # Drives the relays of every forward from a single thread. Handler
+    # threads only open the channel and hand the relay over, so an open
+    # tunnel costs two registered file descriptors instead of a thread, and
+    # the selector (epoll on Linux) isn't limited to FD_SETSIZE.
+    #
+    # The listening sockets of every forward are watched here too and
+    # accepted connections are queued for the worker pool, so an idle
+    # forward costs one file descriptor rather than a serve_forever thread.
+
+    def __init__(self):
+        self.logger = logging.getLogger('forwardhandler')
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.incoming = []
+        self.events = {}
+        # Relays with data waiting for the remote window to open
+        self.waiting = set()
+        # Relays with an idle timeout
+        self.expiring = set()
+        # Relay -> time its rate limits let it read again
+        self.throttled = {}
+        # Listening socket -> ForwardServer
+        self.listeners = {}
+        # (server, event) pairs; event is None to start listening, or set
+        # once the server has stopped listening and is closed
+        self.listener_changes = []
+        self.last_idle_check = time.time()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(0)
+        self.wake_w.setblocking(0)
+        self.selector.register(self.wake_r, selectors.EVENT_READ)
+
+    def start(self):
+        poller_thread = threading.Thread(target=self.run, name='relay-poller')
+        poller_thread.daemon = True
+        poller_thread.start()
+
+    def add(self, relay):
+        with self.lock:
+            self.incoming.append(relay)
+        self.wake()
+
+    def listen(self, server):
+        server.socket.setblocking(0)
+        with self.lock:
+            self.listener_changes.append((server, None))
+        self.wake()
+
+    def unlisten(self, server):
+        # Stop accepting on server and close it. Waits for the poller so
+        # the port can be bound again as soon as this returns.
+        closed = threading.Event()
+        with self.lock:
+            self.listener_changes.append((server, closed))
+        self.wake()
+        closed.wait(UNLISTEN_TIMEOUT)
+
+    def wake(self):
+        try:
+            self.wake_w.send(b'\0')
+        except socket.error:
+            # The wakeup pipe is full, so the poller is about to wake anyway
+            pass
+
+    def run(self):
+        while True:
+            with self.lock:
+                incoming, self.incoming = self.incoming, []
+                listener_changes, self.listener_changes = self.listener_changes, []
+            for server, closed in listener_changes:
+                self.change_listener(server, closed)
+            for relay in incoming:
+                if relay.idle_timeout:
+                    self.expiring.add(relay)
+                self.update(relay)
+
+            timeout = None
+            if self.waiting:
+                timeout = CHANNEL_RETRY_INTERVAL
+            elif self.expiring:
+                timeout = IDLE_CHECK_INTERVAL
+            if self.throttled:
+                wake = max(min(self.throttled.values()) - time.time(), 0)
+                if timeout is None or wake < timeout:
+                    timeout = wake
+            ready = {}
+            for key, mask in self.selector.select(timeout):
+                if key.fileobj is self.wake_r:
+                    self.drain_wakeups()
+                    continue
+                if key.fileobj in self.listeners:
+                    self.accept(self.listeners[key.fileobj])
+                    continue
+                r, w = ready.setdefault(key.data, ([], []))
+                if mask & selectors.EVENT_READ:
+                    r.append(key.fileobj)
+                if mask & selectors.EVENT_WRITE:
+                    w.append(key.fileobj)
+            for relay in self.waiting:
+                ready.setdefault(relay, ([], []))
+            now = time.time()
+            for relay, wake in list(self.throttled.items()):
+                if wake <= now:
+                    ready.setdefault(relay, ([], []))
+            if self.expiring and now - self.last_idle_check >= IDLE_CHECK_INTERVAL:
+                self.last_idle_check = now
+                for relay in self.expiring:
+                    if relay.expire_if_idle(now):
+                        self.logger.info('Closing tunnel idle for over %ds',
+                                         relay.idle_timeout,
+                                         extra={'fields': {'event': 'idle_closed'}})
+                        ready.setdefault(relay, ([], []))
+
+            # Rate limited relays moving bulk data go last, so interactive
+            # ones sharing their buckets get served first
+            bulk = []
+            for relay, (r, w) in ready.items():
+                if relay.bulk():
+                    bulk.append((relay, r, w))
+                else:
+                    self.pump(relay, r, w)
+            for relay, r, w in bulk:
+                self.pump(relay, r, w)
+
+    def pump(self, relay, r, w):
+        try:
+            relay.pump(r, w)
+        except Exception as e:
+            self.logger.warning('Relay failed: %r', e)
+            relay.failed = True
+        self.update(relay)
+
+    def change_listener(self, server, closed):
+        if closed is None:
+            try:
+                self.selector.register(server.socket, selectors.EVENT_READ)
+            except Exception as e:
+                self.logger.error('Could not listen on %r: %r',
+                                  server.server_address, e)
+                server.server_close()
+                return
+            self.listeners[server.socket] = server
+            return
+        try:
+            if self.listeners.pop(server.socket, None) is not None:
+                self.selector.unregister(server.socket)
+            server.server_close()
+        except Exception as e:
+            self.logger.warning('Closing listener failed: %r', e)
+        finally:
+            closed.set()
+
+    def accept(self, server):
+        # Accepts one pending connection and queues it for a worker. The
+        # socket is non-blocking, so a connection that went away before we
+        # got to it is simply skipped.
+        try:
+            server._handle_request_noblock()
+        except Exception as e:
+            self.logger.warning('Accept failed: %r', e)
+
+    def drain_wakeups(self):
+        try:
+            while self.wake_r.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def update(self, relay):
+        # A relay that breaks while being updated is dropped on its own so
+        # the other tunnels carry on
+        try:
+            self.register(relay)
+        except Exception:
+            self.logger.exception('Dropping relay after an error')
+            self.drop(relay)
+
+    def register(self, relay):
+        # Bring the registrations of a relay in line with what it wants next
+        if relay.finished():
+            self.set_events(relay.sock, relay, 0)
+            self.set_events(relay.chan, relay, 0)
+            self.waiting.discard(relay)
+            self.expiring.discard(relay)
+            self.throttled.pop(relay, None)
+            relay.close()
+            return
+        readers = relay.readers()
+        sock_events = 0
+        if relay.sock in readers:
+            sock_events |= selectors.EVENT_READ
+        if relay.to_sock:
+            sock_events |= selectors.EVENT_WRITE
+        chan_events = 0
+        if relay.chan in readers:
+            chan_events |= selectors.EVENT_READ
+        self.set_events(relay.sock, relay, sock_events)
+        self.set_events(relay.chan, relay, chan_events)
+        if relay.to_chan:
+            self.waiting.add(relay)
+        else:
+            self.waiting.discard(relay)
+        if relay.throttled is None:
+            self.throttled.pop(relay, None)
+        else:
+            self.throttled[relay] = time.time() + relay.throttled
+
+    def drop(self, relay):
+        # Forget a relay in an unknown state and close what is left of it
+        for fileobj in (relay.sock, relay.chan):
+            if self.events.pop(fileobj, 0):
+                try:
+                    self.selector.unregister(fileobj)
+                except Exception:
+                    pass
+        self.waiting.discard(relay)
+        self.expiring.discard(relay)
+        self.throttled.pop(relay, None)
+        try:
+            relay.close()
+        except Exception as e:
+            self.logger.warning('Closing a failed relay: %r', e)
+
+    def set_events(self, fileobj, relay, events):
+        current = self.events.get(fileobj, 0)
+        if events == current:
+            return
+        if not events:
+            self.selector.unregister(fileobj)
+            del self.events[fileobj]
+        elif not current:
+            self.selector.register(fileobj, events, relay)
+            self.events[fileobj] = events
+        else:
+            self.selector.modify(fileobj, events, relay)
+            self.events[fileobj] = events
+
+
+_poller = None
+_poller_lock = threading.Lock()
+
+
+def get_poller():
+    # The shared poller is started the first time a relay needs it
+    global _poller
+    with _poller_lock:
+        if _poller is None:
+            _poller = RelayPoller()
+            _poller.start()
+        return _poller
+
+
+class ForwardPool:
+    # Bounded pool of worker threads that open channels for every forward.
+    # Accepted connections are queued and handed to a worker once both their
+    # forward and the pool as a whole are under their channel limits, so a
+    # burst of clients can't start thousands of threads or open_channel
+    # calls at once. Connections that arrive while the queue is full or that
+    # wait longer than queue_timeout are closed.
+
+    def __init__(self, max_workers=MAX_WORKERS, max_channels=MAX_TOTAL_CHANNELS,
+                 max_queue=MAX_QUEUE, queue_timeout=QUEUE_TIMEOUT):
+        self.max_workers = max_workers
+        self.max_channels = max_channels
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+        self.workers = 0
+        self.idle = 0
+        self.active_channels = 0
+        self.admitted = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+        self.max_queue_depth = 0
+
+    def configure(self, max_workers=None, max_channels=None, max_queue=None,
+                  queue_timeout=None):
+        with self.cond:
+            if max_workers is not None:
+                self.max_workers = max(1, max_workers)
+            if max_channels is not None:
+                self.max_channels = max_channels
+            if max_queue is not None:
+                self.max_queue = max_queue
+            if queue_timeout is not None:
+                self.queue_timeout = queue_timeout
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'workers': self.workers,
+                'queue_depth': len(self.queue),
+                'max_queue_depth': self.max_queue_depth,
+                'active_channels': self.active_channels,
+                'admitted': self.admitted,
+                'rejected_queue_full': self.rejected_full,
+                'rejected_timeout': self.rejected_timeout,
+            }
+
+    def submit(self, server, request, client_address):
+        with self.cond:
+            full = self.max_queue and len(self.queue) >= self.max_queue
+            if full:
+                self.rejected_full += 1
+            else:
+                self.queue.append((time.time(), server, request, client_address))
+                self.max_queue_depth = max(self.max_queue_depth, len(self.queue))
+                if self.idle == 0 and self.workers < self.max_workers:
+                    self.workers += 1
+                    worker = threading.Thread(target=self.work,
+                                              name='forward-worker')
+                    worker.daemon = True
+                    worker.start()
+                self.cond.notify_all()
+        if full:
+            server.reject_request(request, client_address, 'queue full')
+
+    def release(self, server):
+        with self.cond:
+            server.active_channels -= 1
+            self.active_channels -= 1
+            self.cond.notify_all()
+
+    def admissible(self, server):
+        if self.max_channels and self.active_channels >= self.max_channels:
+            return False
+        if server.max_channels and server.active_channels >= server.max_channels:
+            return False
+        return True
+
+    def take(self):
+        # (Called with the lock held.) Drop entries that have waited too long
+        # and take the oldest entry whose forward has a free channel slot.
+        now = time.time()
+        chosen = None
+        expired = []
+        remaining = collections.deque()
+        for item in self.queue:
+            if self.queue_timeout and now - item[0] > self.queue_timeout:
+                expired.append(item)
+            elif chosen is None and self.admissible(item[1]):
+                chosen = item
+            else:
+                remaining.append(item)
+        self.queue = remaining
+        self.rejected_timeout += len(expired)
+        if chosen is not None:
+            chosen[1].active_channels += 1
+            self.active_channels += 1
+            self.admitted += 1
+        return chosen, expired
+
+    def wait_time(self):
+        # Wake up in time to expire the oldest queued entry
+        if not self.queue or not self.queue_timeout:
+            return None
+        return max(self.queue[0][0] + self.queue_timeout - time.time(), 0.01)
+
+    def work(self):
+        while True:
+            with self.cond:
+                while True:
+                    item, expired = self.take()
+                    if item is not None or expired:
+                        break
+                    self.idle += 1
+                    self.cond.wait(self.wait_time())
+                    self.idle -= 1
+            for queued_at, server, request, client_address in expired:
+                server.reject_request(request, client_address, 'timed out in queue')
+            if item is not None:
+                queued_at, server, request, client_address = item
+                server.process_admitted(request, client_address)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# What of ForwardPool.stats() is exported with the connection metrics
+FORWARD_POOL_METRICS = [
+    ('workers', 'workers', 'gauge', 'Worker threads opening channels'),
+    ('queue_depth', 'queue_depth', 'gauge', 'Accepted connections waiting for a worker'),
+    ('max_queue_depth', 'max_queue_depth', 'gauge', 'Most connections ever waiting at once'),
+    ('active_channels', 'active_channels', 'gauge', 'Channels open through the pool'),
+    ('admitted', 'admitted_total', 'counter', 'Connections handed to a worker'),
+    ('rejected_queue_full', 'rejected_queue_full_total', 'counter',
+     'Connections refused because the queue was full'),
+    ('rejected_timeout', 'rejected_timeout_total', 'counter',
+     'Connections refused after waiting too long in the queue'),
+]
+
+
+def get_forward_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ForwardPool()
+            get_metrics().register('forward_pool', _pool.stats, FORWARD_POOL_METRICS)
+        return _pool
+
+
+class ForwardServer (SocketServer.TCPServer):
     allow_reuse_address = True
-    
+    # Connection bursts are absorbed by the pool queue, so don't let the
+    # kernel drop SYNs with the default backlog of 5
+    request_queue_size = 128
+    # Most channels this forward may have open at once, 0 for no limit
+    max_channels = 0
+
+    def __init__(self, server_address, RequestHandlerClass):
+        SocketServer.TCPServer.__init__(self, server_address,
+                                        RequestHandlerClass)
+        self.pool = get_forward_pool()
+        self.detached = set()
+        self.active_channels = 0
+        self.rejected = 0
+
+    def get_request(self):
+        # The listening socket may be non-blocking when the shared poller
+        # watches it; the handler expects a blocking socket
+        request, client_address = self.socket.accept()
+        request.setblocking(1)
+        return request, client_address
+
+    def process_request(self, request, client_address):
+        # Queue the connection for the shared worker pool rather than
+        # starting a thread for it
+        self.pool.submit(self, request, client_address)
+
+    def process_admitted(self, request, client_address):
+        # Runs on a pool worker once the connection holds a channel slot
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        if request in self.detached:
+            # The relay gives the slot back when it closes
+            self.detached.discard(request)
+        else:
+            self.shutdown_request(request)
+            self.pool.release(self)
+
+    def describe(self):
+        handler = self.RequestHandlerClass
+        return '%s:%d' % (handler.chain_host, handler.chain_port)
+
+    def reject_request(self, request, client_address, reason):
+        self.rejected += 1
+        handler = self.RequestHandlerClass
+        get_metrics().rejected(handler.metrics_name, handler.chain_host)
+        logging.getLogger('forwardhandler').warning(
+                'Rejected connection from %r to %s: %s (queue depth %d)',
+                client_address, self.describe(), reason, len(self.pool.queue),
+                extra={'fields': {'event': 'rejected', 'forward': handler.metrics_name,
+                                  'reason': reason}})
+        self.shutdown_request(request)
+
+    def detach_request(self, request):
+        # Ownership of the socket has moved to a relay, so don't close it
+        # when the handler returns
+        self.detached.add(request)
+
 
 class Handler (SocketServer.BaseRequestHandler):
+    min_bufsize = MIN_BUFSIZE
+    max_bufsize = MAX_BUFSIZE
+    keepalive = 0
+    idle_timeout = 0
+    channel_pool = None
+    # The forward's name in the metrics
+    metrics_name = None
+    # The forward's ratelimit.Limit, if it has one
+    rate_limit = None
+
+    def destination(self):
+        # Where the channel for this connection goes, or None to drop the
+        # connection
+        return self.chain_host, self.chain_port
+
+    def channel_failed(self, rejected):
+        pass
+
+    def channel_opened(self, chan):
+        pass
 
     def handle(self):
         logger = logging.getLogger('forwardhandler')
+        if self.keepalive:
+            enable_keepalive(self.request, self.keepalive, user_timeout=False)
+        destination = self.destination()
+        if destination is None:
+            return
+        metrics = get_metrics()
+        started = time.time()
+        chan = None
+        if self.channel_pool is not None:
+            chan = self.channel_pool.take()
         try:
-            chan = self.ssh_transport.open_channel('direct-tcpip',
-                                                   (self.chain_host, self.chain_port),
-                                                   self.request.getpeername())
+            if chan is None:
+                chan = self.ssh_transport.open_channel('direct-tcpip', destination,
+                                                       self.client_address)
         except Exception as e:
-            logger.warning('Incoming request to %s:%d failed: %s' % (self.chain_host,
-                                                              self.chain_port,
-                                                              repr(e)))
+            logger.warning('Incoming request to %s:%d failed: %r',
+                           destination[0], destination[1], e,
+                           extra={'fields': {'event': 'open_failed',
+                                             'forward': self.metrics_name}})
+            metrics.open_failed(self.metrics_name, destination[0], time.time() - started)
+            self.channel_failed(False)
             return
         if chan is None:
-            logger.warning('Incoming request to %s:%d was rejected by the server.' %
-                    (self.chain_host, self.chain_port))
+            logger.warning('Incoming request to %s:%d was rejected by the server.',
+                           destination[0], destination[1],
+                           extra={'fields': {'event': 'open_refused',
+                                             'forward': self.metrics_name}})
+            metrics.open_failed(self.metrics_name, destination[0], time.time() - started)
+            self.channel_failed(True)
             return
+        channel_metrics = metrics.opened(self.metrics_name, destination[0],
+                                         time.time() - started)
+        self.channel_opened(chan)
 
-        logger.info('Connected!  Tunnel open %r -> %r -> %r' % (self.request.getpeername(),
-                                                            chan.getpeername(), (self.chain_host, self.chain_port)))
-        while True:
-            r, w, x = select.select([self.request, chan], [], [])
-            if self.request in r:
-                data = self.request.recv(1024)
-                if len(data) == 0:
-                    break
-                chan.send(data)
-            if chan in r:
-                data = chan.recv(1024)
-                if len(data) == 0:
-                    break
-                self.request.send(data)
-                
-        peername = self.request.getpeername()
-        chan.close()
-        self.request.close()
-        logger.info('Tunnel closed from %r' % (peername,))
-
-
-def forward_tunnel(local_host, local_port, remote_host, remote_port, transport):
+        peername = self.client_address
+        if logger.isEnabledFor(logging.INFO):
+            # getpeername() on the channel is a system call, so skip it
+            # unless the message is going to be written
+            logger.info('Connected!  Tunnel open %r -> %r -> %r', peername,
+                        chan.getpeername(), destination,
+                        extra={'fields': {'event': 'tunnel_open',
+                                          'forward': self.metrics_name}})
+
+        server = self.server
+
+        def closed():
+            server.pool.release(server)
+            logger.info('Tunnel closed from %r', peername,
+                        extra={'fields': {'event': 'tunnel_closed',
+                                          'forward': self.metrics_name}})
+
+        upstream_limit, downstream_limit = limiters(self.rate_limit, destination[0])
+        relay = Relay(self.request, chan, self.min_bufsize, self.max_bufsize,
+                      on_close=closed,
+                      idle_timeout=self.idle_timeout, metrics=channel_metrics,
+                      upstream_limit=upstream_limit,
+                      downstream_limit=downstream_limit)
+        self.server.detach_request(self.request)
+        if selectors is None:
+            # Without a shared poller each relay needs a thread of its own,
+            # which must not be one of the pool workers
+            relay_thread = threading.Thread(target=relay.run)
+            relay_thread.daemon = True
+            relay_thread.start()
+        else:
+            get_poller().add(relay)
+
+
+def forward_tunnel(local_host, local_port, remote_host, remote_port, transport,
+                   min_bufsize=MIN_BUFSIZE, max_bufsize=MAX_BUFSIZE,
+                   max_channels=0, keepalive=0, idle_timeout=0, warm_channels=0,
+                   warm_ttl=WARM_TTL, rate_limit=0):
     # this is a little convoluted, but lets me configure things for the Handler
     # object.  (SocketServer doesn't give Handlers any way to access the outer
     # server normally.)
@@ -91,7 +1068,40 @@ def forward_tunnel(local_host, local_port, remote_host, remote_port, transport):
         chain_host = remote_host
         chain_port = remote_port
         ssh_transport = transport
+    SubHandler.min_bufsize = min_bufsize
+    SubHandler.max_bufsize = max_bufsize
+    SubHandler.keepalive = keepalive
+    SubHandler.idle_timeout = idle_timeout
+    SubHandler.metrics_name = '%s:%d' % (local_host, local_port)
+    if rate_limit:
+        SubHandler.rate_limit = Limit(rate_limit)
     server = ForwardServer((local_host, local_port), SubHandler)
-    server_thread = threading.Thread(target=server.serve_forever)
-    server_thread.daemon = True
-    server_thread.start()
+    server.max_channels = max_channels
+    if warm_channels:
+        # The pool starts pre-opening channels on the first connection
+        SubHandler.channel_pool = ChannelPool(transport, remote_host, remote_port,
+                                              warm_channels, warm_ttl,
+                                              SubHandler.metrics_name)
+    start_listener(server)
+    return server
+
+
+def start_listener(server):
+    if selectors is None:
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+    else:
+        get_poller().listen(server)
+
+
+def close_tunnel(server):
+    # Stop accepting connections on a forward. Connections already relaying
+    # belong to the poller now and carry on until either side closes.
+    if selectors is None:
+        server.shutdown()
+        server.server_close()
+    else:
+        get_poller().unlisten(server)
+    if server.RequestHandlerClass.channel_pool is not None:
+        server.RequestHandlerClass.channel_pool.close()
@@ -0,0 +1,219 @@
+#
+#  ratelimit.py
+#
+# License: Copyright (c) 2016 Hologram All Rights Reserved.
+#
+# Released under the MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+# Token bucket rate limits for forwarded traffic, in bytes per second and
+# applied to each direction separately. A relay draws from the buckets of
+# its forward, of the link it reaches and of the global limit, and only
+# reads what all of them allow.
+#
+# Bulk transfers are kept from starving interactive channels that share a
+# bucket in two ways: a throttled read takes at most FAIR_QUANTUM bytes, so
+# channels waiting on one bucket take turns, and a direction whose reads
+# keep using up their allowance counts as bulk and may only spend tokens
+# above the bucket's interactive reserve.
+
+import threading
+import time
+
+# Seconds of traffic a bucket saves up while idle and may send at once
+BURST_SECONDS = 0.5
+# Smallest bucket size, so even low rates move whole packets
+MIN_BURST = 16384
+# Share of every bucket only interactive channels may spend
+INTERACTIVE_RESERVE = 0.25
+# Most bytes a rate limited read takes at once
+FAIR_QUANTUM = 16384
+
+
+class TokenBucket:
+    # Holds up to burst tokens, one per byte, refilled at rate per second.
+    # Reads may overdraw it when data arrives before it could be metered
+    # (the async engine can't size its socket reads), which just makes the
+    # next wait longer.
+
+    def __init__(self, rate):
+        self.lock = threading.Lock()
+        self.tokens = 0
+        self.updated = time.time()
+        self.configure(rate)
+        self.tokens = self.burst
+
+    def configure(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.burst = max(int(rate * BURST_SECONDS), MIN_BURST)
+            self.reserve = int(self.burst * INTERACTIVE_RESERVE)
+            self.quantum = min(FAIR_QUANTUM, self.burst - self.reserve)
+            self.tokens = min(self.tokens, self.burst)
+
+    def refill(self, now):
+        # (Called with the lock held.)
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def available(self, bulk, now):
+        with self.lock:
+            self.refill(now)
+            if bulk:
+                return int(self.tokens - self.reserve)
+            return int(self.tokens)
+
+    def consume(self, size, now):
+        with self.lock:
+            self.refill(now)
+            self.tokens -= size
+
+    def delay(self, bulk, now):
+        # Seconds until a read is worth doing: a bulk read waits for a full
+        # quantum above the reserve, anything else for a single byte
+        with self.lock:
+            self.refill(now)
+            if bulk:
+                needed = self.reserve + self.quantum - self.tokens
+            else:
+                needed = 1 - self.tokens
+            if needed <= 0:
+                return 0
+            return needed / float(self.rate)
+
+
+class Limit:
+    # A rate limit shared by everything it covers, with a bucket for data
+    # going to the device and one for data coming back
+
+    def __init__(self, rate, explicit=True):
+        self.upstream = TokenBucket(rate)
+        self.downstream = TokenBucket(rate)
+        # False for a link limit that only follows the default link rate
+        self.explicit = explicit
+
+    def configure(self, rate):
+        self.upstream.configure(rate)
+        self.downstream.configure(rate)
+
+
+class Limiter:
+    # The buckets one direction of one relay draws from
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bulk = False
+
+    def allowance(self):
+        # Most bytes the next read may take, 0 or less if it has to wait
+        now = time.time()
+        return min(min(b.available(self.bulk, now) for b in self.buckets), FAIR_QUANTUM)
+
+    def consume(self, requested, received):
+        now = time.time()
+        for b in self.buckets:
+            b.consume(received, now)
+        # Only a sender with more waiting fills a read completely
+        self.bulk = received >= requested
+
+    def delay(self):
+        now = time.time()
+        return max(b.delay(self.bulk, now) for b in self.buckets)
+
+
+_total = None
+_links = {}
+_default_link_rate = 0
+_lock = threading.Lock()
+
+
+def set_total_limit(rate):
+    # Limit all forwarded traffic together, 0 for no limit
+    global _total
+    with _lock:
+        if not rate:
+            _total = None
+        elif _total is None:
+            _total = Limit(rate)
+        else:
+            _total.configure(rate)
+
+
+def set_default_link_limit(rate):
+    # Limit every link that has no limit of its own, 0 for no limit
+    global _default_link_rate
+    with _lock:
+        _default_link_rate = rate
+        for link, limit in list(_links.items()):
+            if not limit.explicit:
+                if rate:
+                    limit.configure(rate)
+                else:
+                    del _links[link]
+
+
+def set_link_limit(link, rate):
+    # Limit the traffic of one link, whichever forwards it goes through.
+    # Forwards to the same link share the limit, so the last one set wins.
+    with _lock:
+        limit = _links.get(link)
+        if not rate:
+            _links.pop(link, None)
+        elif limit is None:
+            _links[link] = Limit(rate)
+        else:
+            limit.configure(rate)
+            limit.explicit = True
+
+
+def reset_link_limits(links):
+    # Put the links that had a limit set but aren't in links back on the
+    # default link rate, for when the forwards that set them are gone
+    with _lock:
+        for link, limit in list(_links.items()):
+            if not limit.explicit or link in links:
+                continue
+            if _default_link_rate:
+                limit.configure(_default_link_rate)
+                limit.explicit = False
+            else:
+                del _links[link]
+
+
+def link_limit(link):
+    with _lock:
+        limit = _links.get(link)
+        if limit is None and _default_link_rate:
+            limit = _links[link] = Limit(_default_link_rate, explicit=False)
+        return limit
+
+
+def limiters(forward_limit, link):
+    # (upstream, downstream) limiters for a new relay on a forward with
+    # limit forward_limit (or None) to link, or (None, None) when no limit
+    # applies
+    limits = [limit for limit in (forward_limit, link_limit(link), _total)
+              if limit is not None]
+    if not limits:
+        return None, None
+    return (Limiter([limit.upstream for limit in limits]),
+            Limiter([limit.downstream for limit in limits]))
@@ -0,0 +1,131 @@
+#
+#  sbapi.py
+#
+# License: Copyright (c) 2016 Hologram All Rights Reserved.
+#
+# Released under the MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from SpaceBridge.sbexceptions import UpdaterException
+
+# (connect, read) timeouts for Dashboard API calls, in seconds
+API_TIMEOUT = (10, 30)
+# Attempts for a request that fails to connect or gets a 5xx back. Only
+# idempotent requests are retried, so generating a keypair never is.
+API_RETRIES = 3
+API_BACKOFF = 0.5
+API_RETRY_STATUSES = (500, 502, 503, 504)
+# Connections kept open to the API host. Sized for concurrent page fetches.
+API_POOL_SIZE = 8
+# Rows per page for list endpoints, the most the API hands out at once
+PAGE_SIZE = 1000
+
+
+class DashboardAPI:
+    # Client for the Hologram Dashboard API. Every call goes through one
+    # requests.Session so the TCP and TLS handshakes to apibase happen once
+    # and later calls reuse the pooled keep-alive connection.
+
+    def __init__(self, apibase, apikey, timeout=API_TIMEOUT, retries=API_RETRIES,
+                 pool_size=API_POOL_SIZE):
+        self.apibase = apibase
+        self.apikey = apikey
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(total=retries, connect=retries, read=retries,
+                      status=retries, backoff_factor=API_BACKOFF,
+                      status_forcelist=API_RETRY_STATUSES,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=1,
+                              pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, path, params=None, **kwargs):
+        # Returns the requests.Response; callers check the status themselves
+        url_params = {'apikey': self.apikey}
+        if params:
+            url_params.update(params)
+        return self.session.request(method, self.apibase + path,
+                params=url_params, timeout=self.timeout, **kwargs)
+
+    def get(self, path, params=None):
+        return self.request('GET', path, params)
+
+    def post(self, path, params=None, json=None):
+        return self.request('POST', path, params, json=json)
+
+    def get_page(self, path, params):
+        r = self.get(path, params)
+        #pylint: disable=no-member
+        if r.status_code != requests.codes.ok:
+            raise UpdaterException('Error connecting to API: ' + r.text)
+        return r.json()['data']
+
+    def pages(self, path, params=None, limit=PAGE_SIZE):
+        # Yields a list endpoint one page at a time, following startafter
+        # until a short page. The next page is already being fetched while
+        # the caller works through the current one.
+        params = dict(params or {})
+        params['limit'] = limit
+        page = self.get_page(path, params)
+        while True:
+            prefetch = None
+            if len(page) >= limit:
+                params = dict(params, startafter=page[-1]['id'])
+                prefetch = Prefetch(self.get_page, path, params)
+            yield page
+            if prefetch is None:
+                return
+            page = prefetch.result()
+
+    def close(self):
+        self.session.close()
+
+
+class Prefetch:
+    # Runs one call on a background thread; result() waits for it and
+    # returns its value or raises its exception
+
+    def __init__(self, func, *args):
+        self.value = None
+        self.error = None
+        self.thread = threading.Thread(target=self.run, args=(func,) + args)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, func, *args):
+        try:
+            self.value = func(*args)
+        except Exception as e:
+            self.error = e
+
+    def result(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
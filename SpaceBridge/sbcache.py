@@ -0,0 +1,150 @@
+#
+#  sbcache.py
+#
+# License: Copyright (c) 2016 Hologram All Rights Reserved.
+#
+# Released under the MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+# Seconds cached API data is used as is
+CACHE_TTL = 300
+# Seconds past the TTL that cached data is still shown while a fresh copy is
+# fetched in the background. Older data is fetched again before it is used.
+CACHE_MAX_STALE = 7 * 24 * 3600
+
+
+class APICache:
+    # Dashboard API responses cached on disk, one JSON file per entry under
+    # <settings dir>/cache/<hash of the API key>/ so different accounts never
+    # see each other's data and the key itself is never written out.
+
+    def __init__(self, settings_dir, apikey, ttl=CACHE_TTL,
+                 max_stale=CACHE_MAX_STALE):
+        digest = hashlib.sha256(apikey.encode('utf-8')).hexdigest()[:16]
+        self.directory = os.path.join(settings_dir, 'cache', digest)
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.logger = logging.getLogger('spacebridge')
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def read(self, key):
+        # Returns (data, age in seconds), or (None, None) if there is no
+        # usable entry
+        try:
+            with open(self.path(key), 'r') as f:
+                entry = json.load(f)
+            return entry['data'], time.time() - entry['fetched_at']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None, None
+
+    def write(self, key, data):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        # Write to a temporary file and rename it into place so a reader
+        # never sees half an entry. Device names are nobody else's business,
+        # so keep the file private.
+        tmp = '%s.%d.tmp' % (self.path(key), os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'fetched_at': time.time(), 'data': data}, f)
+        if os.name == 'nt' and os.path.exists(self.path(key)):
+            os.remove(self.path(key))
+        os.rename(tmp, self.path(key))
+
+    def store(self, key, data):
+        # With a TTL of 0 the cache is off, so nothing is read or written
+        if self.ttl <= 0:
+            return data
+        try:
+            self.write(key, data)
+        except (IOError, OSError) as e:
+            self.logger.warning('Could not write API cache entry %s: %s', key, e)
+        return data
+
+    def lookup(self, key, refresh=False):
+        # Returns (data, stale) for a cached entry that may still be used,
+        # or (None, False) if it has to come from the API first
+        if self.ttl <= 0 or refresh:
+            return None, False
+        data, age = self.read(key)
+        if data is None or age > self.ttl + self.max_stale:
+            return None, False
+        self.logger.debug('Using cached %s from %ds ago', key, age)
+        return data, age > self.ttl
+
+    def fetch(self, key, loader, refresh=False):
+        # Returns the entry for key, calling loader() to get it from the API
+        # when there is no cached copy, it is too old, or refresh is set
+        data, stale = self.lookup(key, refresh)
+        if data is None:
+            return self.store(key, loader())
+        if stale:
+            self.refresh_in_background(key, loader)
+        return data
+
+    def fetch_pages(self, key, pages, refresh=False):
+        # Like fetch() for a list the API pages through. pages() returns an
+        # iterator over the pages, which are passed on as they arrive and
+        # cached as one list at the end. A cached list comes out as a single
+        # page.
+        data, stale = self.lookup(key, refresh)
+        if data is not None:
+            if stale:
+                self.refresh_in_background(key,
+                        lambda: [row for page in pages() for row in page])
+            yield data
+            return
+        rows = []
+        for page in pages():
+            rows.extend(page)
+            yield page
+        self.store(key, rows)
+
+    def refresh_in_background(self, key, loader):
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def refresh():
+            try:
+                self.store(key, loader())
+            except Exception as e:
+                self.logger.info('Background refresh of %s failed: %s', key, e)
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        self.logger.debug('Refreshing stale %s in the background', key)
+        t = threading.Thread(target=refresh, name='cache-refresh-' + key)
+        t.daemon = True
+        t.start()
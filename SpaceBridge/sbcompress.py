@@ -0,0 +1,118 @@
+#
+#  sbcompress.py
+#
+# License: Copyright (c) 2016 Hologram All Rights Reserved.
+#
+# Released under the MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+# SSH compression for the connection to the tunnel server. SSH only defines
+# zlib, either from the key exchange on (zlib) or from login on
+# (zlib@openssh.com), and the server picks whichever both sides offer.
+# What we control is how our side compresses: at which zlib level, and
+# whether to bother at all.
+#
+# Paramiko ends every packet with a full flush, so no packet refers back
+# to an earlier one and each can go out either compressed or as stored
+# (uncompressed) deflate blocks; the server decompresses both the same
+# way. Compression is switched off for a while when it doesn't save
+# enough, as with already compressed or encrypted payloads, so it stops
+# costing CPU for nothing, and is tried again later.
+
+import functools
+import logging
+import zlib
+
+import paramiko
+
+COMPRESSION_METHODS = ['zlib@openssh.com', 'zlib']
+# zlib level used by --compress without a level
+DEFAULT_LEVEL = 6
+# Bytes compressed before the ratio is judged
+SAMPLE_BYTES = 1048576
+# Compression stays on while it saves at least this share of the bytes
+MIN_SAVING = 0.1
+# Bytes sent uncompressed before compression is tried again. Doubles each
+# time a new sample doesn't pay off, up to MAX_BACKOFF_BYTES.
+BACKOFF_BYTES = 16 * 1048576
+MAX_BACKOFF_BYTES = 256 * 1048576
+
+
+class AdaptiveCompressor:
+    # Outbound compressor for a paramiko transport. Called with each packet
+    # payload and returns the bytes to send in its place.
+
+    def __init__(self, level=DEFAULT_LEVEL, adaptive=True):
+        self.logger = logging.getLogger('spacebridge')
+        self.deflate = zlib.compressobj(level)
+        # Raw deflate at level 0 only writes stored blocks, and leaves out
+        # the stream header the first compressed packet already sent
+        self.store = zlib.compressobj(0, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.adaptive = adaptive
+        self.compressing = True
+        self.sample_in = 0
+        self.sample_out = 0
+        self.stored = 0
+        self.backoff = BACKOFF_BYTES
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def __call__(self, data):
+        if self.compressing:
+            out = self.deflate.compress(data) + self.deflate.flush(zlib.Z_FULL_FLUSH)
+            if self.adaptive:
+                self.sample(len(data), len(out))
+        else:
+            out = self.store.compress(data) + self.store.flush(zlib.Z_FULL_FLUSH)
+            self.stored += len(data)
+            if self.stored >= self.backoff:
+                self.compressing = True
+                self.stored = 0
+        self.bytes_in += len(data)
+        self.bytes_out += len(out)
+        return out
+
+    def sample(self, size_in, size_out):
+        self.sample_in += size_in
+        self.sample_out += size_out
+        if self.sample_in < SAMPLE_BYTES:
+            return
+        saving = 1 - self.sample_out / float(self.sample_in)
+        if saving < MIN_SAVING:
+            self.compressing = False
+            self.logger.info('SSH compression saved %d%%, pausing it for %dMB',
+                             int(saving * 100), self.backoff // 1048576)
+            self.backoff = min(self.backoff * 2, MAX_BACKOFF_BYTES)
+        else:
+            self.backoff = BACKOFF_BYTES
+        self.sample_in = self.sample_out = 0
+
+
+def install_compressor(level=DEFAULT_LEVEL, adaptive=True):
+    # SSHClient negotiates compression while connecting, and paramiko has
+    # no way to hand a compressor to the transport it creates, so replace
+    # the one paramiko uses for both zlib methods in this process
+    info = dict(paramiko.Transport._compression_info)
+    compressor = functools.partial(AdaptiveCompressor, level, adaptive)
+    for method in COMPRESSION_METHODS:
+        info[method] = (compressor, info[method][1])
+    paramiko.Transport._compression_info = info
+
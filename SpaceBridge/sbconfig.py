@@ -0,0 +1,412 @@
+#
+#  sbconfig.py
+#
+# License: Copyright (c) 2016 Hologram All Rights Reserved.
+#
+# Released under the MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+# Forwards from the command line and from --config files.
+#
+# A forward is a list [link, device port, local port, options]. link is a
+# link id, or a name:/device: spec still to be looked up, and options holds
+# per-forward settings that override the command line ones.
+#
+# A config file is JSON, YAML or TOML, told apart by its extension:
+#
+#   {
+#     "defaults": {"max_channels": 10},
+#     "forwards": [
+#       "1234:22:2222",
+#       "1000-1999:22:20000+",
+#       {"link": "name:pump-7", "device_port": 502, "local_port": 5020,
+#        "idle_timeout": 300},
+#       {"link": 1234, "device_port": "8000-8009", "local_port": 28000},
+#       {"link": 1235, "device_port": 22, "local_port": 2223,
+#        "rate_limit": "64k", "link_rate_limit": "128k"},
+#       {"links": [1234, 1235, 1236], "device_port": 22, "local_port": 20000}
+#     ]
+#   }
+#
+# A device port range or a list of links takes consecutive local ports
+# starting at local_port. The whole file is checked in one pass before
+# anything binds, and every problem found is reported together.
+#
+# Rate limits are in bytes per second, optionally with a k or M suffix.
+# rate_limit caps one forward and link_rate_limit everything to the link,
+# through any forward.
+
+import json
+import math
+import os
+
+from SpaceBridge.sbexceptions import ErrorException
+
+# Prefixes for naming a forward's link by device instead of by link id
+LINK_BY_NAME = 'name:'
+LINK_BY_DEVICE = 'device:'
+
+# Settings a forward may override, and their types
+FORWARD_OPTIONS = {
+    'local_host': str,
+    'min_bufsize': int,
+    'max_bufsize': int,
+    'max_channels': int,
+    'keepalive': int,
+    'idle_timeout': int,
+    'warm_channels': int,
+    'warm_ttl': float,
+    'rate_limit': int,
+    'link_rate_limit': int,
+}
+# Smallest value of each numeric setting. Buffer sizes can't be 0, a warm
+# channel has to live long enough to be handed out, and the others take 0
+# for off or no limit.
+OPTION_MINIMUMS = {
+    'min_bufsize': 1,
+    'max_bufsize': 1,
+    'max_channels': 0,
+    'keepalive': 0,
+    'idle_timeout': 0,
+    'warm_channels': 0,
+    'warm_ttl': 1,
+    'rate_limit': 0,
+    'link_rate_limit': 0,
+}
+# The same for the command line options that only apply globally
+ARGUMENT_MINIMUMS = dict(OPTION_MINIMUMS, max_total_channels=0, max_workers=1,
+                         queue_timeout=0, transports=1, hold_timeout=0,
+                         total_rate_limit=0, cache_ttl=0, metrics_interval=0)
+# Settings given as a rate, like "64k"
+RATE_OPTIONS = set(['rate_limit', 'link_rate_limit'])
+RATE_SUFFIXES = {'k': 1024, 'm': 1024 * 1024}
+FORWARD_KEYS = set(['link', 'links', 'device_port', 'local_port'])
+# Local hosts that listen on every interface
+WILDCARD_HOSTS = ('', '0.0.0.0', '::')
+# Most problems listed when a config file is rejected
+MAX_ERRORS = 20
+
+try:
+    string_types = (str, unicode)
+except NameError:
+    string_types = (str,)
+
+
+def parse_link(link):
+    # Returns a link id, or the name:/device: spec for looking it up later.
+    # Raises ValueError if link is neither.
+    if isinstance(link, int) and not isinstance(link, bool) and link > 0:
+        return link
+    if isinstance(link, string_types):
+        if link.isdigit():
+            return int(link)
+        if link.startswith(LINK_BY_NAME) and len(link) > len(LINK_BY_NAME):
+            return link
+        if link.startswith(LINK_BY_DEVICE) and link[len(LINK_BY_DEVICE):].isdigit():
+            return link
+    raise ValueError('invalid link %r' % (link,))
+
+
+def parse_rate(rate):
+    # "64k", "1.5M" or 4096 -> bytes per second, 0 for no limit
+    if isinstance(rate, int) and not isinstance(rate, bool) and rate >= 0:
+        return rate
+    if isinstance(rate, string_types):
+        value = rate.strip().lower()
+        multiplier = RATE_SUFFIXES.get(value[-1:], 1)
+        if multiplier > 1:
+            value = value[:-1]
+        try:
+            result = float(value) * multiplier
+        except ValueError:
+            pass
+        else:
+            # "inf", "nan" and "1e400" parse as floats but aren't rates
+            if not math.isinf(result) and not math.isnan(result) and result >= 0:
+                return int(result)
+    raise ValueError('invalid rate %r' % (rate,))
+
+
+def parse_port(port):
+    if isinstance(port, string_types) and port.isdigit():
+        port = int(port)
+    if isinstance(port, int) and not isinstance(port, bool) and 0 < port < 65536:
+        return port
+    raise ValueError('invalid port %r' % (port,))
+
+
+def parse_port_range(ports):
+    # "8000-8009" or 8000 -> list of ports
+    if isinstance(ports, string_types) and '-' in ports:
+        first, _, last = ports.partition('-')
+        first, last = parse_port(first), parse_port(last)
+        if last < first:
+            raise ValueError('invalid port range %r' % (ports,))
+        return list(range(first, last + 1))
+    return [parse_port(ports)]
+
+
+def parse_link_range(links):
+    # "1000-1999" -> list of link ids, anything else -> [parse_link(links)]
+    first, sep, last = links.partition('-')
+    if sep and first.isdigit() and last.isdigit():
+        first, last = int(first), int(last)
+        if 0 < first <= last:
+            return list(range(first, last + 1))
+        raise ValueError('invalid link range %r' % (links,))
+    return [parse_link(links)]
+
+
+def parse_forward_string(forward):
+    # <link>:<device port>:<local port>[@<rate limit>], returning a list of
+    # forwards. Device names may contain colons, so split the ports off the
+    # end.
+    #
+    # The link may be a range of link ids (1000-1999) or the device port a
+    # range (8000-8009), but not both. A range maps to consecutive local
+    # ports, written as the first port followed by + (20000+) or as a range
+    # of the same length (20000-20999).
+    splfor = forward.rsplit(":", 2)
+    if len(splfor) != 3:
+        raise ErrorException("forward string formatted wrong [%s]"%forward)
+    options = {}
+    if '@' in splfor[2]:
+        splfor[2], _, rate = splfor[2].partition('@')
+        try:
+            options['rate_limit'] = parse_rate(rate)
+        except ValueError:
+            raise ErrorException("Invalid rate limit in [%s]"%forward)
+    try:
+        links = parse_link_range(splfor[0])
+    except ValueError:
+        raise ErrorException("Invalid linkid in [%s]"%forward)
+    try:
+        device_ports = parse_port_range(splfor[1])
+        local = splfor[2]
+        if local.endswith('+'):
+            first = parse_port(local[:-1])
+            local_ports = list(range(first, first + max(len(links), len(device_ports))))
+        else:
+            local_ports = parse_port_range(local)
+    except ValueError:
+        raise ErrorException("Invalid port numbers in [%s]"%forward)
+    if len(links) > 1 and len(device_ports) > 1:
+        raise ErrorException("Use either a link range or a device port range in [%s]"%
+                forward)
+    count = max(len(links), len(device_ports))
+    if len(local_ports) != count:
+        raise ErrorException(
+                "[%s] needs %d local ports; write the first one followed by +"%
+                (forward, count))
+    if local_ports[-1] > 65535:
+        raise ErrorException("Local ports run past 65535 in [%s]"%forward)
+    if len(links) == 1:
+        links = links * count
+    if len(device_ports) == 1:
+        device_ports = device_ports * count
+    return [[link, device_port, local_port, dict(options)]
+            for link, device_port, local_port in zip(links, device_ports, local_ports)]
+
+
+def parse_options(entry, defaults=None):
+    options = dict(defaults or {})
+    for key, value in entry.items():
+        if key in FORWARD_KEYS:
+            continue
+        if key not in FORWARD_OPTIONS:
+            raise ValueError('unknown setting %r' % key)
+        kind = FORWARD_OPTIONS[key]
+        if key in RATE_OPTIONS:
+            value = parse_rate(value)
+        if kind is float and isinstance(value, int) and not isinstance(value, bool):
+            value = float(value)
+        if kind is str and isinstance(value, string_types):
+            value = str(value)
+        if not isinstance(value, kind) or isinstance(value, bool):
+            raise ValueError('%s must be a %s' % (key, kind.__name__))
+        if key in OPTION_MINIMUMS and value < OPTION_MINIMUMS[key]:
+            raise ValueError('%s must be at least %d' % (key, OPTION_MINIMUMS[key]))
+        options[key] = value
+    if 'min_bufsize' in options and 'max_bufsize' in options and\
+            options['min_bufsize'] > options['max_bufsize']:
+        raise ValueError('min_bufsize cannot be larger than max_bufsize')
+    return options
+
+
+def expand_entry(entry, defaults):
+    # One config entry -> list of forwards
+    if isinstance(entry, string_types):
+        forwards = parse_forward_string(entry)
+        for forward in forwards:
+            forward[3] = dict(defaults, **forward[3])
+        return forwards
+    if not isinstance(entry, dict):
+        raise ValueError('expected a forward string or a table')
+    options = parse_options(entry, defaults)
+    if ('link' in entry) == ('links' in entry):
+        raise ValueError('needs exactly one of link or links')
+    for key in ('device_port', 'local_port'):
+        if key not in entry:
+            raise ValueError('missing %s' % key)
+    if 'links' in entry:
+        if not isinstance(entry['links'], list) or not entry['links']:
+            raise ValueError('links must be a non-empty list')
+        links = [parse_link(link) for link in entry['links']]
+        device_ports = parse_port_range(entry['device_port'])
+        if len(device_ports) != 1:
+            raise ValueError('use either a list of links or a device port range')
+        device_ports = device_ports * len(links)
+    else:
+        device_ports = parse_port_range(entry['device_port'])
+        links = [parse_link(entry['link'])] * len(device_ports)
+    local_port = parse_port(entry['local_port'])
+    if local_port + len(links) - 1 > 65535:
+        raise ValueError('local ports would run past 65535')
+    return [[link, device_port, local_port + i, options]
+            for i, (link, device_port) in enumerate(zip(links, device_ports))]
+
+
+def load_config(path):
+    # Parses a config file into plain data, picking the format from the
+    # file extension. YAML and TOML support need PyYAML and, before Python
+    # 3.11, the toml package.
+    ext = os.path.splitext(path)[1].lower()
+    try:
+        if ext in ('.yaml', '.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise ErrorException('Reading %s needs PyYAML (pip install pyyaml)' % path)
+            loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+            with open(path, 'r') as f:
+                return yaml.load(f, Loader=loader) or {}
+        if ext == '.toml':
+            try:
+                import tomllib
+                with open(path, 'rb') as f:
+                    return tomllib.load(f)
+            except ImportError:
+                pass
+            try:
+                import toml
+            except ImportError:
+                raise ErrorException('Reading %s needs the toml package (pip install toml)' % path)
+            with open(path, 'r') as f:
+                return toml.load(f)
+        with open(path, 'r') as f:
+            return json.load(f)
+    except ErrorException:
+        raise
+    except Exception as e:
+        raise ErrorException('Could not read config file %s: %s' % (path, e))
+
+
+def read_config(path):
+    # Loads a config file and returns its forwards, or raises ErrorException
+    # listing everything wrong with it
+    config = load_config(path)
+    if not isinstance(config, dict):
+        raise ErrorException('%s: expected a table with a forwards list' % path)
+    errors = []
+    try:
+        defaults = parse_options(config.get('defaults') or {})
+    except (ValueError, AttributeError) as e:
+        defaults = {}
+        errors.append('defaults: %s' % e)
+    entries = config.get('forwards')
+    if not isinstance(entries, list):
+        raise ErrorException('%s: expected a forwards list' % path)
+    forwards = []
+    for i, entry in enumerate(entries):
+        try:
+            forwards.extend(expand_entry(entry, defaults))
+        except (ValueError, ErrorException) as e:
+            errors.append('forwards[%d]: %s' % (i, e))
+    if errors:
+        raise_errors(path, errors)
+    return forwards
+
+
+def check_arguments(args):
+    # Rejects command line options below their minimum, all of them together
+    errors = []
+    for key in sorted(ARGUMENT_MINIMUMS):
+        value = getattr(args, key, None)
+        if value is not None and value < ARGUMENT_MINIMUMS[key]:
+            errors.append('--%s must be at least %d' %
+                    (key.replace('_', '-'), ARGUMENT_MINIMUMS[key]))
+    if errors:
+        raise_errors('The command line', errors)
+
+
+def parse_listen_address(value, local_host):
+    # "[host:]port" -> (host, port), as given to --socks
+    host, _, port = value.rpartition(':')
+    try:
+        return (host or local_host, parse_port(port))
+    except ValueError as e:
+        raise ErrorException('Invalid address %s: %s' % (value, e))
+
+
+def check_forwards(forwards, local_host, socks=None):
+    # Rejects forwards that would bind the same local address twice, or the
+    # address of the SOCKS proxy
+    errors = []
+    bound = {}
+    for forward in forwards:
+        address = forward_address(forward, local_host)
+        taken = [other for other in bound.get(address[1], [])
+                 if clashes(address, forward_address(other, local_host))]
+        if socks and clashes(address, socks):
+            errors.append('local port %s:%d is used by both [%s] and the SOCKS proxy' %
+                    (address[0], address[1], describe(forward)))
+        elif taken:
+            errors.append('local port %s:%d is used by both [%s] and [%s]' %
+                    (address[0], address[1], describe(taken[0]), describe(forward)))
+        else:
+            bound.setdefault(address[1], []).append(forward)
+    if errors:
+        raise_errors('forwards', errors)
+
+
+def clashes(address, other):
+    # A listener on all interfaces takes the port on every address
+    if address[1] != other[1]:
+        return False
+    return address[0] == other[0] or address[0] in WILDCARD_HOSTS or\
+        other[0] in WILDCARD_HOSTS
+
+
+def forward_address(forward, local_host):
+    options = forward[3] if len(forward) > 3 else {}
+    return (options.get('local_host', local_host), forward[2])
+
+
+def describe(forward):
+    return '%s:%s:%s' % (forward[0], forward[1], forward[2])
+
+
+def raise_errors(source, errors):
+    shown = errors[:MAX_ERRORS]
+    if len(errors) > MAX_ERRORS:
+        shown.append('... and %d more' % (len(errors) - MAX_ERRORS))
+    raise ErrorException('%s has %d problem(s):\n  %s' %
+            (source, len(errors), '\n  '.join(shown)))
@@ -0,0 +1,74 @@
+#
+#  sbdaemonui.py
+#
+# License: Copyright (c) 2016 Hologram All Rights Reserved.
+#
+# Released under the MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+# UI for running as a service. Nothing can be asked interactively, so
+# anything that would need a prompt has to come from the command line, and
+# messages go to the log instead of the screen.
+
+import logging
+from SpaceBridge.sbexceptions import MissingParamException
+
+class SpaceBridgeDaemonUI:
+    title = "Hologram SpaceBridge"
+    def __init__(self, version):
+        title = self.title + ' v' + version
+        self.title = title
+        self.logger = logging.getLogger('spacebridge')
+
+
+    def prompt_for_apikey(self):
+        raise MissingParamException('--apikey is required with --daemon')
+
+
+    def prompt_for_forwards(self, links):
+        raise MissingParamException('--forward, --config or --socks is required with --daemon')
+
+
+    def prompt_for_orgid(self, orgs):
+        raise MissingParamException('--forward, --config or --socks is required with --daemon')
+
+
+    def prompt_for_keygen(self):
+        raise MissingParamException(
+                'No private key found. Run once without --daemon to generate '
+                'one, or pass --privatekey')
+
+
+    def show_message(self, message):
+        self.logger.info(message)
+
+
+    def show_error_message(self, message):
+        self.logger.error(message)
+
+
+    def show_exception(self):
+        self.logger.exception('Unexpected error')
+
+
+    def tunnel_running(self, fwdmessage):
+        # The daemon main loop keeps the process alive, so don't block here
+        self.logger.info('%s is running\n%s', self.title, fwdmessage)
@@ -33,9 +33,12 @@ sys.modules['tkinter']=None
 import easygui
 from Tkinter import *
 import re
+import threading
+import Queue
 import tkMessageBox
-from sbexceptions import ErrorException, MissingParamException
-import sbutils
+from SpaceBridge.sbexceptions import ErrorException, MissingParamException
+from SpaceBridge import sbutils
+from SpaceBridge import linkindex
 
 
 class SpaceBridgeGUI:
@@ -88,6 +91,9 @@ class SpaceBridgeGUI:
             org_name = sbutils.printable_string(org['name'])
             org_list.append(org_name)
             org_map[org['name']] = org['id']
+        all_orgs = "All organizations"
+        org_list.append(all_orgs)
+        org_map[all_orgs] = sbutils.ALL_ORGS
         res = easygui.choicebox(
                 msg='What organization will you be connecting to?',
                 title=self.title,
@@ -107,12 +113,18 @@ class PortForwardGui:
     port_widgets = []
     tkroot = None
     result = None
+    # How often the window picks up links that finished loading, in ms
+    load_poll_interval = 100
+    # Most matches shown in the device list at once
+    max_matches = 100
     def __init__(self, title):
         self.linkre = re.compile(r' \[link#(\d+) ')
         self.title = title
+        self.index = linkindex.LinkIndex()
+        self.active_row = None
 
 
-    # builds a string to put into the dropdown box
+    # builds a string to put into the device list
     def build_link_string(self, link):
         res = link['devicename']
         res += " [link#%s device#%s]"%(str(link['id']), str(link['deviceid']))
@@ -127,6 +139,20 @@ class PortForwardGui:
         return mo.group(1)
 
 
+    # finds the link for what was typed or picked in a device box
+    def resolve_link(self, devicestring):
+        linkid = self.parse_link_string(devicestring)
+        if linkid is not None and int(linkid) in self.index:
+            return int(linkid)
+        exact = self.index.find_name(devicestring.strip())
+        if len(exact) == 1:
+            return exact[0]['id']
+        matches = self.index.search(devicestring, 2)
+        if len(matches) == 1:
+            return matches[0]['id']
+        return None
+
+
     def button_callback(self):
         self.result = []
         for pw in self.port_widgets:
@@ -138,7 +164,11 @@ class PortForwardGui:
                 if not dp.isdigit() or not lp.isdigit():
                     tkMessageBox.showerror(self.title, "Ports must be a number")
                     return
-                linkid = self.parse_link_string(devicestring)
+                linkid = self.resolve_link(devicestring)
+                if linkid is None:
+                    tkMessageBox.showerror(self.title,
+                            "Pick a single device from the list for \"%s\"" % devicestring)
+                    return
                 forward = [linkid, int(dp), int(lp)]
                 self.result.append(forward)
         self.tkroot.destroy()
@@ -149,10 +179,76 @@ class PortForwardGui:
         return("break")
 
 
-    def prompt_for_forwards(self, links):
-        linkstrings = []
-        for link in links:
-            linkstrings.append(self.build_link_string(link))
+    # Shows the links matching what's typed in the device box being edited
+    def update_matches(self):
+        text = ""
+        if self.active_row is not None:
+            text = self.active_row['mv'].get()
+        self.match_links = self.index.search(text, self.max_matches)
+        self.matches.delete(0, END)
+        for link in self.match_links:
+            self.matches.insert(END, self.build_link_string(link))
+
+
+    def device_focused(self, pw):
+        self.active_row = pw
+        self.update_matches()
+
+
+    def match_picked(self, event):
+        selection = self.matches.curselection()
+        if not selection or self.active_row is None:
+            return
+        link = self.match_links[int(selection[0])]
+        self.active_row['mv'].set(self.build_link_string(link))
+        self.active_row['dp'].focus()
+
+
+    # Loads the remaining pages of links on a background thread. Tk may only
+    # be touched from the main thread, so they are passed over a queue.
+    def load_pages(self, link_pages):
+        try:
+            for links in link_pages:
+                self.loaded.put(links)
+        except Exception as e:
+            self.loaded.put(e)
+        self.loaded.put(None)
+
+
+    # Adds links that finished loading to the index
+    def poll_pages(self):
+        added = False
+        done = False
+        while True:
+            try:
+                item = self.loaded.get_nowait()
+            except Queue.Empty:
+                break
+            if item is None:
+                done = True
+                break
+            if isinstance(item, Exception):
+                done = True
+                tkMessageBox.showerror(self.title,
+                        "Not all links could be loaded: %s" % item)
+                break
+            self.index.add(item)
+            added = True
+        if added:
+            self.update_matches()
+        if done:
+            self.status.config(text="%d devices" % len(self.index))
+        else:
+            self.status.config(text="Loading links... %d so far" % len(self.index))
+            self.tkroot.after(self.load_poll_interval, self.poll_pages)
+
+
+    def prompt_for_forwards(self, link_pages):
+        # Show the window as soon as the first page of links is in and keep
+        # adding the rest to the index as they arrive. Typing in a device box
+        # filters the device list below the form.
+        link_pages = iter(link_pages)
+        self.index.add(next(link_pages, []))
         self.tkroot = Tk()
         self.tkroot.title(self.title)
         self.tkroot.bind_class("Text", "<Tab>", self.focus_next)
@@ -162,6 +258,8 @@ class PortForwardGui:
 
         l1 = Label(frame_top, text="Configure your tunnels")
         l1.pack()
+        self.status = Label(frame_top, text="Loading links...")
+        self.status.pack()
 
         frame2 = Frame(self.tkroot)
         frame2.pack(expand = True)
@@ -177,28 +275,48 @@ class PortForwardGui:
         forwardrow = 1
 
         for i in range(5):
-            port_widgets = self.add_new_forward(
-                    frame_form, linkstrings, forwardrow)
+            port_widgets = self.add_new_forward(frame_form, forwardrow)
             self.port_widgets.append(port_widgets)
             forwardrow += 1
 
+        frame_matches = Frame(frame2)
+        frame_matches.pack(expand = True, fill = BOTH)
+        scrollbar = Scrollbar(frame_matches)
+        scrollbar.pack(side = RIGHT, fill = Y)
+        self.matches = Listbox(frame_matches, height=10, width=50,
+                exportselection=False,
+                yscrollcommand=scrollbar.set)
+        self.matches.pack(side = LEFT, expand = True, fill = BOTH)
+        scrollbar.config(command=self.matches.yview)
+        self.matches.bind("<<ListboxSelect>>", self.match_picked)
+
         frame_bottom = Frame(frame2, pady=20)
         frame_bottom.pack()
         b = Button(frame_bottom, text="Done", command=self.button_callback)
         b.pack()
 
+        self.device_focused(self.port_widgets[0])
+        self.port_widgets[0]['entry'].focus()
+
+        self.loaded = Queue.Queue()
+        loader = threading.Thread(target=self.load_pages, args=(link_pages,))
+        loader.daemon = True
+        loader.start()
+        self.tkroot.after(self.load_poll_interval, self.poll_pages)
+
         self.tkroot.mainloop()
         return self.result
 
 
-    def add_new_forward(self, master, links, forwardrow):
+    def add_new_forward(self, master, forwardrow):
         menuvalue = StringVar(master)
-        lst = OptionMenu(master, menuvalue, *links)
-        lst.config(width=15)
-        lst.grid(row=forwardrow, column=0)
+        device = Entry(master, textvariable=menuvalue, width=30)
+        device.grid(row=forwardrow, column=0)
         dport = Text(master, height=1, width=7)
         dport.grid(row=forwardrow, column=1)
         lport = Text(master, height=1, width=7)
         lport.grid(row=forwardrow, column=2)
-        return {"mv":menuvalue, "dp":dport, "lp":lport}
-
+        pw = {"mv":menuvalue, "entry":device, "dp":dport, "lp":lport}
+        device.bind("<FocusIn>", lambda event: self.device_focused(pw))
+        device.bind("<KeyRelease>", lambda event: self.update_matches())
+        return pw
@@ -0,0 +1,238 @@
+#
+#  sblogging.py
+#
+# License: Copyright (c) 2016 Hologram All Rights Reserved.
+#
+# Released under the MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+# Logging setup. Records are put on a queue by the threads that log them
+# and written out by a single listener thread, so forwarding threads never
+# wait on file or terminal I/O. Messages are only formatted by the
+# listener, and only if a handler takes them. Frequent messages are
+# sampled before they are queued, the log file is rotated by size, and
+# records can be written as JSON lines for log shippers.
+
+import atexit
+import json
+import logging
+import logging.handlers
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+TEXT_FORMAT = '%(asctime)s [%(levelname)s] %(name)s (%(process)d): %(message)s'
+LOG_FORMATS = ['text', 'json']
+# Rotate spacebridge.log at this size, keeping this many old files
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 5
+# Records waiting for the listener; more than this and new ones are dropped
+QUEUE_SIZE = 10000
+# Each message may be logged this many times per interval before the rest
+# are counted and summarized instead. Errors are never sampled.
+SAMPLE_BURST = 20
+SAMPLE_INTERVAL = 10.0
+# Messages are formatted before logging in places, so the sampler forgets
+# old ones once it tracks this many
+SAMPLE_MAX_KEYS = 1000
+
+
+try:
+    QueueHandler = logging.handlers.QueueHandler
+    QueueListener = logging.handlers.QueueListener
+except AttributeError:
+    # Python 2 has neither; these cover what we use of them
+    class QueueHandler (logging.Handler):
+        def __init__(self, queue):
+            logging.Handler.__init__(self)
+            self.queue = queue
+
+        def enqueue(self, record):
+            self.queue.put_nowait(record)
+
+        def prepare(self, record):
+            return record
+
+        def emit(self, record):
+            try:
+                self.enqueue(self.prepare(record))
+            except Exception:
+                self.handleError(record)
+
+    class QueueListener:
+        _sentinel = None
+
+        def __init__(self, queue, *handlers, **kwargs):
+            self.queue = queue
+            self.handlers = handlers
+            self.respect_handler_level = kwargs.get('respect_handler_level', False)
+            self._thread = None
+
+        def start(self):
+            self._thread = threading.Thread(target=self._monitor)
+            self._thread.daemon = True
+            self._thread.start()
+
+        def handle(self, record):
+            for handler in self.handlers:
+                if not self.respect_handler_level or record.levelno >= handler.level:
+                    handler.handle(record)
+
+        def _monitor(self):
+            while True:
+                record = self.queue.get()
+                if record is self._sentinel:
+                    return
+                self.handle(record)
+
+        def stop(self):
+            self.queue.put(self._sentinel)
+            self._thread.join()
+            self._thread = None
+
+
+class AsyncHandler (QueueHandler):
+    # Queues records as they are, with their arguments, so the logging
+    # thread doesn't pay for formatting. Only tracebacks are rendered here,
+    # since they reference frames that won't survive until the listener
+    # gets to them.
+    def __init__(self, queue):
+        QueueHandler.__init__(self, queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Better to lose log lines than to stall a forward
+            self.dropped += 1
+
+
+class SamplingFilter (logging.Filter):
+    # Lets each message template through burst times per interval. Once a
+    # window has passed, the next record of a sampled message is preceded by
+    # a count of the ones that were left out.
+    def __init__(self, burst=SAMPLE_BURST, interval=SAMPLE_INTERVAL,
+                 max_level=logging.WARNING):
+        logging.Filter.__init__(self)
+        self.burst = burst
+        self.interval = interval
+        self.max_level = max_level
+        self.lock = threading.Lock()
+        self.windows = {}
+
+    def filter(self, record):
+        if record.levelno > self.max_level:
+            return True
+        key = (record.name, record.msg)
+        now = time.time()
+        suppressed = 0
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None and len(self.windows) >= SAMPLE_MAX_KEYS:
+                self.prune(now)
+            if window is None or now - window[0] >= self.interval:
+                if window is not None:
+                    suppressed = window[2]
+                window = [now, 0, 0]
+                self.windows[key] = window
+            if window[1] >= self.burst:
+                window[2] += 1
+                return False
+            window[1] += 1
+        if suppressed:
+            logging.getLogger(record.name).log(record.levelno,
+                    'Suppressed %d more like: %s', suppressed, record.msg)
+        return True
+
+    def prune(self, now):
+        # (Called with the lock held.)
+        for key, window in list(self.windows.items()):
+            if now - window[0] >= self.interval:
+                del self.windows[key]
+
+
+class JSONFormatter (logging.Formatter):
+    # One JSON object per line. Values passed as extra={'fields': {...}}
+    # become keys of their own.
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) +
+                    '.%03dZ' % record.msecs,
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+def make_formatter(log_format):
+    if log_format == 'json':
+        return JSONFormatter()
+    return logging.Formatter(TEXT_FORMAT)
+
+
+def setup_logging(logfile, stderr_level=logging.WARNING, file_level=logging.INFO,
+                  log_format='text', max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS,
+                  sample_burst=SAMPLE_BURST, sample_interval=SAMPLE_INTERVAL):
+    # Point the root logger at a queue and start the thread that writes the
+    # queued records to stderr and the log file. The listener is flushed
+    # and stopped when the interpreter exits.
+    stderr_handler = logging.StreamHandler()
+    stderr_handler.setLevel(stderr_level)
+
+    file_handler = logging.handlers.RotatingFileHandler(logfile,
+            maxBytes=max_bytes, backupCount=backups)
+    file_handler.setLevel(file_level)
+    file_handler.setFormatter(make_formatter(log_format))
+
+    records = queue.Queue(QUEUE_SIZE)
+    handler = AsyncHandler(records)
+    # Nothing below the lowest handler level needs to cross the queue
+    handler.setLevel(min(stderr_level, file_level))
+    if sample_burst:
+        handler.addFilter(SamplingFilter(sample_burst, sample_interval))
+    logging.getLogger('').addHandler(handler)
+
+    listener = QueueListener(records, stderr_handler, file_handler,
+                             respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,389 @@
+#
+#  sbmetrics.py
+#
+# License: Copyright (c) 2016 Hologram All Rights Reserved.
+#
+# Released under the MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+# Connection metrics for every forward and every link: active channels,
+# bytes each way, how long open_channel took, how long channels lived, and
+# how many connections failed or were rejected. Both forwarding engines
+# and the SOCKS proxy report here. Pools that keep counters of their own
+# register them to be exported alongside. The numbers can be scraped from
+# a local HTTP endpoint in the Prometheus text format and are logged as a
+# periodic summary.
+
+import bisect
+import logging
+import threading
+import time
+
+try:
+    import BaseHTTPServer
+except ImportError:
+    import http.server as BaseHTTPServer
+
+# Histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LIFETIME_BUCKETS = (1, 10, 60, 300, 1800, 3600, 21600, 86400)
+# Seconds between summary log lines
+SUMMARY_INTERVAL = 300
+# Links listed in the summary, slowest to open first
+SUMMARY_SLOW_LINKS = 5
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation, which is
+        # as close as fixed buckets get
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+
+class ChannelStats:
+    # Everything counted for one forward or one link
+    def __init__(self):
+        self.active = 0
+        self.opened = 0
+        self.failed = 0
+        self.rejected = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.open_latency = Histogram(LATENCY_BUCKETS)
+        self.lifetime = Histogram(LIFETIME_BUCKETS)
+
+
+class Channel:
+    # Handed to the relay of one open channel to report its traffic. Bytes
+    # out go from the local client to the device, bytes in come back.
+    def __init__(self, metrics, stats):
+        self.metrics = metrics
+        self.stats = stats
+        self.started = time.time()
+        self.closed = False
+
+    def transferred(self, bytes_out, bytes_in):
+        with self.metrics.lock:
+            for stats in self.stats:
+                stats.bytes_out += bytes_out
+                stats.bytes_in += bytes_in
+
+    def close(self):
+        lifetime = time.time() - self.started
+        with self.metrics.lock:
+            if self.closed:
+                return
+            self.closed = True
+            for stats in self.stats:
+                stats.active -= 1
+                stats.lifetime.observe(lifetime)
+
+
+class Source:
+    # Counters something keeps for itself, read whenever metrics are
+    # rendered. stats() returns a dict and fields lists the entries to
+    # export as (key, metric name, type, help text), with an optional label
+    # name for list values, which become one sample per index.
+    def __init__(self, name, stats, fields, labels):
+        self.name = name
+        self.stats = stats
+        self.fields = fields
+        self.labels = labels
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.forwards = {}
+        self.links = {}
+        self.sources = []
+        self.started = time.time()
+
+    def register(self, name, stats, fields, labels=None):
+        # Exports stats() as spacebridge_<name>_<metric name>, with labels
+        # telling apart several sources of the same name
+        source = Source(name, stats, fields, labels or {})
+        with self.lock:
+            self.sources.append(source)
+        return source
+
+    def unregister(self, source):
+        with self.lock:
+            if source in self.sources:
+                self.sources.remove(source)
+
+    def read_sources(self):
+        # Sources are read without holding the lock, since they take locks
+        # of their own that may be held while reporting here
+        with self.lock:
+            sources = list(self.sources)
+        return [(source, source.stats()) for source in sources]
+
+    def get_stats(self, forward, link):
+        # (Called with the lock held.)
+        stats = []
+        for table, name in ((self.forwards, forward), (self.links, link)):
+            if name is None:
+                continue
+            if name not in table:
+                table[name] = ChannelStats()
+            stats.append(table[name])
+        return stats
+
+    def rejected(self, forward, link=None):
+        with self.lock:
+            for stats in self.get_stats(forward, link):
+                stats.rejected += 1
+
+    def open_failed(self, forward, link, latency):
+        with self.lock:
+            for stats in self.get_stats(forward, link):
+                stats.failed += 1
+                stats.open_latency.observe(latency)
+
+    def opened(self, forward, link, latency):
+        with self.lock:
+            stats = self.get_stats(forward, link)
+            for s in stats:
+                s.active += 1
+                s.opened += 1
+                s.open_latency.observe(latency)
+        return Channel(self, stats)
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        sources = self.read_sources()
+        seen = set()
+        for source, _ in sources:
+            if source.name in seen:
+                continue
+            seen.add(source.name)
+            for field in source.fields:
+                key, name, kind, help_text = field[:4]
+                name = 'spacebridge_%s_%s' % (source.name, name)
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for other, stats in sources:
+                    if other.name != source.name:
+                        continue
+                    values = stats[key]
+                    if not isinstance(values, list):
+                        lines.append('%s%s %s' % (name, format_labels(other.labels),
+                                                  format_value(values)))
+                        continue
+                    for index, value in enumerate(values):
+                        labels = dict(other.labels)
+                        labels[field[4]] = index
+                        lines.append('%s%s %s' % (name, format_labels(labels),
+                                                  format_value(value)))
+        with self.lock:
+            for kind, table in (('forward', self.forwards), ('link', self.links)):
+                prefix = 'spacebridge_%s_' % kind
+                rows = sorted(table.items())
+                for name, kind_, help_text, value in (
+                        ('active_channels', 'gauge', 'Channels open right now',
+                         lambda s: s.active),
+                        ('channels_opened_total', 'counter', 'Channels opened',
+                         lambda s: s.opened),
+                        ('channel_failures_total', 'counter',
+                         'Channels the tunnel server failed or refused to open',
+                         lambda s: s.failed),
+                        ('rejected_total', 'counter',
+                         'Connections refused before opening a channel',
+                         lambda s: s.rejected),
+                        ('bytes_out_total', 'counter', 'Bytes sent to the device',
+                         lambda s: s.bytes_out),
+                        ('bytes_in_total', 'counter', 'Bytes received from the device',
+                         lambda s: s.bytes_in)):
+                    lines.append('# HELP %s%s %s' % (prefix, name, help_text))
+                    lines.append('# TYPE %s%s %s' % (prefix, name, kind_))
+                    for label, stats in rows:
+                        lines.append('%s%s{%s="%s"} %d' % (prefix, name, kind,
+                                escape_label(label), value(stats)))
+                for name, help_text, histogram in (
+                        ('open_seconds', 'Time taken to open a channel',
+                         lambda s: s.open_latency),
+                        ('channel_lifetime_seconds', 'How long closed channels stayed open',
+                         lambda s: s.lifetime)):
+                    lines.append('# HELP %s%s %s' % (prefix, name, help_text))
+                    lines.append('# TYPE %s%s histogram' % (prefix, name))
+                    for label, stats in rows:
+                        label = '%s="%s"' % (kind, escape_label(label))
+                        h = histogram(stats)
+                        for bound, count in h.cumulative():
+                            lines.append('%s%s_bucket{%s,le="%s"} %d' % (prefix, name,
+                                    label, format_bound(bound), count))
+                        lines.append('%s%s_sum{%s} %.6f' % (prefix, name, label, h.sum))
+                        lines.append('%s%s_count{%s} %d' % (prefix, name, label, h.count))
+            lines.append('# HELP spacebridge_uptime_seconds Seconds since SpaceBridge started')
+            lines.append('# TYPE spacebridge_uptime_seconds gauge')
+            lines.append('spacebridge_uptime_seconds %.0f' % (time.time() - self.started))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        # Log lines: one per forward, then the links slowest to open, then
+        # one per registered source
+        lines = []
+        sources = self.read_sources()
+        with self.lock:
+            for name, s in sorted(self.forwards.items()):
+                lines.append('%s: %d active, %d opened, %d failed, %d rejected, '
+                        '%s out, %s in, open p50 %s p99 %s' %
+                        (name, s.active, s.opened, s.failed, s.rejected,
+                         format_bytes(s.bytes_out), format_bytes(s.bytes_in),
+                         format_latency(s.open_latency.quantile(0.5)),
+                         format_latency(s.open_latency.quantile(0.99))))
+            slow = sorted((s.open_latency.quantile(0.99), name)
+                          for name, s in self.links.items() if s.open_latency.count)
+            for p99, name in reversed(slow[-SUMMARY_SLOW_LINKS:]):
+                s = self.links[name]
+                lines.append('%s: open p99 %s, %d attempts, %d failed' %
+                        (name, format_latency(p99), s.open_latency.count, s.failed))
+        for source, stats in sources:
+            title = ' '.join([source.name.replace('_', ' ')] +
+                             [str(value) for _, value in sorted(source.labels.items())])
+            values = []
+            for field in source.fields:
+                value = stats[field[0]]
+                if isinstance(value, list):
+                    value = '/'.join(format_value(v) for v in value)
+                else:
+                    value = format_value(value)
+                values.append('%s %s' % (field[0].replace('_', ' '), value))
+            lines.append('%s: %s' % (title, ', '.join(values)))
+        return lines
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape_label(value))
+                             for name, value in sorted(labels.items()))
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return '%g' % value
+    return '%d' % value
+
+
+def format_bound(bound):
+    if bound == float('inf'):
+        return '+Inf'
+    return repr(float(bound))
+
+
+def format_latency(seconds):
+    if seconds == float('inf'):
+        return 'over %gs' % LATENCY_BUCKETS[-1]
+    return '%dms' % (seconds * 1000)
+
+
+def format_bytes(count):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if count < 1024:
+            return '%d%s' % (count, unit)
+        count //= 1024
+    return '%dTB' % count
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics()
+        return _metrics
+
+
+class MetricsHandler (BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = get_metrics().render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would flood stderr otherwise
+        pass
+
+
+def serve_metrics(host, port):
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+    server_thread = threading.Thread(target=server.serve_forever,
+                                     name='metrics-server')
+    server_thread.daemon = True
+    server_thread.start()
+    return server
+
+
+def log_summaries(interval=SUMMARY_INTERVAL):
+    logger = logging.getLogger('spacebridge.metrics')
+
+    def run():
+        while True:
+            time.sleep(interval)
+            for line in get_metrics().summary():
+                logger.info(line)
+
+    summary_thread = threading.Thread(target=run, name='metrics-summary')
+    summary_thread.daemon = True
+    summary_thread.start()
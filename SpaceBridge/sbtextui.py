@@ -25,11 +25,15 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from sbexceptions import ErrorException, MissingParamException
+from SpaceBridge.sbexceptions import ErrorException, MissingParamException
+from SpaceBridge import linkindex
+from SpaceBridge import sbutils
 import sys
 
 class SpaceBridgeTextUI:
     title = "Hologram SpaceBridge"
+    # Most links listed at once; beyond this the user searches by name
+    list_limit = 50
     def __init__(self, version):
         title = self.title + ' v' + version
         self.title = title
@@ -39,30 +43,48 @@ class SpaceBridgeTextUI:
         return raw_input("Please enter your Hologram API key: ")
 
 
-    def prompt_for_forwards(self, links):
+    def print_link(self, link):
+        print("  ID#%s - %s (Device ID#%s)"%(str(link['id']), link['devicename'],
+            str(link['deviceid'])))
+
+
+    def prompt_for_forwards(self, link_pages):
+        # link_pages yields lists of links as they load; print each page as
+        # soon as it arrives rather than waiting for all of them. Large
+        # fleets are searched by name instead of listed in full.
         print("Links with tunneling enabled:")
         result = []
-        if not links:
+        index = linkindex.LinkIndex()
+        for links in link_pages:
+            for link in links[:max(0, self.list_limit - len(index))]:
+                self.print_link(link)
+            index.add(links)
+        if not len(index):
             print("  [NONE]")
         else:
-            linkids = []
-            for link in links:
-                linkids.append(link['id'])
-                print("  ID#%s - %s (Device ID#%s)"%(str(link['id']), link['devicename'],
-                    str(link['deviceid'])))
+            if len(index) > self.list_limit:
+                print("  ... and %d more. Type part of a device name to search."%
+                        (len(index) - self.list_limit))
             linkid = 0
             device_port = 0
             local_port = 0
             while True:
-                linkid = raw_input("Enter link ID to forward: ")
+                linkid = raw_input("Enter link ID to forward (or search for a device): ")
+                if not linkid.isdigit() or int(linkid) not in index:
+                    matches = index.find_name(linkid.strip())
+                    if len(matches) != 1:
+                        matches = index.search(linkid, self.list_limit)
+                    if len(matches) == 1:
+                        linkid = str(matches[0]['id'])
+                    else:
+                        if not matches:
+                            print("Error: Invalid linkid")
+                        for link in matches:
+                            self.print_link(link)
+                        continue
+                linkid = int(linkid)
                 device_port = raw_input("Enter device port: ")
                 local_port = raw_input("Enter local port: ")
-                if not linkid.isdigit():
-                    print("Error: Invalid linkid")
-                linkid = int(linkid)
-                if linkid not in linkids:
-                    print("Error: Invalid linkid")
-                    continue
                 if not device_port.isdigit():
                     print("Error: Invalid device port")
                     continue
@@ -87,7 +109,11 @@ class SpaceBridgeTextUI:
                 print("  ID#%d - %s"%(org['id'], org['name']))
             while True:
                 orgid = raw_input(
-                        "Choose the organization id to search for the device: ")
+                        "Choose the organization id to search for the device "
+                        "(or \"%s\" to search all of them): " % sbutils.ALL_ORGS)
+                if orgid.strip().lower() == sbutils.ALL_ORGS:
+                    orgid = sbutils.ALL_ORGS
+                    break
                 if not orgid.isdigit():
                     print("Error: Invalid organization id")
                     continue
@@ -25,6 +25,16 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# Returned by the UIs' prompt_for_orgid to search every organization at once
+ALL_ORGS = 'all'
+
 
 def printable_string(input_string):
     """ Return a string (unicode or ascii) that is safe to use with print() or str()
@@ -47,3 +57,48 @@ def printable_string(input_string):
         output_string = input_string.encode('utf8', 'replace')
     return output_string
 
+
+def parallel_map(func, items, max_workers):
+    """ Call func on every item using a bounded pool of threads
+
+    Results are yielded as soon as each call finishes, so their order does
+    not follow items. If a call raises, the exception is raised from the
+    generator once it gets to that result; calls already running are left
+    to finish in the background.
+
+    Args:
+        func (callable): Function taking one item
+        items (iterable): Items to call func on
+        max_workers (int): Most calls to run at the same time
+
+    Yields:
+        tuple: (item, result of func(item))
+
+    """
+    items = list(items)
+    todo = queue.Queue()
+    for item in items:
+        todo.put(item)
+    done = queue.Queue()
+
+    def worker():
+        while True:
+            try:
+                item = todo.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                done.put((item, func(item), None))
+            except Exception as e:
+                done.put((item, None, e))
+
+    for _ in range(min(max_workers, len(items))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+
+    for _ in range(len(items)):
+        item, result, error = done.get()
+        if error is not None:
+            raise error
+        yield item, result
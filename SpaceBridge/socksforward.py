@@ -0,0 +1,298 @@
+#
+#  socksforward.py
+#
+# License: Copyright (c) 2016 Hologram All Rights Reserved.
+#
+# Released under the MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+# Dynamic forwarding, like ssh -D. A single local SOCKS5 listener opens a
+# direct-tcpip channel to whatever link and port each client asks for, so
+# any device can be reached without setting up a forward for it first.
+# Clients name the device by hostname, e.g. link1234:22; with curl that is
+#
+#     curl --socks5-hostname localhost:1080 http://link1234:80/
+#
+# The handshake is read on a few threads of the proxy's own. After that,
+# connections share the threaded engine's worker pool, channel limits and
+# relay poller with the regular forwards.
+
+import collections
+import logging
+import re
+import socket
+import struct
+import threading
+import time
+
+from SpaceBridge import portforward
+from SpaceBridge.sbmetrics import get_metrics
+from SpaceBridge.ratelimit import Limit
+
+SOCKS_VERSION = 5
+AUTH_NONE = 0
+AUTH_UNACCEPTABLE = 0xff
+CMD_CONNECT = 1
+ATYP_IPV4 = 1
+ATYP_DOMAIN = 3
+ATYP_IPV6 = 4
+
+REPLY_SUCCEEDED = 0
+REPLY_FAILURE = 1
+REPLY_NOT_ALLOWED = 2
+REPLY_HOST_UNREACHABLE = 4
+REPLY_REFUSED = 5
+REPLY_COMMAND_NOT_SUPPORTED = 7
+REPLY_ADDRESS_NOT_SUPPORTED = 8
+
+# How long a client gets to finish the SOCKS handshake, in seconds
+HANDSHAKE_TIMEOUT = 10.0
+# Threads reading handshakes, and most clients waiting for one
+MAX_HANDSHAKE_WORKERS = 8
+MAX_HANDSHAKE_QUEUE = 256
+
+LINK_HOST = re.compile(r'^link\d+$')
+
+
+class SocksError(Exception):
+    def __init__(self, message, reply=None):
+        Exception.__init__(self, message)
+        self.reply = reply
+
+
+def recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise SocksError('client closed the connection during the handshake')
+        data += chunk
+    return data
+
+
+def parse_link_host(host):
+    # Only link hosts are accepted; the tunnel server can't reach anything
+    # else and an open proxy on the loopback interface shouldn't pretend to
+    host = host.lower()
+    if LINK_HOST.match(host):
+        return host
+    return None
+
+
+def negotiate(sock):
+    # Reads the greeting and CONNECT request, returning the (link host,
+    # port) asked for. Raises SocksError if the request can't be served.
+    version, nmethods = recv_exact(sock, 2)
+    if version != SOCKS_VERSION:
+        raise SocksError('unsupported SOCKS version %d' % version)
+    methods = recv_exact(sock, nmethods)
+    if AUTH_NONE not in methods:
+        sock.sendall(struct.pack('!BB', SOCKS_VERSION, AUTH_UNACCEPTABLE))
+        raise SocksError('client requires authentication')
+    sock.sendall(struct.pack('!BB', SOCKS_VERSION, AUTH_NONE))
+
+    version, command, _, atyp = recv_exact(sock, 4)
+    if atyp == ATYP_DOMAIN:
+        length = recv_exact(sock, 1)[0]
+        host = bytes(recv_exact(sock, length)).decode('ascii', 'replace')
+    elif atyp == ATYP_IPV4:
+        host = socket.inet_ntoa(bytes(recv_exact(sock, 4)))
+    elif atyp == ATYP_IPV6:
+        recv_exact(sock, 16)
+        host = 'an IPv6 address'
+    else:
+        raise SocksError('unknown address type %d' % atyp,
+                         REPLY_ADDRESS_NOT_SUPPORTED)
+    port = struct.unpack('!H', bytes(recv_exact(sock, 2)))[0]
+    if command != CMD_CONNECT:
+        raise SocksError('unsupported command %d' % command,
+                         REPLY_COMMAND_NOT_SUPPORTED)
+    chain_host = parse_link_host(host)
+    if chain_host is None:
+        raise SocksError('%s is not a link; connect to linkNNN:port' % host,
+                         REPLY_NOT_ALLOWED)
+    return chain_host, port
+
+
+def send_reply(sock, code):
+    # The bound address means nothing across the tunnel, so send zeros
+    try:
+        sock.sendall(struct.pack('!BBBB4sH', SOCKS_VERSION, code, 0,
+                                 ATYP_IPV4, b'\0' * 4, 0))
+    except socket.error:
+        pass
+
+
+class HandshakePool:
+    # A few threads of their own read SOCKS handshakes, so a client only
+    # queues for a forward worker and a channel slot once it has said where
+    # it wants to go. Slow or silent clients can't hold up the regular
+    # forwards that way. Clients that arrive while the queue is full are
+    # closed, as are ones that haven't finished HANDSHAKE_TIMEOUT seconds
+    # after they were accepted.
+
+    def __init__(self, max_workers=MAX_HANDSHAKE_WORKERS,
+                 max_queue=MAX_HANDSHAKE_QUEUE):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+        self.workers = 0
+        self.idle = 0
+
+    def submit(self, server, request, client_address):
+        with self.cond:
+            full = len(self.queue) >= self.max_queue
+            if not full:
+                self.queue.append((time.time() + HANDSHAKE_TIMEOUT, server, request,
+                                   client_address))
+                if self.idle == 0 and self.workers < self.max_workers:
+                    self.workers += 1
+                    worker = threading.Thread(target=self.work,
+                                              name='socks-handshake')
+                    worker.daemon = True
+                    worker.start()
+                self.cond.notify()
+        if full:
+            server.reject_request(request, client_address, 'handshake queue full')
+
+    def work(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.idle += 1
+                    self.cond.wait()
+                    self.idle -= 1
+                deadline, server, request, client_address = self.queue.popleft()
+            server.handshake(request, client_address, deadline)
+
+
+_handshake_pool = None
+_handshake_pool_lock = threading.Lock()
+
+
+def get_handshake_pool():
+    global _handshake_pool
+    with _handshake_pool_lock:
+        if _handshake_pool is None:
+            _handshake_pool = HandshakePool()
+        return _handshake_pool
+
+
+class SocksHandler (portforward.Handler):
+    chain_host = None
+    chain_port = None
+
+    def destination(self):
+        return self.server.pop_destination(self.request)
+
+    def channel_failed(self, rejected):
+        if rejected:
+            send_reply(self.request, REPLY_REFUSED)
+        else:
+            send_reply(self.request, REPLY_HOST_UNREACHABLE)
+
+    def channel_opened(self, chan):
+        send_reply(self.request, REPLY_SUCCEEDED)
+
+
+class SocksServer (portforward.ForwardServer):
+    # Accepted connections go to the handshake pool first, and from there
+    # to the forward pool with the destination they asked for
+
+    def __init__(self, server_address, RequestHandlerClass):
+        portforward.ForwardServer.__init__(self, server_address,
+                                           RequestHandlerClass)
+        self.handshakes = get_handshake_pool()
+        self.destinations = {}
+        self.lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        self.handshakes.submit(self, request, client_address)
+
+    def handshake(self, request, client_address, deadline):
+        # Runs on a handshake thread
+        handler = self.RequestHandlerClass
+        logger = logging.getLogger('forwardhandler')
+        try:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                raise socket.timeout('waited too long for a handshake thread')
+            request.settimeout(timeout)
+            destination = negotiate(request)
+            request.settimeout(None)
+        except SocksError as e:
+            logger.warning('SOCKS request from %r refused: %s', client_address, e,
+                    extra={'fields': {'event': 'rejected', 'forward': handler.metrics_name,
+                                      'reason': str(e)}})
+            get_metrics().rejected(handler.metrics_name)
+            if e.reply is not None:
+                send_reply(request, e.reply)
+            self.shutdown_request(request)
+            return
+        except (socket.error, socket.timeout) as e:
+            logger.warning('SOCKS handshake with %r failed: %r', client_address, e)
+            self.shutdown_request(request)
+            return
+        with self.lock:
+            self.destinations[request] = destination
+        self.pool.submit(self, request, client_address)
+
+    def pop_destination(self, request):
+        with self.lock:
+            return self.destinations.pop(request, None)
+
+    def reject_request(self, request, client_address, reason):
+        # A client turned away after its handshake is waiting for a reply
+        if self.pop_destination(request) is not None:
+            send_reply(request, REPLY_REFUSED)
+        portforward.ForwardServer.reject_request(self, request, client_address, reason)
+
+    def shutdown_request(self, request):
+        self.pop_destination(request)
+        portforward.ForwardServer.shutdown_request(self, request)
+
+    def describe(self):
+        return 'the SOCKS proxy'
+
+
+def socks_tunnel(local_host, local_port, transport,
+                 min_bufsize=portforward.MIN_BUFSIZE,
+                 max_bufsize=portforward.MAX_BUFSIZE, max_channels=0,
+                 keepalive=0, idle_timeout=0, rate_limit=0):
+    class SubHandler (SocksHandler):
+        ssh_transport = transport
+    SubHandler.min_bufsize = min_bufsize
+    SubHandler.max_bufsize = max_bufsize
+    SubHandler.keepalive = keepalive
+    SubHandler.idle_timeout = idle_timeout
+    SubHandler.metrics_name = '%s:%d' % (local_host, local_port)
+    if rate_limit:
+        # All connections through the proxy share one limit
+        SubHandler.rate_limit = Limit(rate_limit)
+    server = SocksServer((local_host, local_port), SubHandler)
+    server.max_channels = max_channels
+    portforward.start_listener(server)
+    return server
+
+
+def close_tunnel(server):
+    portforward.close_tunnel(server)
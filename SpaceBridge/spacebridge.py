@@ -32,23 +32,46 @@ local port forwarding (analogous to OpenSSH's "-L" option) from a
 local port through the SpaceBridge server.
 """
 
-import getpass
+import itertools
 import os
+import signal
+import socket
 import sys
+import time
 import argparse
 import paramiko
 import logging
 from SpaceBridge.sbexceptions import MissingParamException, ErrorException, UpdaterException
-import sbgui
-import sbtextui
 import requests
 #pylint: disable=no-member
 requests.packages.urllib3.disable_warnings()
 #pylint: enable=no-member
-import portforward
+from SpaceBridge import portforward
+from SpaceBridge import transportpool
+from SpaceBridge import socksforward
+from SpaceBridge import sbapi
+from SpaceBridge import sbcache
+from SpaceBridge import sbutils
+from SpaceBridge import linkindex
+from SpaceBridge import sbconfig
+from SpaceBridge import channelpool
+from SpaceBridge import sblogging
+from SpaceBridge import sbcompress
+from SpaceBridge import sbmetrics
+from SpaceBridge import ratelimit
 
 
 DEFAULT_LOCAL_HOST = '127.0.0.1'
+DEFAULT_ENGINE = 'thread'
+# Seconds between keepalives. Cellular carriers expire idle NAT mappings
+# after as little as a minute or two.
+DEFAULT_KEEPALIVE = 30
+# Forwards listed when the tunnel starts; the rest are only logged
+MAX_FORWARD_MESSAGES = 20
+# File descriptors to allow for on top of one listener per forward
+FD_HEADROOM = 4096
+# How often the daemon main loop wakes up to act on signals, in seconds
+DAEMON_POLL_INTERVAL = 1.0
 
 
 class AllowHologramPolicy(paramiko.MissingHostKeyPolicy):
@@ -68,12 +91,45 @@ class SpaceBridge:
     tunnel_port = 999
     stderr_log_level = logging.WARNING
     forwards = []
+    socks = None
+    metrics_address = None
+    metrics_interval = sbmetrics.SUMMARY_INTERVAL
+    daemon = False
     local_host = DEFAULT_LOCAL_HOST
+    engine = DEFAULT_ENGINE
+    min_bufsize = portforward.MIN_BUFSIZE
+    max_bufsize = portforward.MAX_BUFSIZE
+    max_channels = 0
+    max_total_channels = portforward.MAX_TOTAL_CHANNELS
+    max_workers = portforward.MAX_WORKERS
+    queue_timeout = portforward.QUEUE_TIMEOUT
+    transport_count = 1
+    transport_balance = transportpool.LEAST_LOADED
+    hold_timeout = transportpool.HOLD_TIMEOUT
+    keepalive = DEFAULT_KEEPALIVE
+    idle_timeout = 0
+    warm_channels = 0
+    warm_ttl = channelpool.WARM_TTL
+    rate_limit = 0
+    link_rate_limit = 0
+    total_rate_limit = 0
+    compress_level = 0
+    cache_ttl = sbcache.CACHE_TTL
+    refresh = False
+    discovery_workers = sbapi.API_POOL_SIZE
 
     def __init__(self, version, args):
-        if args.text_mode:
+        self.version = version
+        # Only import the UI in use so headless runs never load Tkinter
+        if args.daemon:
+            from SpaceBridge import sbdaemonui
+            self.ui = sbdaemonui.SpaceBridgeDaemonUI(version)
+            self.daemon = True
+        elif args.text_mode:
+            from SpaceBridge import sbtextui
             self.ui = sbtextui.SpaceBridgeTextUI(version)
         else:
+            from SpaceBridge import sbgui
             self.ui = sbgui.SpaceBridgeGUI(version)
 
         if args.verbose:
@@ -88,29 +144,22 @@ class SpaceBridge:
         self.publickey = ''
 
         logfile = self.settings_dir + os.path.sep + 'spacebridge.log'
-        rootlogger = logging.getLogger('')
         self.logger = logging.getLogger('spacebridge')
         self.logger.setLevel(logging.DEBUG)
+        if self.verbose:
+            # Log every tunnel opening and closing
+            logging.getLogger('forwardhandler').setLevel(self.log_level)
+        sblogging.setup_logging(logfile, self.stderr_log_level,
+                log_format=args.log_format, max_bytes=args.log_max_bytes,
+                sample_burst=args.log_sample)
 
-        sh = logging.StreamHandler()
-        sh.setLevel(self.stderr_log_level)
-        rootlogger.addHandler(sh)
-
-        fh = logging.FileHandler(logfile)
-        fh.setLevel(logging.INFO)
-        fmt = logging.Formatter(
-                '%(asctime)s [%(levelname)s] %(name)s (%(process)d): %(message)s')
-        fh.setFormatter(fmt)
-        rootlogger.addHandler(fh)
-
-        self.client = paramiko.SSHClient()
-        self.client.load_system_host_keys()
         if args.no_fingerprint:
-            self.client.set_missing_host_key_policy(paramiko.client.AutoAddPolicy())
+            self.host_key_policy = paramiko.client.AutoAddPolicy()
         else:
-            self.client.set_missing_host_key_policy(AllowHologramPolicy())
+            self.host_key_policy = AllowHologramPolicy()
 
     def collect_user_prefs(self, args):
+        sbconfig.check_arguments(args)
         if args.apibase:
             self.apibase = args.apibase
 
@@ -122,6 +171,12 @@ class SpaceBridge:
                 sys.exit(0)
             elif self.apikey == "":
                 raise MissingParamException('Missing APIKey')
+        self.api = sbapi.DashboardAPI(self.apibase, self.apikey)
+        if args.cache_ttl is not None:
+            self.cache_ttl = args.cache_ttl
+        self.refresh = args.refresh
+        self.cache = sbcache.APICache(self.settings_dir,
+                self.apibase + self.apikey, self.cache_ttl)
 
         if args.publickey:
             self.publickey = args.publickey
@@ -134,25 +189,91 @@ class SpaceBridge:
             self.tunnel_port = args.tunnel_port
         if args.local_host:
             self.local_host = args.local_host
+        if args.engine:
+            self.engine = args.engine
+        if args.min_bufsize:
+            self.min_bufsize = args.min_bufsize
+        if args.max_bufsize:
+            self.max_bufsize = args.max_bufsize
+        if self.min_bufsize > self.max_bufsize:
+            raise ErrorException('--min-bufsize cannot be larger than --max-bufsize')
+        if args.max_channels is not None:
+            self.max_channels = args.max_channels
+        if args.max_total_channels is not None:
+            self.max_total_channels = args.max_total_channels
+        if args.max_workers:
+            self.max_workers = args.max_workers
+        if args.queue_timeout is not None:
+            self.queue_timeout = args.queue_timeout
+        if args.transports:
+            self.transport_count = args.transports
+        if args.transport_balance:
+            self.transport_balance = args.transport_balance
+        if args.hold_timeout is not None:
+            self.hold_timeout = args.hold_timeout
+        if args.keepalive is not None:
+            self.keepalive = args.keepalive
+        if args.idle_timeout is not None:
+            self.idle_timeout = args.idle_timeout
+        if args.warm_channels is not None:
+            self.warm_channels = args.warm_channels
+        if args.warm_ttl is not None:
+            self.warm_ttl = args.warm_ttl
+        if args.rate_limit is not None:
+            self.rate_limit = args.rate_limit
+        if args.link_rate_limit is not None:
+            self.link_rate_limit = args.link_rate_limit
+        if args.total_rate_limit is not None:
+            self.total_rate_limit = args.total_rate_limit
+        if args.compress is not None:
+            if not 0 <= args.compress <= 9:
+                raise ErrorException('--compress takes a zlib level from 1 to 9, or 0 for none')
+            self.compress_level = args.compress
+        if args.socks:
+            self.socks = sbconfig.parse_listen_address(args.socks, self.local_host)
+        if args.metrics_port:
+            self.metrics_address = sbconfig.parse_listen_address(args.metrics_port,
+                                                                 self.local_host)
+        if args.metrics_interval is not None:
+            self.metrics_interval = args.metrics_interval
 
     def collect_forwards(self, args):
-        if args.forwards:
-            self.parse_forwards(args.forwards)
+        if args.forwards or args.config:
+            forwards = []
+            if args.config:
+                forwards += sbconfig.read_config(args.config)
+            for forward in args.forwards or []:
+                forwards.extend(sbconfig.parse_forward_string(forward))
+            sbconfig.check_forwards(forwards, self.local_host, self.socks)
+            self.resolve_forwards(forwards)
+            self.forwards = forwards
+        elif self.socks:
+            # Devices are picked per connection through the SOCKS proxy
+            self.forwards = []
         else:
             user = self.load_user_info()
             orgs = self.load_orgs(user['id'])
-            if len(orgs) > 1:
+            if args.all_orgs:
+                orgid = sbutils.ALL_ORGS
+            elif len(orgs) > 1:
                 orgid = self.ui.prompt_for_orgid(orgs)
             else:
                 orgid = orgs[0]['id']
             if orgid is None or not orgid:
                 sys.exit(0)
-            links = self.load_link_list(orgid)
-            if not links:
+            # Hand links to the UI page by page as they arrive, but look at
+            # the first page up front so an empty account fails early
+            if orgid == sbutils.ALL_ORGS:
+                link_pages = self.load_all_link_pages(orgs)
+            else:
+                link_pages = self.load_link_pages(orgid)
+            first_page = next(link_pages, [])
+            if not first_page:
                 raise ErrorException(
                         "You don't have any links with tunneling enabled. "\
                         "Go into the dashboard and enable tunneling on some links")
-            self.forwards = self.ui.prompt_for_forwards(links)
+            self.forwards = self.ui.prompt_for_forwards(
+                    itertools.chain([first_page], link_pages))
             if self.forwards is None or not self.forwards:
                 sys.exit(0)
             for f in self.forwards:
@@ -160,26 +281,98 @@ class SpaceBridge:
                     raise ErrorException(
                     'There was an error collecting link information. Contact support')
 
-    def parse_forwards(self, forwardstrings):
-        self.forwards = []
-        for forward in forwardstrings:
-            splfor = forward.split(":")
-            if len(splfor) != 3:
+    def resolve_forwards(self, forwards):
+        # Replaces name:/device: links with their link ids
+        unresolved = set(forward[0] for forward in forwards
+                         if not isinstance(forward[0], int))
+        if unresolved:
+            linkids = self.resolve_links(sorted(unresolved))
+            for forward in forwards:
+                if not isinstance(forward[0], int):
+                    forward[0] = linkids[forward[0]]
+
+    def resolve_links(self, links):
+        # Maps name:/device: link specs to link ids. Earlier answers are
+        # kept in the API cache so scripted restarts don't have to look them
+        # up again; anything new is looked up in a single pass over the
+        # links of every organization. Answers older than the cache TTL are
+        # looked up again, since a name can move to another link, and are
+        # only used as they are when the API can't be reached.
+        linkids, stale = self.cache.lookup('forward-links', self.refresh)
+        linkids = linkids or {}
+        if not stale:
+            missing = [link for link in links if link not in linkids]
+            if not missing:
+                return linkids
+            return self.find_links(missing, linkids)
+        try:
+            return self.find_links(links, {}, refresh=True)
+        except (requests.RequestException, UpdaterException) as e:
+            if any(link not in linkids for link in links):
+                raise
+            # (requests errors quote the URL, API key included)
+            self.logger.warning('Could not reach the API to check links (%s), '
+                                'using cached link ids for %s that may be out of date',
+                                type(e).__name__, ', '.join(links))
+            return linkids
+
+    def find_links(self, links, linkids, refresh=False):
+        # Looks links up from the API data and adds them to linkids
+        self.logger.info('Looking up links for %s' % ', '.join(links))
+        user = self.load_user_info(refresh)
+        index = linkindex.LinkIndex()
+        for links_page in self.load_all_link_pages(self.load_orgs(user['id'], refresh),
+                                                   refresh):
+            index.add(links_page)
+        for link in links:
+            if link.startswith(sbconfig.LINK_BY_NAME):
+                matches = index.find_name(link[len(sbconfig.LINK_BY_NAME):])
+            else:
+                match = index.get_by_deviceid(int(link[len(sbconfig.LINK_BY_DEVICE):]))
+                matches = [match] if match is not None else []
+            if not matches:
+                raise ErrorException(
+                        "No link with tunneling enabled matches [%s]"%link)
+            if len(matches) > 1:
                 raise ErrorException(
-                        "forward string formatted wrong [%s]"%forward)
-            if not splfor[0].isdigit():
-                raise ErrorException("Invalid linkid in [%s]"%
-                        forward)
-            if not splfor[1].isdigit() or not splfor[2].isdigit():
-                raise ErrorException("Invalid port numbers in [%s]"%
-                        forward)
-            fwd = [int(splfor[0]), int(splfor[1]), int(splfor[2])]
-            self.forwards.append(fwd)
-
-    def load_user_info(self):
-        apiurl = self.apibase + 'users/me/'
-        url_params = {'apikey' : self.apikey}
-        r = requests.get(apiurl, params=url_params)
+                        "[%s] matches several links (%s), use a link id instead"%
+                        (link, ', '.join(str(m['id']) for m in matches)))
+            linkids[link] = matches[0]['id']
+        self.cache.store('forward-links', linkids)
+        return linkids
+
+    # The load_* methods serve API data from the on-disk cache when they can,
+    # unless refresh is set here or on the command line; the fetch_* methods
+    # always go to the API.
+
+    def load_user_info(self, refresh=False):
+        return self.cache.fetch('user', self.fetch_user_info, self.refresh or refresh)
+
+    def load_link_pages(self, orgid, refresh=False):
+        return self.cache.fetch_pages('links-%s' % orgid,
+                lambda: self.fetch_link_pages(orgid), self.refresh or refresh)
+
+    def load_link_list(self, orgid, refresh=False):
+        return [link for page in self.load_link_pages(orgid, refresh) for link in page]
+
+    def load_all_link_pages(self, orgs, refresh=False):
+        # Loads the links of every org at once over a bounded number of
+        # threads and yields each org's links as soon as they are in. Links
+        # are ordered by org as they finish, not by org id.
+        self.logger.info("Loading links from %d organizations" % len(orgs))
+        orgids = [org['id'] for org in orgs]
+        for orgid, links in sbutils.parallel_map(
+                lambda orgid: self.load_link_list(orgid, refresh), orgids,
+                self.discovery_workers):
+            if links:
+                yield links
+
+    def load_orgs(self, userid, refresh=False):
+        return self.cache.fetch('orgs-%s' % userid,
+                lambda: self.fetch_orgs(userid), self.refresh or refresh)
+
+    def fetch_user_info(self):
+        r = self.api.get('users/me/')
         #pylint: disable=no-member
         if r.status_code != requests.codes.ok:
             raise ErrorException('Error connecting to API: ' + r.text)
@@ -187,41 +380,16 @@ class SpaceBridge:
             resp = r.json();
             return resp['data']
 
-    def load_link_list(self, orgid):
+    def fetch_link_pages(self, orgid):
         self.logger.info("Loading links from account")
-        apiurl = self.apibase + 'links/cellular/'
-        url_params = {'apikey' : self.apikey,
-                'orgid':orgid, 'tunnelable':1,
-                'limit':1000}
-        r = requests.get(apiurl, params=url_params)
-        #pylint: disable=no-member
-        if r.status_code != requests.codes.ok:
-            raise UpdaterException('Error connecting to API: ' + r.text)
-        else:
-            resp = r.json();
-            return resp['data']
-
+        url_params = {'orgid':orgid, 'tunnelable':1}
+        return self.api.pages('links/cellular/', url_params)
 
-    def load_orgs(self, userid):
-        apiurl = self.apibase + 'organizations/'
-        url_params = {'apikey' : self.apikey, 'userid' : userid,
-                      'limit' : 1000}
-        orgs = []
-        while True:
-            r = requests.get(apiurl, params=url_params)
-            #pylint: disable=no-member
-            if r.status_code != requests.codes.ok:
-                raise UpdaterException('Error connecting to API: ' + r.text)
-            else:
-                resp = r.json();
-                data = resp['data']
-                orgs += data
 
-                if (len(data) < 1000):
-                    break
-                else:
-                    url_params['startafter'] = data[-1]['id']
-        return orgs
+    def fetch_orgs(self, userid):
+        url_params = {'userid' : userid}
+        return [org for page in self.api.pages('organizations/', url_params)
+                for org in page]
 
 
     def check_credential_files(self):
@@ -241,8 +409,7 @@ class SpaceBridge:
             with open(self.publickey, 'r') as kf:
                 publickey = kf.read()
             payload = {'public_key': publickey}
-            params = {'apikey': self.apikey}
-            r = requests.post(self.apibase + "tunnelkeys", json=payload, params=params)
+            r = self.api.post("tunnelkeys", json=payload)
             #pylint: disable=no-member
             if r.status_code != requests.codes.ok:
                 raise ErrorException('Error uploading public key: ' + r.text)
@@ -251,9 +418,7 @@ class SpaceBridge:
 
     def generate_and_upload_key(self):
         self.logger.info('Generating keypair from API')
-        apiurl = self.apibase + "tunnelkeys"
-        params = {'apikey': self.apikey}
-        r = requests.post(apiurl, params=params)
+        r = self.api.post("tunnelkeys")
         #pylint: disable=no-member
         if r.status_code != requests.codes.ok:
             raise ErrorException('Error generating keypair: ' + r.text)
@@ -265,37 +430,209 @@ class SpaceBridge:
                 kf.write(resp['data']['public_key'])
             self.logger.info('Generated and saved keypair to %s and %s', self.privatekey, self.privatekey + '.pub')
 
-    def connect_to_tunnel_server(self):
+    def load_forward_engine(self):
+        if self.engine == 'async':
+            try:
+                from SpaceBridge import asyncforward
+            except (ImportError, SyntaxError):
+                raise ErrorException(
+                        'The async forwarding engine requires Python 3.5 or newer')
+            return asyncforward
+        return portforward
+
+    def connect_client(self):
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(self.host_key_policy)
+
         self.logger.info('Connecting to server %s:%s ...'%(str(self.tunnel_server),
             str(self.tunnel_port)))
         try:
-            self.client.connect(self.tunnel_server, self.tunnel_port, username="htunnel",
-                    key_filename=self.privatekey, look_for_keys=True)
+            client.connect(self.tunnel_server, self.tunnel_port, username="htunnel",
+                    key_filename=self.privatekey, look_for_keys=True,
+                    compress=self.compress_level > 0)
         except Exception as e:
-            if e[0] == 'not a valid EC private key file':
+            if e.args and e.args[0] == 'not a valid EC private key file':
                 raise ErrorException('Invalid private key file')
             else:
                 raise ErrorException('*** Failed to connect to %s:%s: %r'%
                         (str(self.tunnel_server), str(self.tunnel_port), e))
 
-        forwardmessage = ""
+        if self.compress_level and client.get_transport().local_compression == 'none':
+            self.logger.warning('The tunnel server declined SSH compression')
+        # Interactive channels share the connection with bulk ones, so don't
+        # let Nagle hold their small packets back behind unacknowledged data
+        client.get_transport().sock.setsockopt(socket.IPPROTO_TCP,
+                                               socket.TCP_NODELAY, 1)
+        if self.keepalive:
+            # SSH keepalives hold the NAT mapping open, and TCP keepalive
+            # makes a dead peer kill the transport so it gets reconnected
+            transport = client.get_transport()
+            transport.set_keepalive(self.keepalive)
+            portforward.enable_keepalive(transport.sock, self.keepalive)
+        return client
+
+    def connect_to_tunnel_server(self):
+        self.engine_module = self.load_forward_engine()
+        if self.compress_level:
+            sbcompress.install_compressor(self.compress_level)
+        # SOCKS connections go through the threaded engine's pool whichever
+        # engine the forwards use
+        pools = [self.engine_module.get_forward_pool()]
+        if self.socks and self.engine_module is not portforward:
+            pools.append(portforward.get_forward_pool())
+        for pool in pools:
+            pool.configure(max_workers=self.max_workers,
+                    max_channels=self.max_total_channels,
+                    queue_timeout=self.queue_timeout)
+
+        self.transport_pool = transportpool.TransportPool(self.connect_client,
+                self.transport_count, self.transport_balance, self.hold_timeout)
+        self.transport_pool.start()
+        ratelimit.set_total_limit(self.total_rate_limit)
+        ratelimit.set_default_link_limit(self.link_rate_limit)
+
+        if self.metrics_address:
+            sbmetrics.serve_metrics(*self.metrics_address)
+            self.logger.info('Serving metrics on http://%s:%d/metrics' %
+                             self.metrics_address)
+        if self.metrics_interval:
+            sbmetrics.log_summaries(self.metrics_interval)
+
+        self.listeners = {}
+        # A listener per forward plus headroom for the tunnels through them
+        portforward.raise_fd_limit(len(self.forwards) + FD_HEADROOM)
+        messages = []
         for forward in self.forwards:
-            host = "link" + str(forward[0])
-            msg = 'Now forwarding %s:%s to %s:%s ...' %\
-                    (self.local_host, str(forward[2]), host, str(forward[1]))
-            self.logger.info(msg)
-            forwardmessage += msg + '\n'
-            portforward.forward_tunnel(self.local_host, forward[2],
-                    host, forward[1], self.client.get_transport())
+            messages.append(self.start_forward(forward))
+        self.socks_server = None
+        if self.socks:
+            messages.append(self.start_socks())
+        if len(messages) > MAX_FORWARD_MESSAGES:
+            more = len(messages) - MAX_FORWARD_MESSAGES
+            messages = messages[:MAX_FORWARD_MESSAGES]
+            messages.append('... and %d more' % more)
+        forwardmessage = '\n'.join(messages) + '\n'
 
         self.ui.tunnel_running(forwardmessage)
 
+    def forward_option(self, forward, name):
+        # Per-forward settings from a config file win over the command line
+        if len(forward) > 3 and name in forward[3]:
+            return forward[3][name]
+        return getattr(self, name)
+
+    def start_forward(self, forward):
+        host = "link" + str(forward[0])
+        local_host = self.forward_option(forward, 'local_host')
+        msg = 'Now forwarding %s:%s to %s:%s ...' %\
+                (local_host, str(forward[2]), host, str(forward[1]))
+        self.logger.info(msg)
+
+        def option(name):
+            return self.forward_option(forward, name)
+
+        if len(forward) > 3 and 'link_rate_limit' in forward[3]:
+            ratelimit.set_link_limit(host, forward[3]['link_rate_limit'])
+        server = self.engine_module.forward_tunnel(local_host, forward[2],
+                host, forward[1], self.transport_pool,
+                min_bufsize=option('min_bufsize'), max_bufsize=option('max_bufsize'),
+                max_channels=option('max_channels'), keepalive=option('keepalive'),
+                idle_timeout=option('idle_timeout'),
+                warm_channels=option('warm_channels'), warm_ttl=option('warm_ttl'),
+                rate_limit=option('rate_limit'))
+        self.listeners[sbconfig.forward_address(forward, self.local_host)] = (forward, server)
+        return msg
+
+    def start_socks(self):
+        # SOCKS connections always go through the threaded engine's pool and
+        # poller, whichever engine the forwards use
+        msg = 'SOCKS5 proxy on %s:%d, connect to linkNNN:<device port> ...' % self.socks
+        self.logger.info(msg)
+        self.socks_server = socksforward.socks_tunnel(self.socks[0], self.socks[1],
+                self.transport_pool, min_bufsize=self.min_bufsize,
+                max_bufsize=self.max_bufsize, max_channels=self.max_channels,
+                keepalive=self.keepalive, idle_timeout=self.idle_timeout,
+                rate_limit=self.rate_limit)
+        return msg
+
+    def stop_forward(self, address):
+        forward, server = self.listeners.pop(address)
+        self.logger.info('Stopped forwarding %s:%s to link%s:%s' %
+                (address[0], str(forward[2]), str(forward[0]), str(forward[1])))
+        self.engine_module.close_tunnel(server)
+
+    def reload_forwards(self):
+        # Re-read the command line, including any @file argument files and
+        # the --config file, and bring the listeners in line with it.
+        # Listeners whose forward didn't change are left alone, and
+        # connections on removed ones stay open.
+        self.logger.info('Reloading forwards')
+        try:
+            args = get_parser(self.version).parse_args()
+            self.collect_forwards(args)
+        except Exception as e:
+            self.logger.error('Keeping current forwards, reload failed: %s' % e)
+            return
+        wanted = dict((sbconfig.forward_address(forward, self.local_host), forward)
+                      for forward in self.forwards)
+        # Link limits set by forwards that are gone would otherwise stay
+        # until the next restart
+        link_limits = dict(('link' + str(forward[0]), forward[3]['link_rate_limit'])
+                           for forward in self.forwards
+                           if len(forward) > 3 and 'link_rate_limit' in forward[3])
+        ratelimit.reset_link_limits(link_limits)
+        for link, rate in link_limits.items():
+            ratelimit.set_link_limit(link, rate)
+        for address, (forward, server) in list(self.listeners.items()):
+            if wanted.get(address) != forward:
+                self.stop_forward(address)
+        for address, forward in wanted.items():
+            if address in self.listeners:
+                continue
+            try:
+                self.start_forward(forward)
+            except Exception as e:
+                self.logger.error('Could not forward %s:%d: %s' %
+                        (address[0], address[1], e))
+
+    def serve_forever(self):
+        # Main loop for --daemon. Forward threads are all daemon threads, so
+        # this is what keeps the process alive until it is told to stop.
+        state = {'stop': False, 'reload': False}
+
+        def stop(signum, frame):
+            state['stop'] = True
+
+        def reload(signum, frame):
+            state['reload'] = True
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, reload)
+
+        while not state['stop']:
+            time.sleep(DAEMON_POLL_INTERVAL)
+            if state['reload']:
+                state['reload'] = False
+                self.reload_forwards()
+
+        self.logger.info('Shutting down')
+        for address in list(self.listeners):
+            self.stop_forward(address)
+        if self.socks_server is not None:
+            socksforward.close_tunnel(self.socks_server)
+        self.transport_pool.close()
+
     def run(self, args):
         try:
             self.collect_user_prefs(args)
             self.check_credential_files()
             self.collect_forwards(args)
             self.connect_to_tunnel_server()
+            if self.daemon:
+                self.serve_forever()
         except ErrorException as e:
             self.ui.show_error_message('Error: '+ str(e))
             sys.exit(1)
@@ -318,18 +655,105 @@ def get_version():
         return f.readline().rstrip()
 
 
-def main():
-    version = get_version()
+def get_parser(version):
+    # Arguments can also be read from files given as @path, one per line,
+    # which --daemon re-reads on SIGHUP
     parser = argparse.ArgumentParser(description=HELP,
-        add_help=True)
+        add_help=True, fromfile_prefix_chars='@')
     parser.add_argument('--apikey', help='Hologram API key')
     parser.add_argument('-f', '--forward', dest="forwards", action="append",
-        help="Specify any number of port forwards in the format <linkid>:<device port>:<local port>")
+        help="Specify any number of port forwards in the format "
+        "<link>:<device port>:<local port>[@<rate limit>], where <link> is a link id, "
+        "name:<device name> or device:<device id>")
+    parser.add_argument('-c', '--config',
+        help="JSON, YAML or TOML file listing forwards and per-forward settings")
+    parser.add_argument('--socks', metavar='[HOST:]PORT',
+        help="Run a SOCKS5 proxy on this local port that reaches any device as "
+        "linkNNN:<device port>, like ssh -D")
     parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--log-format', choices=sblogging.LOG_FORMATS, default='text',
+        help='Write ~/.hologram/spacebridge.log as plain text or as JSON lines '
+        '(default: text)')
+    parser.add_argument('--log-max-bytes', type=int, default=sblogging.LOG_MAX_BYTES,
+        help='Rotate the log file when it reaches this size, keeping %d old files, '
+        '0 to never rotate (default: %d)' % (sblogging.LOG_BACKUPS, sblogging.LOG_MAX_BYTES))
+    parser.add_argument('--log-sample', type=int, default=sblogging.SAMPLE_BURST,
+        help='Times the same message may be logged every %d seconds before the '
+        'rest are only counted, 0 to log everything (default: %d)' %
+        (sblogging.SAMPLE_INTERVAL, sblogging.SAMPLE_BURST))
     parser.add_argument('--text-mode', action='store_true',
         help="Disable the GUI and do everything via text inputs")
+    parser.add_argument('--daemon', action='store_true',
+        help="Run headless as a service until SIGTERM. Requires --apikey and "
+        "--forward, --config or --socks. SIGHUP reloads the forwards")
     parser.add_argument('--local-host', default=DEFAULT_LOCAL_HOST,
         help='local host IP to bind to (default: %s)' % DEFAULT_LOCAL_HOST)
+    parser.add_argument('--engine', choices=['thread', 'async'], default=DEFAULT_ENGINE,
+        help='Forwarding engine: "thread" relays all connections from one poller '
+        'thread and opens channels on a bounded worker pool, '
+        '"async" runs all forwards on one event loop (default: %s)' % DEFAULT_ENGINE)
+    parser.add_argument('--min-bufsize', type=int,
+        help='Initial relay read size in bytes (default: %d)' % portforward.MIN_BUFSIZE)
+    parser.add_argument('--max-bufsize', type=int,
+        help='Largest relay read size in bytes under sustained load (default: %d)' %
+        portforward.MAX_BUFSIZE)
+    parser.add_argument('--max-channels', type=int,
+        help='Most concurrent connections per forward, 0 for no limit (default: 0)')
+    parser.add_argument('--max-total-channels', type=int,
+        help='Most concurrent connections across all forwards, 0 for no limit '
+        '(default: %d)' % portforward.MAX_TOTAL_CHANNELS)
+    parser.add_argument('--max-workers', type=int,
+        help='Threads used to open new connections (default: %d)' % portforward.MAX_WORKERS)
+    parser.add_argument('--queue-timeout', type=float,
+        help='Seconds a new connection may wait for a free slot before it is '
+        'refused, 0 to wait forever (default: %s)' % portforward.QUEUE_TIMEOUT)
+    parser.add_argument('--transports', type=int,
+        help='Number of connections to the tunnel server to spread forwarded '
+        'connections over (default: 1)')
+    parser.add_argument('--transport-balance', choices=transportpool.BALANCE_MODES,
+        help='How new connections pick a tunnel server connection '
+        '(default: %s)' % transportpool.LEAST_LOADED)
+    parser.add_argument('--hold-timeout', type=float,
+        help='Seconds a new connection waits for a lost tunnel server connection '
+        'to come back before it is refused (default: %s)' % transportpool.HOLD_TIMEOUT)
+    parser.add_argument('--keepalive', type=int,
+        help='Seconds between SSH and TCP keepalives, 0 to disable (default: %d)' %
+        DEFAULT_KEEPALIVE)
+    parser.add_argument('--idle-timeout', type=int,
+        help='Close forwarded connections with no traffic for this many seconds, '
+        '0 to keep them forever (default: 0)')
+    parser.add_argument('--warm-channels', type=int,
+        help='Channels to keep open ahead of time per forward to cut connect '
+        'latency (default: 0)')
+    parser.add_argument('--warm-ttl', type=float,
+        help='Seconds before an unused warm channel is replaced (default: %d)' %
+        channelpool.WARM_TTL)
+    parser.add_argument('--rate-limit', type=sbconfig.parse_rate, metavar='RATE',
+        help='Most bytes per second each way through each forward, with an '
+        'optional k or M suffix, 0 for no limit (default: 0)')
+    parser.add_argument('--link-rate-limit', type=sbconfig.parse_rate, metavar='RATE',
+        help='Most bytes per second each way to each link, across all forwards '
+        'and the SOCKS proxy (default: 0)')
+    parser.add_argument('--total-rate-limit', type=sbconfig.parse_rate, metavar='RATE',
+        help='Most bytes per second each way across everything forwarded '
+        '(default: 0)')
+    parser.add_argument('--compress', type=int, nargs='?', const=sbcompress.DEFAULT_LEVEL,
+        metavar='LEVEL', help='Compress traffic to the tunnel server with zlib at this '
+        'level, 1 (fastest) to 9 (smallest), default %d if no level is given. Paused '
+        'while the data doesn\'t compress well' % sbcompress.DEFAULT_LEVEL)
+    parser.add_argument('--metrics-port', metavar='[HOST:]PORT',
+        help='Serve connection metrics for Prometheus on this local port')
+    parser.add_argument('--metrics-interval', type=int,
+        help='Seconds between connection summaries in the log, 0 to disable '
+        '(default: %d)' % sbmetrics.SUMMARY_INTERVAL)
+    parser.add_argument('--all-orgs', action='store_true',
+        help='Search the links of every organization instead of picking one')
+    parser.add_argument('--cache-ttl', type=int,
+        help='Seconds to reuse cached organization and link lists before '
+        'fetching them again, 0 to disable the cache (default: %d)' %
+        sbcache.CACHE_TTL)
+    parser.add_argument('--refresh', action='store_true',
+        help='Ignore cached organization and link lists and fetch them again')
     parser.add_argument('--upload-publickey', dest="publickey",
         help='Upload specified public key to the server to authenticate against with --privatekey')
     parser.add_argument('-i', '--privatekey', dest="privatekey",
@@ -341,7 +765,12 @@ def main():
     parser.add_argument('--no-fingerprint', help=argparse.SUPPRESS, action='store_true')
     parser.add_argument('--tunnel-server', help=argparse.SUPPRESS)
     parser.add_argument('--tunnel-port', help=argparse.SUPPRESS, type=int)
-    args = parser.parse_args()
+    return parser
+
+
+def main():
+    version = get_version()
+    args = get_parser(version).parse_args()
 
     sb = SpaceBridge(version, args)
     sb.run(args)
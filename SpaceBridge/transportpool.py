@@ -0,0 +1,211 @@
+#
+#  transportpool.py
+#
+# License: Copyright (c) 2016 Hologram All Rights Reserved.
+#
+# Released under the MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import random
+import threading
+import time
+
+from SpaceBridge.sbexceptions import ErrorException
+from SpaceBridge.sbmetrics import get_metrics
+
+LEAST_LOADED = 'least-loaded'
+ROUND_ROBIN = 'round-robin'
+BALANCE_MODES = [LEAST_LOADED, ROUND_ROBIN]
+
+# Reconnect delays, in seconds. The delay ceiling doubles from
+# RECONNECT_MIN_DELAY up to RECONNECT_MAX_DELAY after each failed attempt,
+# and the actual delay is picked at random below it so many clients that
+# lost the server at the same time don't all come back at once.
+RECONNECT_MIN_DELAY = 1.0
+RECONNECT_MAX_DELAY = 60.0
+# How often the supervisor checks transport health, in seconds
+HEALTH_CHECK_INTERVAL = 1.0
+# How long a new channel waits for a transport to come back, in seconds
+HOLD_TIMEOUT = 15.0
+# What of TransportPool.stats() is exported with the connection metrics
+TRANSPORT_POOL_METRICS = [
+    ('live', 'live', 'gauge', 'Connections to the tunnel server that are up'),
+    ('channels', 'channels', 'gauge', 'Channels open on each connection', 'connection'),
+    ('reconnects', 'reconnects_total', 'counter', 'Times a lost connection was reopened'),
+]
+
+
+def close_channel(chan):
+    # Closing a channel whose transport already died raises, and there is
+    # nothing left to clean up then, so that is not an error
+    try:
+        chan.close()
+    except Exception:
+        pass
+
+
+class TransportPool:
+    # Spreads new channels over several SSH connections to the tunnel server
+    # so they don't all share the encryption thread and TCP congestion window
+    # of a single transport. Forwards only ever call open_channel() on their
+    # transport, so a pool can be passed to forward_tunnel in place of one.
+    #
+    # A supervisor thread reconnects transports that die. Listeners don't
+    # notice; a new connection that finds no live transport waits up to
+    # hold_timeout for one to come back instead of being refused.
+
+    def __init__(self, connect, size=1, balance=LEAST_LOADED,
+                 hold_timeout=HOLD_TIMEOUT):
+        # connect is called with no arguments and returns a connected
+        # paramiko.SSHClient
+        self.connect = connect
+        self.size = max(1, size)
+        self.balance = balance
+        self.hold_timeout = hold_timeout
+        self.logger = logging.getLogger('spacebridge')
+        self.cond = threading.Condition()
+        self.clients = []
+        self.channels = []
+        self.failures = []
+        self.retry_at = []
+        self.next_index = 0
+        self.reconnects = 0
+        self.closed = False
+        self.metrics = None
+
+    def start(self):
+        for i in range(self.size):
+            self.clients.append(self.connect())
+            self.channels.append(set())
+            self.failures.append(0)
+            self.retry_at.append(0)
+        self.logger.info('Opened %d connection(s) to the tunnel server', self.size)
+        self.metrics = get_metrics().register('transport_pool', self.stats,
+                                              TRANSPORT_POOL_METRICS)
+        supervisor = threading.Thread(target=self.supervise,
+                                      name='transport-supervisor')
+        supervisor.daemon = True
+        supervisor.start()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.metrics is not None:
+            get_metrics().unregister(self.metrics)
+        for client in self.clients:
+            if client is not None:
+                client.close()
+
+    def is_active(self, index):
+        client = self.clients[index]
+        if client is None:
+            return False
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def supervise(self):
+        while True:
+            with self.cond:
+                if self.closed:
+                    return
+            for i in range(self.size):
+                if not self.is_active(i) and time.time() >= self.retry_at[i]:
+                    self.reconnect(i)
+            with self.cond:
+                self.cond.wait(HEALTH_CHECK_INTERVAL)
+
+    def reconnect(self, index):
+        if self.failures[index] == 0:
+            self.logger.warning('Lost connection %d to the tunnel server, reconnecting', index)
+        old = self.clients[index]
+        self.clients[index] = None
+        if old is not None:
+            old.close()
+        try:
+            client = self.connect()
+        except Exception as e:
+            self.failures[index] += 1
+            ceiling = min(RECONNECT_MAX_DELAY,
+                          RECONNECT_MIN_DELAY * 2 ** (self.failures[index] - 1))
+            delay = random.uniform(0, ceiling)
+            self.retry_at[index] = time.time() + delay
+            self.logger.warning('Reconnect attempt %d failed, retrying in %.1fs: %s',
+                                self.failures[index], delay, e)
+            return
+        with self.cond:
+            self.clients[index] = client
+            self.channels[index] = set()
+            self.failures[index] = 0
+            self.retry_at[index] = 0
+            self.reconnects += 1
+            self.cond.notify_all()
+        self.logger.warning('Reconnected connection %d to the tunnel server', index)
+
+    def pick(self, deadline):
+        # Pick a live transport, waiting for the supervisor to bring one back
+        # if none is up right now
+        with self.cond:
+            while True:
+                live = [i for i in range(self.size) if self.is_active(i)]
+                if live:
+                    break
+                remaining = deadline - time.time()
+                if self.closed or remaining <= 0:
+                    raise ErrorException('No connection to the tunnel server')
+                self.cond.wait(remaining)
+            if self.balance == ROUND_ROBIN:
+                index = live[self.next_index % len(live)]
+                self.next_index += 1
+                return index
+            for i in live:
+                self.channels[i] = set(c for c in self.channels[i] if not c.closed)
+            return min(live, key=lambda i: len(self.channels[i]))
+
+    def open_channel(self, kind, *args, **kwargs):
+        deadline = time.time() + self.hold_timeout
+        while True:
+            index = self.pick(deadline)
+            client = self.clients[index]
+            if client is None:
+                # The supervisor just took this transport down for reconnecting
+                continue
+            try:
+                chan = client.get_transport().open_channel(kind, *args, **kwargs)
+            except Exception:
+                # If the transport died under us try another one, otherwise
+                # the failure is about the channel itself
+                if self.is_active(index) or time.time() >= deadline:
+                    raise
+                continue
+            if chan is not None:
+                with self.cond:
+                    self.channels[index].add(chan)
+            return chan
+
+    def stats(self):
+        with self.cond:
+            return {
+                'channels': [len([c for c in chans if not c.closed])
+                             for chans in self.channels],
+                'live': len([i for i in range(self.size) if self.is_active(i)]),
+                'reconnects': self.reconnects,
+            }
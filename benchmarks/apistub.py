@@ -0,0 +1,193 @@
+#
+#  apistub.py
+#
+# License: Copyright (c) 2016 Hologram All Rights Reserved.
+#
+# Released under the MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""In-process stand-in for the Hologram Dashboard API.
+
+Serves the endpoints SpaceBridge uses (``users/me/``, ``organizations/``,
+``links/cellular/`` and ``tunnelkeys``) over plain HTTP/1.1 with
+keep-alive, with paging by ``limit``/``startafter`` like the real API.
+Counts the requests and TCP connections it serves, can add latency to
+every response, and can fail the next few requests with a 503 to
+exercise retries.
+"""
+
+import json
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+USER_ID = 1
+
+
+def make_orgs(count):
+    return [{'id': 100 + i, 'name': 'Org %d' % i} for i in range(count)]
+
+
+def make_links(orgs, links_per_org):
+    links = {}
+    next_id = 1000
+    for org in orgs:
+        links[org['id']] = []
+        for _ in range(links_per_org):
+            links[org['id']].append({'id': next_id, 'orgid': org['id'],
+                'deviceid': next_id + 500000,
+                'devicename': 'device-%d' % next_id, 'tunnelable': 1})
+            next_id += 1
+    return links
+
+
+def page(rows, query):
+    limit = int(query.get('limit', ['1000'])[0])
+    startafter = query.get('startafter')
+    if startafter:
+        startafter = int(startafter[0])
+        rows = [row for row in rows if row['id'] > startafter]
+    return rows[:limit]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep the connection open between requests
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; don't let Nagle hold the
+    # body back waiting for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.stub.count('connections')
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def route(self, method):
+        stub = self.server.stub
+        stub.count('requests')
+        if stub.latency:
+            time.sleep(stub.latency)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if stub.take_failure():
+            return self.reply(503, {'success': False, 'error': 'unavailable'})
+        if query.get('apikey', [None])[0] != stub.apikey:
+            return self.reply(401, {'success': False, 'error': 'bad apikey'})
+        path = url.path[len(stub.prefix):]
+        if method == 'GET' and path == 'users/me/':
+            return self.reply(200, {'success': True, 'data': {'id': USER_ID}})
+        if method == 'GET' and path == 'organizations/':
+            return self.reply(200, {'success': True,
+                                    'data': page(stub.orgs, query)})
+        if method == 'GET' and path == 'links/cellular/':
+            orgid = int(query.get('orgid', ['0'])[0])
+            return self.reply(200, {'success': True,
+                                    'data': page(stub.links.get(orgid, []), query)})
+        if method == 'POST' and path == 'tunnelkeys':
+            if body:
+                return self.reply(200, {'success': True, 'data': {}})
+            return self.reply(200, {'success': True, 'data': {
+                'private_key': 'stub private key', 'public_key': 'stub public key'}})
+        return self.reply(404, {'success': False, 'error': 'not found'})
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class StubDashboardAPI:
+    """Dashboard API stand-in with ``orgs`` organizations holding
+    ``links_per_org`` tunnelable links each.  ``apibase`` is the URL to hand
+    to the client under test."""
+
+    prefix = '/api/1/'
+
+    def __init__(self, orgs=1, links_per_org=10, apikey='stub-apikey',
+                 latency=0, host='127.0.0.1'):
+        self.apikey = apikey
+        self.latency = latency
+        self.orgs = make_orgs(orgs)
+        self.links = make_links(self.orgs, links_per_org)
+        self.counts = {'requests': 0, 'connections': 0}
+        self.failures = 0
+        self.lock = threading.Lock()
+        self.server = _Server((host, 0), _Handler)
+        self.server.stub = self
+        self.address = self.server.server_address
+        self.apibase = 'http://%s:%d%s' % (self.address[0], self.address[1],
+                                            self.prefix)
+
+    def start(self):
+        t = threading.Thread(target=self.server.serve_forever,
+                             name='stub-dashboard')
+        t.daemon = True
+        t.start()
+        return self
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def fail_next(self, count):
+        with self.lock:
+            self.failures = count
+
+    def take_failure(self):
+        with self.lock:
+            if self.failures:
+                self.failures -= 1
+                return True
+            return False
+
+    def reset_counts(self):
+        with self.lock:
+            self.counts = {'requests': 0, 'connections': 0}
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#
+#  bench_api.py
+#
+# License: Copyright (c) 2016 Hologram All Rights Reserved.
+#
+# Released under the MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Dashboard API call overhead with and without a pooled session.
+
+Makes the same sequence of API calls SpaceBridge makes at startup against
+an in-process Dashboard API stand-in, once with a fresh connection per call
+the way plain requests.get works and once through DashboardAPI, and
+reports the time per call and the number of TCP connections opened.
+
+    python benchmarks/bench_api.py --calls 200
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from SpaceBridge import sbapi
+import apistub
+
+
+def run_plain(stub, calls):
+    for _ in range(calls):
+        requests.get(stub.apibase + 'users/me/', params={'apikey': stub.apikey})
+
+
+def run_session(stub, calls):
+    api = sbapi.DashboardAPI(stub.apibase, stub.apikey)
+    for _ in range(calls):
+        api.get('users/me/')
+    api.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0,
+            help='seconds the stand-in waits before answering each call')
+    args = parser.parse_args()
+
+    stub = apistub.StubDashboardAPI(latency=args.latency).start()
+    print('%-10s %10s %12s' % ('client', 'ms/call', 'connections'))
+    for name, run in (('requests', run_plain), ('session', run_session)):
+        stub.reset_counts()
+        start = time.time()
+        run(stub, args.calls)
+        elapsed = time.time() - start
+        print('%-10s %10.2f %12d' % (name, elapsed * 1000 / args.calls,
+            stub.counts['connections']))
+    stub.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+#
+#  bench_compression.py
+#
+# License: Copyright (c) 2016 Hologram All Rights Reserved.
+#
+# Released under the MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""SSH compression on compressible and incompressible payloads.
+
+Uploads JSON telemetry (compressible) and random bytes (incompressible)
+through a forward to a sink server behind an in-process tunnel server
+stand-in, once without compression and once per zlib level, and once more
+at the default level with the adaptive switch-off disabled. The SSH
+connection runs through a proxy that counts the bytes on the wire and can
+cap them at --link-rate to stand in for a cellular link.
+
+CPU time is for the whole process, so it includes the stand-in server
+decompressing what was sent; compare rows with each other.
+
+    python benchmarks/bench_compression.py
+    python benchmarks/bench_compression.py --link-rate 1M --megabytes 8
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from SpaceBridge import portforward, sbcompress, sbconfig
+import sshstub
+
+CHUNK = 65536
+
+
+class CountingProxy:
+    # TCP proxy for the SSH connection that counts the bytes it carries
+    # and paces each direction to at most rate bytes per second
+
+    def __init__(self, target, rate=0):
+        self.target = target
+        self.rate = rate
+        self.sent = 0
+        self.received = 0
+        self.lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(4)
+        self.address = self.sock.getsockname()
+        t = threading.Thread(target=self.serve, name='stub-proxy')
+        t.daemon = True
+        t.start()
+
+    def serve(self):
+        while True:
+            client, _ = self.sock.accept()
+            server = socket.create_connection(self.target)
+            for s in (client, server):
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            for src, dst, upstream in ((client, server, True), (server, client, False)):
+                t = threading.Thread(target=self.pump, args=(src, dst, upstream),
+                                     name='stub-proxy-pump')
+                t.daemon = True
+                t.start()
+
+    def pump(self, src, dst, upstream):
+        start = time.time()
+        total = 0
+        while True:
+            try:
+                data = src.recv(CHUNK)
+            except socket.error:
+                data = b''
+            if not data:
+                break
+            dst.sendall(data)
+            total += len(data)
+            with self.lock:
+                if upstream:
+                    self.sent += len(data)
+                else:
+                    self.received += len(data)
+            if self.rate:
+                ahead = total / float(self.rate) - (time.time() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        for s in (src, dst):
+            try:
+                s.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def reset(self):
+        with self.lock:
+            sent, self.sent, self.received = self.sent, 0, 0
+        return sent
+
+
+def telemetry(size):
+    # Newline separated JSON readings, like devices report
+    rng = random.Random(1)
+    lines = []
+    length = 0
+    while length < size:
+        line = json.dumps({
+            'device': 'pump-%d' % rng.randint(1, 50),
+            'ts': 1700000000 + len(lines),
+            'temperature': round(rng.uniform(-10, 40), 2),
+            'pressure': round(rng.uniform(900, 1100), 1),
+            'status': rng.choice(['ok', 'ok', 'ok', 'degraded']),
+        }) + '\n'
+        lines.append(line)
+        length += len(line)
+    return ''.join(lines).encode('ascii')[:size]
+
+
+PAYLOADS = {
+    'json': telemetry,
+    'random': os.urandom,
+}
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def upload(port, payload):
+    s = socket.create_connection(('127.0.0.1', port))
+    header = ('%d\n' % len(payload)).encode('ascii')
+    s.sendall(header)
+    view = memoryview(payload)
+    for i in range(0, len(payload), CHUNK):
+        s.sendall(view[i:i + CHUNK])
+    reply = b''
+    while len(reply) < len(header):
+        data = s.recv(64)
+        if not data:
+            raise RuntimeError('connection closed by the tunnel')
+        reply += data
+    s.close()
+
+
+def run(proxy, payload, level, adaptive):
+    if level:
+        sbcompress.install_compressor(level, adaptive)
+    client = sshstub.connect_client(proxy.address, compress=bool(level))
+    port = sshstub.free_port()
+    server = portforward.forward_tunnel('127.0.0.1', port, 'link2', 7,
+                                        client.get_transport())
+    proxy.reset()
+    cpu = cpu_seconds()
+    start = time.time()
+    upload(port, payload)
+    elapsed = time.time() - start
+    cpu = cpu_seconds() - cpu
+    wire = proxy.reset()
+    portforward.close_tunnel(server)
+    client.close()
+    return {
+        'mb_per_sec': len(payload) / elapsed / 1048576,
+        'wire_ratio': wire / float(len(payload)),
+        'cpu_sec': cpu,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--megabytes', type=int, default=32,
+            help='amount of each payload to upload')
+    parser.add_argument('--level', type=int, action='append',
+            help='zlib level to try; may be repeated (default: 1, 6 and 9)')
+    parser.add_argument('--link-rate', type=sbconfig.parse_rate, default=0,
+            help='cap the SSH connection at this many bytes per second each way, '
+            'with an optional k or M suffix (default: no cap)')
+    args = parser.parse_args()
+
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    sink_server = sshstub.SinkServer().start()
+    stub = sshstub.StubTunnelServer(sink_server.address).start()
+    proxy = CountingProxy(stub.address, args.link_rate)
+    size = args.megabytes * 1048576
+
+    configs = [(0, True)] + [(level, True) for level in args.level or [1, 6, 9]]
+    configs.append((sbcompress.DEFAULT_LEVEL, False))
+    print('%-8s %-8s %9s %9s %8s' % ('payload', 'level', 'MB/s', 'wire', 'CPU s'))
+    for name in sorted(PAYLOADS):
+        payload = PAYLOADS[name](size)
+        for level, adaptive in configs:
+            result = run(proxy, payload, level, adaptive)
+            label = str(level or 'off') + ('' if adaptive else ' fixed')
+            print('%-8s %-8s %9.1f %8.1f%% %8.2f' % (name, label,
+                result['mb_per_sec'], result['wire_ratio'] * 100, result['cpu_sec']))
+
+
+if __name__ == '__main__':
+    main()
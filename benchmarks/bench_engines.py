@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+#
+#  bench_engines.py
+#
+# License: Copyright (c) 2016 Hologram All Rights Reserved.
+#
+# Released under the MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Compare the threaded and async forwarding engines.
+
+Opens many concurrent connections through a forward to an in-process
+tunnel server stand-in, holds them all open while exchanging small
+messages, and reports connect latency, round trip time and the number of
+client threads needed to keep the connections open.
+
+    python benchmarks/bench_engines.py --connections 200 --rounds 20
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from SpaceBridge import portforward
+import sshstub
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def echo(s, payload):
+    s.sendall(payload)
+    received = 0
+    while received < len(payload):
+        data = s.recv(65536)
+        if not data:
+            raise RuntimeError('connection closed by the tunnel')
+        received += len(data)
+
+
+def run_engine(engine, transport, connections, rounds, payload):
+    port = sshstub.free_port()
+    engine.forward_tunnel('127.0.0.1', port, 'link1', 7, transport)
+    baseline_threads = sshstub.client_threads()
+
+    # Connect latency covers accept, open_channel and the first round trip
+    socks = []
+    connect_times = []
+    for _ in range(connections):
+        t0 = time.time()
+        s = socket.create_connection(('127.0.0.1', port))
+        echo(s, payload)
+        connect_times.append(time.time() - t0)
+        socks.append(s)
+    peak_threads = sshstub.client_threads()
+
+    rtts = []
+    start = time.time()
+    for _ in range(rounds):
+        for s in socks:
+            t0 = time.time()
+            echo(s, payload)
+            rtts.append(time.time() - t0)
+    elapsed = time.time() - start
+    for s in socks:
+        s.close()
+
+    return {
+        'connect_p50_ms': percentile(connect_times, 50) * 1000,
+        'connect_p99_ms': percentile(connect_times, 99) * 1000,
+        'messages_per_sec': len(rtts) / elapsed,
+        'rtt_p50_ms': percentile(rtts, 50) * 1000,
+        'rtt_p99_ms': percentile(rtts, 99) * 1000,
+        'extra_threads': peak_threads - baseline_threads,
+    }
+
+
+def load_engines(names):
+    engines = []
+    for name in names:
+        if name == 'thread':
+            engines.append((name, portforward))
+        elif name == 'async':
+            from SpaceBridge import asyncforward
+            engines.append((name, asyncforward))
+    return engines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--connections', type=int, default=100)
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--payload', type=int, default=512,
+            help='message size in bytes')
+    parser.add_argument('--engine', action='append', choices=['thread', 'async'],
+            help='engine to benchmark; may be repeated (default: both)')
+    args = parser.parse_args()
+
+    echo_server = sshstub.EchoServer().start()
+    server = sshstub.StubTunnelServer(echo_server.address).start()
+    payload = b'x' * args.payload
+
+    print('%-8s %12s %12s %10s %10s %10s %8s' % ('engine', 'conn p50 ms',
+        'conn p99 ms', 'msg/s', 'p50 ms', 'p99 ms', 'threads'))
+    for name, engine in load_engines(args.engine or ['thread', 'async']):
+        client = sshstub.connect_client(server.address)
+        result = run_engine(engine, client.get_transport(), args.connections,
+                args.rounds, payload)
+        print('%-8s %12.2f %12.2f %10.0f %10.2f %10.2f %8d' % (name,
+            result['connect_p50_ms'], result['connect_p99_ms'],
+            result['messages_per_sec'], result['rtt_p50_ms'],
+            result['rtt_p99_ms'], result['extra_threads']))
+        client.close()
+
+
+if __name__ == '__main__':
+    main()
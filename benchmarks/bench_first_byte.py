@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+#  bench_first_byte.py
+#
+# License: Copyright (c) 2016 Hologram All Rights Reserved.
+#
+# Released under the MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""First byte latency of short request/response connections.
+
+Opens one connection at a time through a forward, sends a small request
+and waits for the reply, the way Modbus polls or HTTP health checks use a
+tunnel. Channel opens through the in-process tunnel server stand-in are
+delayed to stand in for the round trip to a device over cellular. Runs once
+opening a channel per connection and once with pre-opened warm channels.
+
+    python benchmarks/bench_first_byte.py --requests 50 --open-delay 0.2
+    python benchmarks/bench_first_byte.py --warm 4 --interval 0.05
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bench_engines import echo, load_engines, percentile
+import sshstub
+
+
+def run(engine, transport, requests, interval, warm):
+    port = sshstub.free_port()
+    engine.forward_tunnel('127.0.0.1', port, 'link1', 7, transport,
+            warm_channels=warm)
+    # Give the pool a chance to fill before the first request
+    time.sleep(1.0 if warm else 0)
+    latencies = []
+    for _ in range(requests):
+        t0 = time.time()
+        s = socket.create_connection(('127.0.0.1', port))
+        echo(s, b'poll')
+        latencies.append(time.time() - t0)
+        s.close()
+        time.sleep(interval)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=30)
+    parser.add_argument('--interval', type=float, default=0.25,
+            help='pause between requests in seconds')
+    parser.add_argument('--open-delay', type=float, default=0.2,
+            help='seconds the stand-in takes to open each channel')
+    parser.add_argument('--warm', type=int, default=2,
+            help='warm channels to keep open per forward')
+    parser.add_argument('--engine', action='append', choices=['thread', 'async'],
+            help='engine to benchmark; may be repeated (default: thread)')
+    args = parser.parse_args()
+
+    echo_server = sshstub.EchoServer().start()
+    server = sshstub.StubTunnelServer(echo_server.address,
+            open_delay=args.open_delay).start()
+
+    print('%-8s %6s %10s %10s' % ('engine', 'warm', 'p50 ms', 'p99 ms'))
+    for name, engine in load_engines(args.engine or ['thread']):
+        for warm in (0, args.warm):
+            client = sshstub.connect_client(server.address)
+            latencies = run(engine, client.get_transport(), args.requests,
+                    args.interval, warm)
+            print('%-8s %6d %10.2f %10.2f' % (name, warm,
+                percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000))
+            client.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#
+#  bench_ratelimit.py
+#
+# License: Copyright (c) 2016 Hologram All Rights Reserved.
+#
+# Released under the MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Rate limits and interactive latency next to a bulk transfer.
+
+Puts a global rate limit on an in-process tunnel server stand-in with an
+echo server (link1) and a sink server (link2) behind it. Measures the echo
+round trip on its own, then again while a bulk transfer to the sink runs
+through another forward on the same transport, and reports the rate the
+transfer actually got.
+
+    python benchmarks/bench_ratelimit.py --rate 1M --megabytes 4
+    python benchmarks/bench_ratelimit.py --reserve 0
+"""
+
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from SpaceBridge import ratelimit, sbconfig
+from bench_engines import echo, load_engines, percentile
+from bench_suite import ECHO_LINK, SINK_LINK, send_to_sink
+import sshstub
+
+PING_INTERVAL = 0.02
+
+
+def ping(port, payload, count):
+    s = socket.create_connection(('127.0.0.1', port))
+    rtts = []
+    for _ in range(count):
+        t0 = time.time()
+        echo(s, payload)
+        rtts.append(time.time() - t0)
+        time.sleep(PING_INTERVAL)
+    s.close()
+    return rtts
+
+
+def run_engine(engine, transport, args):
+    ports = {}
+    servers = []
+    for link in (ECHO_LINK, SINK_LINK):
+        ports[link] = sshstub.free_port()
+        servers.append(engine.forward_tunnel('127.0.0.1', ports[link],
+                'link%d' % link, 7, transport))
+    payload = b'x' * args.payload
+    quiet = ping(ports[ECHO_LINK], payload, args.pings)
+
+    total = args.megabytes * 1024 * 1024
+    done = []
+
+    def bulk():
+        start = time.time()
+        send_to_sink(ports[SINK_LINK], total)
+        done.append(time.time() - start)
+    bulk_thread = threading.Thread(target=bulk)
+    bulk_thread.daemon = True
+    bulk_thread.start()
+    # Let the transfer use up the burst before measuring
+    time.sleep(ratelimit.BURST_SECONDS)
+    busy = []
+    while bulk_thread.is_alive():
+        busy.extend(ping(ports[ECHO_LINK], payload, args.pings))
+    bulk_thread.join()
+    for server in servers:
+        engine.close_tunnel(server)
+    return {
+        'bulk_mb_per_sec': args.megabytes / done[0],
+        'quiet_p50_ms': percentile(quiet, 50) * 1000,
+        'busy_p50_ms': percentile(busy, 50) * 1000,
+        'busy_p99_ms': percentile(busy, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rate', type=sbconfig.parse_rate, default=1048576,
+            help='global limit in bytes per second, with an optional k or M '
+            'suffix (default: 1M)')
+    parser.add_argument('--reserve', type=float, default=ratelimit.INTERACTIVE_RESERVE,
+            help='share of the limit kept for interactive traffic (default: %s)' %
+            ratelimit.INTERACTIVE_RESERVE)
+    parser.add_argument('--megabytes', type=int, default=4,
+            help='size of the bulk transfer')
+    parser.add_argument('--payload', type=int, default=128,
+            help='echo message size in bytes')
+    parser.add_argument('--pings', type=int, default=20,
+            help='echo round trips per measurement')
+    parser.add_argument('--engine', action='append', choices=['thread', 'async'],
+            help='engine to benchmark; may be repeated (default: both)')
+    args = parser.parse_args()
+
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    ratelimit.INTERACTIVE_RESERVE = args.reserve
+    echo_server = sshstub.EchoServer().start()
+    sink_server = sshstub.SinkServer().start()
+    stub = sshstub.StubTunnelServer(echo_server.address,
+            targets={SINK_LINK: sink_server.address}).start()
+
+    print('%-8s %10s %10s %12s %12s %12s' % ('engine', 'limit MB/s', 'bulk MB/s',
+        'quiet p50 ms', 'busy p50 ms', 'busy p99 ms'))
+    for name, engine in load_engines(args.engine or ['thread', 'async']):
+        # A fresh limit per engine, starting with a full bucket
+        ratelimit.set_total_limit(0)
+        ratelimit.set_total_limit(args.rate)
+        client = sshstub.connect_client(stub.address)
+        result = run_engine(engine, client.get_transport(), args)
+        print('%-8s %10.2f %10.2f %12.2f %12.2f %12.2f' % (name,
+            args.rate / 1048576.0, result['bulk_mb_per_sec'],
+            result['quiet_p50_ms'], result['busy_p50_ms'], result['busy_p99_ms']))
+        client.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+#
+#  bench_suite.py
+#
+# License: Copyright (c) 2016 Hologram All Rights Reserved.
+#
+# Released under the MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Throughput, latency and footprint of forwards under typical workloads.
+
+Starts an in-process stand-in for tunnel.hologram.io with an echo server
+(link1) and a sink server (link2) behind it, then runs every workload
+through forwards set up two ways:
+
+  engine  portforward.forward_tunnel (or asyncforward) on a single SSH
+          transport, which is the forwarding layer alone
+  app     a SpaceBridge instance configured from the command line and
+          started with connect_to_tunnel_server, as --daemon runs it
+
+Workloads:
+
+  bulk    stream --megabytes to the sink over --streams connections
+  small   open --connections short connections one after another, each
+          doing one small request/response with the echo server
+  idle    hold --idle-connections open and silent for --idle-seconds,
+          then check that every one of them still echoes
+
+For each run the suite reports MB/s, connections per second, p50/p99
+connect latency (connect plus the first round trip, which is when the
+channel is actually open), the CPU time the process used (for idle, only
+while the connections were silent) and its RSS afterwards. The stand-in runs in the same process, so CPU time includes
+its share; compare runs with each other rather than reading it as the
+client's cost alone.
+
+    python benchmarks/bench_suite.py
+    python benchmarks/bench_suite.py --workload bulk --megabytes 256 --via app
+    python benchmarks/bench_suite.py --engine async --json results.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+BASEDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, BASEDIR)
+# spacebridge.py imports its siblings the way the bundled app runs it
+sys.path.insert(1, os.path.join(BASEDIR, 'SpaceBridge'))
+
+import paramiko
+
+from SpaceBridge import portforward, spacebridge
+from bench_engines import echo, load_engines, percentile
+import sshstub
+
+ECHO_LINK = 1
+SINK_LINK = 2
+CHUNK = 65536
+WORKLOADS = ['bulk', 'small', 'idle']
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def rss_mb():
+    # Current RSS where /proc has it, otherwise the peak
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / 1048576.0
+    except (IOError, OSError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        return peak / (1048576.0 if sys.platform == 'darwin' else 1024.0)
+
+
+def send_to_sink(port, total):
+    s = socket.create_connection(('127.0.0.1', port))
+    header = ('%d\n' % total).encode('ascii')
+    s.sendall(header)
+    chunk = b'\0' * CHUNK
+    sent = 0
+    while sent < total:
+        n = min(CHUNK, total - sent)
+        s.sendall(chunk[:n])
+        sent += n
+    # The sink echoes the header once it has everything
+    reply = b''
+    while len(reply) < len(header):
+        data = s.recv(64)
+        if not data:
+            raise RuntimeError('connection closed by the tunnel')
+        reply += data
+    s.close()
+
+
+def connect_and_echo(port, payload):
+    t0 = time.time()
+    s = socket.create_connection(('127.0.0.1', port))
+    echo(s, payload)
+    return s, time.time() - t0
+
+
+def run_bulk(ports, args):
+    total = args.megabytes * 1024 * 1024
+    streams = [threading.Thread(target=send_to_sink,
+                                args=(ports[SINK_LINK], total // args.streams))
+               for _ in range(args.streams)]
+    start = time.time()
+    for t in streams:
+        t.start()
+    for t in streams:
+        t.join()
+    elapsed = time.time() - start
+    return {'mb_per_sec': args.megabytes / elapsed}
+
+
+def run_small(ports, args):
+    payload = b'x' * args.payload
+    latencies = []
+    start = time.time()
+    for _ in range(args.connections):
+        s, latency = connect_and_echo(ports[ECHO_LINK], payload)
+        s.close()
+        latencies.append(latency)
+    elapsed = time.time() - start
+    return {
+        'connections_per_sec': args.connections / elapsed,
+        'connect_p50_ms': percentile(latencies, 50) * 1000,
+        'connect_p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def run_idle(ports, args):
+    payload = b'x' * args.payload
+    socks = []
+    latencies = []
+    for _ in range(args.idle_connections):
+        s, latency = connect_and_echo(ports[ECHO_LINK], payload)
+        socks.append(s)
+        latencies.append(latency)
+    # Nothing should be spending CPU on connections with no traffic
+    cpu_before = cpu_seconds()
+    time.sleep(args.idle_seconds)
+    idle_cpu = cpu_seconds() - cpu_before
+    dead = 0
+    for s in socks:
+        try:
+            s.settimeout(5)
+            echo(s, payload)
+        except (socket.error, RuntimeError):
+            dead += 1
+        s.close()
+    return {
+        'connect_p50_ms': percentile(latencies, 50) * 1000,
+        'connect_p99_ms': percentile(latencies, 99) * 1000,
+        'cpu_sec': idle_cpu,
+        'dead': dead,
+    }
+
+
+RUNNERS = {'bulk': run_bulk, 'small': run_small, 'idle': run_idle}
+
+
+def start_engine(engine, stub):
+    # The forwarding layer on its own: one transport, one forward per link
+    client = sshstub.connect_client(stub.address)
+    ports = {}
+    servers = []
+    for link in (ECHO_LINK, SINK_LINK):
+        ports[link] = sshstub.free_port()
+        servers.append(engine.forward_tunnel('127.0.0.1', ports[link],
+                'link%d' % link, 7, client.get_transport()))
+
+    def stop():
+        for server in servers:
+            engine.close_tunnel(server)
+        client.close()
+    return ports, stop
+
+
+def start_app(engine_name, stub, keyfile):
+    # SpaceBridge as --daemon runs it, minus the signal loop
+    ports = dict((link, sshstub.free_port()) for link in (ECHO_LINK, SINK_LINK))
+    argv = ['--daemon', '--apikey', 'benchmark', '--no-fingerprint',
+            '--privatekey', keyfile, '--engine', engine_name,
+            '--tunnel-server', stub.address[0],
+            '--tunnel-port', str(stub.address[1]), '--metrics-interval', '0']
+    for link, port in ports.items():
+        argv += ['--forward', '%d:7:%d' % (link, port)]
+    version = spacebridge.get_version()
+    args = spacebridge.get_parser(version).parse_args(argv)
+    root_handlers = list(logging.getLogger('').handlers)
+    sb = spacebridge.SpaceBridge(version, args)
+    sb.collect_user_prefs(args)
+    sb.collect_forwards(args)
+    sb.connect_to_tunnel_server()
+
+    def stop():
+        for address in list(sb.listeners):
+            sb.stop_forward(address)
+        sb.transport_pool.close()
+        # Each instance sets up logging; don't let them pile up
+        for handler in logging.getLogger('').handlers:
+            if handler not in root_handlers:
+                logging.getLogger('').removeHandler(handler)
+    return ports, stop
+
+
+def format_row(workload, via, engine, result):
+    def column(key, fmt):
+        if key in result:
+            return fmt % result[key]
+        return '-'
+    return '%-6s %-6s %-7s %8s %8s %9s %9s %7s %7s %5s' % (workload, via, engine,
+            column('mb_per_sec', '%.1f'), column('connections_per_sec', '%.0f'),
+            column('connect_p50_ms', '%.2f'), column('connect_p99_ms', '%.2f'),
+            column('cpu_sec', '%.2f'), column('rss_mb', '%.1f'),
+            column('dead', '%d'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workload', action='append', choices=WORKLOADS,
+            help='workload to run; may be repeated (default: all)')
+    parser.add_argument('--via', action='append', choices=['engine', 'app'],
+            help='how to set up the forwards; may be repeated (default: both)')
+    parser.add_argument('--engine', action='append', choices=['thread', 'async'],
+            help='forwarding engine; may be repeated (default: both)')
+    parser.add_argument('--megabytes', type=int, default=64,
+            help='bulk: amount of data to send')
+    parser.add_argument('--streams', type=int, default=1,
+            help='bulk: connections to split the data over')
+    parser.add_argument('--connections', type=int, default=200,
+            help='small: connections to open')
+    parser.add_argument('--payload', type=int, default=128,
+            help='small and idle: message size in bytes')
+    parser.add_argument('--idle-connections', type=int, default=500,
+            help='idle: connections to hold open')
+    parser.add_argument('--idle-seconds', type=float, default=10,
+            help='idle: how long to hold them without traffic')
+    parser.add_argument('--json', metavar='FILE',
+            help='also write the results to FILE as JSON')
+    args = parser.parse_args()
+
+    # Transports closed at the end of each run would log resets otherwise
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    # Every idle connection costs a few descriptors on each side of the
+    # stand-in
+    portforward.raise_fd_limit(8 * args.idle_connections + 1024)
+    echo_server = sshstub.EchoServer().start()
+    sink_server = sshstub.SinkServer().start()
+    stub = sshstub.StubTunnelServer(echo_server.address,
+            targets={SINK_LINK: sink_server.address}).start()
+    keyfile = os.path.join(tempfile.mkdtemp(), 'bench.key')
+    paramiko.RSAKey.generate(2048).write_private_key_file(keyfile)
+
+    results = []
+    print('%-6s %-6s %-7s %8s %8s %9s %9s %7s %7s %5s' % ('load', 'via', 'engine',
+        'MB/s', 'conn/s', 'p50 ms', 'p99 ms', 'CPU s', 'RSS MB', 'dead'))
+    for workload in args.workload or WORKLOADS:
+        for via in args.via or ['engine', 'app']:
+            for name, engine in load_engines(args.engine or ['thread', 'async']):
+                if via == 'app':
+                    ports, stop = start_app(name, stub, keyfile)
+                else:
+                    ports, stop = start_engine(engine, stub)
+                cpu_before = cpu_seconds()
+                result = RUNNERS[workload](ports, args)
+                result.setdefault('cpu_sec', cpu_seconds() - cpu_before)
+                result['rss_mb'] = rss_mb()
+                stop()
+                print(format_row(workload, via, name, result))
+                sys.stdout.flush()
+                result.update({'workload': workload, 'via': via, 'engine': name})
+                results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
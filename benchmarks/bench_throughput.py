@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+#
+#  bench_throughput.py
+#
+# License: Copyright (c) 2016 Hologram All Rights Reserved.
+#
+# Released under the MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Bulk transfer throughput through a forward.
+
+Streams a payload through a forward to an echo server behind an in-process
+tunnel server stand-in and reads it back, once with the old fixed 1KB relay
+reads and once per requested buffer configuration. The transfer can be
+split over several connections and several SSH transports.
+
+    python benchmarks/bench_throughput.py --megabytes 64
+    python benchmarks/bench_throughput.py --bufsize 65536:1048576
+    python benchmarks/bench_throughput.py --streams 8 --transports 4
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from SpaceBridge import portforward, transportpool
+import sshstub
+
+CHUNK = 65536
+
+
+def transfer(port, total):
+    s = socket.create_connection(('127.0.0.1', port))
+    chunk = b'\0' * CHUNK
+
+    def writer():
+        sent = 0
+        while sent < total:
+            n = min(CHUNK, total - sent)
+            s.sendall(chunk[:n])
+            sent += n
+
+    start = time.time()
+    writer_thread = threading.Thread(target=writer)
+    writer_thread.daemon = True
+    writer_thread.start()
+    received = 0
+    while received < total:
+        data = s.recv(CHUNK)
+        if not data:
+            raise RuntimeError('connection closed by the tunnel')
+        received += len(data)
+    elapsed = time.time() - start
+    writer_thread.join()
+    s.close()
+    return elapsed
+
+
+def parallel_transfer(port, total, streams):
+    # Split the payload over several concurrent connections and return the
+    # time until the last one finishes
+    threads = [threading.Thread(target=transfer, args=(port, total // streams))
+               for _ in range(streams)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.time() - start
+
+
+def parse_bufsize(value):
+    min_size, _, max_size = value.partition(':')
+    return int(min_size), int(max_size or min_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--megabytes', type=int, default=32,
+            help='amount of data to send through the forward')
+    parser.add_argument('--bufsize', action='append', type=parse_bufsize,
+            help='MIN[:MAX] relay read sizes to try; may be repeated '
+            '(default: 1024 and the built-in adaptive sizes)')
+    parser.add_argument('--streams', type=int, default=1,
+            help='concurrent connections to split the transfer over')
+    parser.add_argument('--transports', type=int, default=1,
+            help='SSH connections to spread the streams over')
+    args = parser.parse_args()
+
+    configs = args.bufsize or [(1024, 1024),
+            (portforward.MIN_BUFSIZE, portforward.MAX_BUFSIZE)]
+    total = args.megabytes * 1024 * 1024
+
+    echo_server = sshstub.EchoServer().start()
+    server = sshstub.StubTunnelServer(echo_server.address).start()
+    pool = transportpool.TransportPool(
+            lambda: sshstub.connect_client(server.address), args.transports)
+    pool.start()
+
+    print('%10s %10s %10s %10s' % ('min', 'max', 'seconds', 'MB/s'))
+    for min_size, max_size in configs:
+        port = sshstub.free_port()
+        portforward.forward_tunnel('127.0.0.1', port, 'link1', 7,
+                pool, min_bufsize=min_size, max_bufsize=max_size)
+        elapsed = parallel_transfer(port, total, args.streams)
+        # Data crosses the tunnel once in each direction
+        print('%10d %10d %10.2f %10.1f' % (min_size, max_size, elapsed,
+            2 * args.megabytes / elapsed))
+    pool.close()
+
+
+if __name__ == '__main__':
+    main()
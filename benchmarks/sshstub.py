@@ -0,0 +1,261 @@
+#
+#  sshstub.py
+#
+# License: Copyright (c) 2016 Hologram All Rights Reserved.
+#
+# Released under the MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""In-process stand-in for the SpaceBridge tunnel server.
+
+Accepts ``htunnel`` logins with any key and serves ``direct-tcpip``
+channels by connecting ``linkN`` destinations to local echo or sink
+servers.
+"""
+
+import selectors
+import socket
+import threading
+import time
+
+import paramiko
+
+RELAY_BUFSIZE = 65536
+
+
+def client_threads():
+    return len([t for t in threading.enumerate()
+                if not t.name.startswith('stub-')])
+
+
+def free_port(host='127.0.0.1'):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind((host, 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _spawn(target, *args):
+    # Stub threads are named so benchmarks can leave them out of the count
+    # of threads used by the client under test
+    t = threading.Thread(target=target, args=args, name='stub-' + target.__name__)
+    t.daemon = True
+    t.start()
+    return t
+
+
+class EchoServer:
+    """Threaded TCP server that echoes everything it reads."""
+
+    def __init__(self, host='127.0.0.1'):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, 0))
+        self.sock.listen(128)
+        self.address = self.sock.getsockname()
+
+    def start(self):
+        _spawn(self._serve)
+        return self
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except (OSError, socket.error):
+                return
+            _spawn(self.handle, conn)
+
+    def handle(self, conn):
+        try:
+            while True:
+                data = conn.recv(RELAY_BUFSIZE)
+                if not data:
+                    break
+                conn.sendall(data)
+        except (OSError, socket.error):
+            pass
+        conn.close()
+
+    def close(self):
+        self.sock.close()
+
+
+class SinkServer(EchoServer):
+    """Threaded TCP server that discards what it reads.
+
+    Clients start with the number of bytes they are going to send as a
+    decimal line. The sink replies with the same line once it has read
+    that many, so the sender knows everything arrived without having to
+    half-close the connection, which forwards don't pass on.
+    """
+
+    def handle(self, conn):
+        try:
+            header = b''
+            while not header.endswith(b'\n'):
+                data = conn.recv(1)
+                if not data:
+                    raise EOFError
+                header += data
+            remaining = int(header)
+            while remaining > 0:
+                data = conn.recv(min(RELAY_BUFSIZE, remaining))
+                if not data:
+                    raise EOFError
+                remaining -= len(data)
+            conn.sendall(header)
+        except (OSError, socket.error, EOFError, ValueError):
+            pass
+        conn.close()
+
+
+class _TunnelInterface(paramiko.ServerInterface):
+
+    def __init__(self):
+        self.destinations = {}
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        if username == 'htunnel':
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        self.destinations[chanid] = destination
+        return paramiko.OPEN_SUCCEEDED
+
+
+class StubTunnelServer:
+    """Stand-in for tunnel.hologram.io.
+
+    ``targets`` maps link ids to ``(host, port)`` pairs; a link without an
+    entry is sent to ``default_target``.  The device port requested by the
+    client is ignored, so every link behaves like the echo server.
+    ``open_delay`` holds up the connection to the target behind every new
+    channel by that many seconds to stand in for the round trip to a device
+    over cellular.
+    """
+
+    host_key = None
+
+    def __init__(self, default_target, targets=None, host='127.0.0.1',
+                 open_delay=0):
+        self.default_target = default_target
+        self.open_delay = open_delay
+        self.targets = targets or {}
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, 0))
+        self.sock.listen(16)
+        self.address = self.sock.getsockname()
+        if StubTunnelServer.host_key is None:
+            StubTunnelServer.host_key = paramiko.RSAKey.generate(2048)
+
+    def start(self):
+        _spawn(self._serve)
+        return self
+
+    def resolve(self, destination):
+        host = destination[0]
+        if host.startswith('link') and host[4:].isdigit():
+            return self.targets.get(int(host[4:]), self.default_target)
+        return self.default_target
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except (OSError, socket.error):
+                return
+            _spawn(self._serve_transport, conn)
+
+    def _serve_transport(self, conn):
+        # Without this, replies to channel opens wait on delayed ACKs and
+        # every new connection takes 40ms longer than the client's share
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(self.host_key)
+        # Like OpenSSH, compress if the client asks for it
+        transport.use_compression(True)
+        iface = _TunnelInterface()
+        transport.start_server(server=iface)
+        while transport.is_active():
+            chan = transport.accept(1)
+            if chan is None:
+                continue
+            destination = iface.destinations.pop(chan.get_id())
+            _spawn(self._relay, chan, destination)
+
+    def _relay(self, chan, destination):
+        if self.open_delay:
+            time.sleep(self.open_delay)
+        try:
+            sock = socket.create_connection(self.resolve(destination))
+        except (OSError, socket.error):
+            chan.close()
+            return
+        # A selector rather than select() so the stub isn't the one to run
+        # into FD_SETSIZE when a benchmark opens many connections
+        selector = selectors.DefaultSelector()
+        selector.register(sock, selectors.EVENT_READ)
+        selector.register(chan, selectors.EVENT_READ)
+        try:
+            while True:
+                r = [key.fileobj for key, mask in selector.select()]
+                if sock in r:
+                    data = sock.recv(RELAY_BUFSIZE)
+                    if not data:
+                        break
+                    chan.sendall(data)
+                if chan in r:
+                    data = chan.recv(RELAY_BUFSIZE)
+                    if not data:
+                        break
+                    sock.sendall(data)
+        except (OSError, socket.error, EOFError):
+            pass
+        selector.close()
+        try:
+            chan.close()
+        except (OSError, socket.error, EOFError):
+            pass
+        sock.close()
+
+    def close(self):
+        self.sock.close()
+
+
+def connect_client(address, compress=False):
+    """Log in to a stub server the way SpaceBridge does and return the
+    connected SSHClient.  ``compress`` asks for SSH compression."""
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.client.AutoAddPolicy())
+    client.connect(address[0], address[1], username='htunnel',
+            pkey=paramiko.RSAKey.generate(2048), look_for_keys=False,
+            allow_agent=False, compress=compress)
+    client.get_transport().sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return client
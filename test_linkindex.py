@@ -0,0 +1,58 @@
+import unittest
+
+from SpaceBridge.linkindex import LinkIndex
+
+
+def link(linkid, deviceid, devicename):
+    return {'id': linkid, 'deviceid': deviceid, 'devicename': devicename}
+
+
+class LinkIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = LinkIndex([link(1, 501, 'Pump A'),
+                                link(2, 502, 'pump b'),
+                                link(3, 503, 'Gate'),
+                                link(4, 504, None)])
+
+    def ids(self, links):
+        return [entry['id'] for entry in links]
+
+    def test_lookups(self):
+        self.assertEqual(len(self.index), 4)
+        self.assertTrue(2 in self.index)
+        self.assertFalse(9 in self.index)
+        self.assertEqual(self.index.get(3)['devicename'], 'Gate')
+        self.assertEqual(self.index.get_by_deviceid(502)['id'], 2)
+        self.assertTrue(self.index.get(9) is None)
+        self.assertTrue(self.index.get_by_deviceid(9) is None)
+
+    def test_pages_skip_known_links(self):
+        self.index.add([link(2, 502, 'renamed'), link(5, 505, 'Pump C')])
+        self.assertEqual(len(self.index), 5)
+        self.assertEqual(self.index.get(2)['devicename'], 'pump b')
+        self.assertEqual(self.ids(self.index.find_name('pump c')), [5])
+
+    def test_find_name(self):
+        self.assertEqual(self.ids(self.index.find_name('PUMP A')), [1])
+        self.assertEqual(self.index.find_name('pump'), [])
+        self.index.add([link(6, 506, 'gate')])
+        self.assertEqual(sorted(self.ids(self.index.find_name('gate'))), [3, 6])
+
+    def test_search_order(self):
+        self.index.add([link(7, 507, 'Garden pump')])
+        # Prefix matches come before substring matches
+        self.assertEqual(self.ids(self.index.search('pump')), [1, 2, 7])
+        self.assertEqual(self.ids(self.index.search(' ga ')), [7, 3])
+
+    def test_search_ids(self):
+        self.assertEqual(self.ids(self.index.search('3')), [3])
+        self.assertEqual(self.ids(self.index.search('502')), [2])
+
+    def test_search_limit(self):
+        self.assertEqual(self.ids(self.index.search('p', limit=1)), [1])
+        self.assertEqual(len(self.index.search('', limit=3)), 3)
+        self.assertEqual(self.index.search('nothing'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
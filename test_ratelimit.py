@@ -0,0 +1,120 @@
+import unittest
+
+from SpaceBridge import ratelimit
+
+
+class TokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        # 64k per second gives a 32k burst, of which 8k is reserved for
+        # interactive reads
+        self.bucket = ratelimit.TokenBucket(65536)
+        self.now = self.bucket.updated
+
+    def test_starts_full(self):
+        self.assertEqual(self.bucket.burst, 32768)
+        self.assertEqual(self.bucket.reserve, 8192)
+        self.assertEqual(self.bucket.available(False, self.now), 32768)
+        self.assertEqual(self.bucket.available(True, self.now), 32768 - 8192)
+
+    def test_refills_up_to_burst(self):
+        self.bucket.consume(32768, self.now)
+        self.assertEqual(self.bucket.available(False, self.now), 0)
+        self.assertEqual(self.bucket.available(False, self.now + 0.25), 16384)
+        self.assertEqual(self.bucket.available(False, self.now + 10), 32768)
+
+    def test_overdraw_waits_longer(self):
+        self.bucket.consume(32768 + 65536, self.now)
+        self.assertEqual(self.bucket.available(False, self.now), -65536)
+        self.assertAlmostEqual(self.bucket.delay(False, self.now), 65537 / 65536.0)
+
+    def test_delay(self):
+        self.assertEqual(self.bucket.delay(False, self.now), 0)
+        self.bucket.consume(32768, self.now)
+        self.assertAlmostEqual(self.bucket.delay(False, self.now), 1 / 65536.0)
+        # A bulk read waits for a quantum above the reserve
+        self.assertAlmostEqual(self.bucket.delay(True, self.now),
+                               (8192 + 16384) / 65536.0)
+
+    def test_small_rates_still_burst_a_packet(self):
+        bucket = ratelimit.TokenBucket(1000)
+        self.assertEqual(bucket.burst, ratelimit.MIN_BURST)
+
+    def test_configure_keeps_tokens_under_burst(self):
+        self.bucket.configure(16384)
+        self.assertEqual(self.bucket.burst, ratelimit.MIN_BURST)
+        self.assertEqual(self.bucket.available(False, self.now), ratelimit.MIN_BURST)
+
+
+class LimiterTest(unittest.TestCase):
+    def test_allowance_is_tightest_bucket(self):
+        tight = ratelimit.TokenBucket(16384)
+        loose = ratelimit.TokenBucket(1048576)
+        limiter = ratelimit.Limiter([loose, tight])
+        tight.consume(ratelimit.MIN_BURST - 100, tight.updated)
+        self.assertTrue(limiter.allowance() < 200)
+
+    def test_allowance_capped_at_quantum(self):
+        limiter = ratelimit.Limiter([ratelimit.TokenBucket(1048576)])
+        self.assertEqual(limiter.allowance(), ratelimit.FAIR_QUANTUM)
+
+    def test_full_reads_count_as_bulk(self):
+        limiter = ratelimit.Limiter([ratelimit.TokenBucket(1048576)])
+        limiter.consume(16384, 16384)
+        self.assertTrue(limiter.bulk)
+        limiter.consume(16384, 10)
+        self.assertFalse(limiter.bulk)
+
+
+class LimitsTest(unittest.TestCase):
+    def tearDown(self):
+        ratelimit.set_total_limit(0)
+        ratelimit.set_default_link_limit(0)
+        for link in list(ratelimit._links):
+            ratelimit.set_link_limit(link, 0)
+
+    def test_no_limits(self):
+        self.assertEqual(ratelimit.limiters(None, 1), (None, None))
+
+    def test_every_limit_applies(self):
+        forward = ratelimit.Limit(1024)
+        ratelimit.set_link_limit(1, 2048)
+        ratelimit.set_total_limit(4096)
+        upstream, downstream = ratelimit.limiters(forward, 1)
+        self.assertEqual([b.rate for b in upstream.buckets], [1024, 2048, 4096])
+        self.assertEqual([b.rate for b in downstream.buckets], [1024, 2048, 4096])
+        self.assertTrue(upstream.buckets[0] is forward.upstream)
+        self.assertTrue(downstream.buckets[0] is forward.downstream)
+
+    def test_link_limit_is_shared(self):
+        ratelimit.set_link_limit(1, 2048)
+        first = ratelimit.limiters(None, 1)[0]
+        second = ratelimit.limiters(None, 1)[0]
+        self.assertTrue(first.buckets[0] is second.buckets[0])
+        self.assertEqual(ratelimit.limiters(None, 2), (None, None))
+
+    def test_default_link_limit(self):
+        ratelimit.set_default_link_limit(1024)
+        ratelimit.set_link_limit(2, 4096)
+        self.assertEqual(ratelimit.link_limit(1).upstream.rate, 1024)
+        self.assertFalse(ratelimit.link_limit(1).explicit)
+        ratelimit.set_default_link_limit(2048)
+        self.assertEqual(ratelimit.link_limit(1).upstream.rate, 2048)
+        self.assertEqual(ratelimit.link_limit(2).upstream.rate, 4096)
+        ratelimit.set_default_link_limit(0)
+        self.assertTrue(ratelimit.link_limit(1) is None)
+        self.assertEqual(ratelimit.link_limit(2).upstream.rate, 4096)
+
+    def test_reset_link_limits(self):
+        ratelimit.set_link_limit(1, 2048)
+        ratelimit.set_link_limit(2, 4096)
+        ratelimit.reset_link_limits([2])
+        self.assertTrue(ratelimit.link_limit(1) is None)
+        self.assertEqual(ratelimit.link_limit(2).upstream.rate, 4096)
+        ratelimit.set_default_link_limit(1024)
+        ratelimit.reset_link_limits([])
+        self.assertEqual(ratelimit.link_limit(2).upstream.rate, 1024)
+        self.assertFalse(ratelimit.link_limit(2).explicit)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,222 @@
+import os
+import socket
+import unittest
+
+from SpaceBridge import portforward
+from SpaceBridge.portforward import BufferPool, Relay, RelayBuffer
+
+
+class FakeChannel:
+    # Stands in for a paramiko channel. window is how much send() takes
+    # before it times out like a channel whose remote window is full.
+
+    def __init__(self, window=1 << 30, packet=32768):
+        self.incoming = b''
+        self.eof = False
+        self.sent = bytearray()
+        self.window = window
+        self.out_window_size = window
+        self.out_max_packet_size = packet + 64
+        self.closed = False
+
+    def setblocking(self, flag):
+        pass
+
+    def recv(self, size):
+        if self.incoming:
+            data, self.incoming = self.incoming[:size], self.incoming[size:]
+            return data
+        if self.eof:
+            return b''
+        raise socket.timeout()
+
+    def send(self, data):
+        if self.closed:
+            return 0
+        if self.window <= 0:
+            raise socket.timeout()
+        sent = min(len(data), self.window)
+        self.sent += bytes(data[:sent])
+        self.window -= sent
+        return sent
+
+    def close(self):
+        self.closed = True
+
+
+class BufferPoolTest(unittest.TestCase):
+    def test_reuses_buffers(self):
+        pool = BufferPool(16, max_free=1)
+        view = pool.get()
+        self.assertEqual(len(view), 16)
+        pool.put(view)
+        self.assertTrue(pool.get() is view)
+
+    def test_keeps_at_most_max_free(self):
+        pool = BufferPool(16, max_free=1)
+        pool.put(pool.get())
+        pool.put(memoryview(bytearray(16)))
+        self.assertEqual(len(pool.free), 1)
+
+
+class RelayBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = BufferPool(8)
+        self.buffer = RelayBuffer(self.pool)
+
+    def test_consume_returns_buffer(self):
+        self.buffer.append(b'abc')
+        self.assertEqual(len(self.buffer), 3)
+        self.assertEqual(self.buffer.space(), 5)
+        self.assertEqual(self.buffer.data(2).tobytes(), b'ab')
+        self.buffer.consume(2)
+        self.assertEqual(self.buffer.data(8).tobytes(), b'c')
+        self.buffer.consume(1)
+        self.assertTrue(self.buffer.view is None)
+        self.assertEqual(len(self.pool.free), 1)
+        # The next append takes the same buffer back
+        view = self.pool.free[0]
+        self.buffer.append(b'd')
+        self.assertTrue(self.buffer.view is view)
+
+    def test_compacts_to_make_room(self):
+        self.buffer.append(b'abcdef')
+        self.buffer.consume(4)
+        self.assertEqual(len(self.buffer.reserve(2)), 2)
+        self.assertEqual(self.buffer.start, 4)
+        # Room for more than what is after the data moves it to the front
+        self.assertEqual(len(self.buffer.reserve(4)), 4)
+        self.assertEqual((self.buffer.start, self.buffer.end), (0, 2))
+        self.buffer.append(b'ghij')
+        self.assertEqual(self.buffer.data(8).tobytes(), b'efghij')
+
+    def test_recv_from(self):
+        sock, peer = socket.socketpair()
+        try:
+            sock.setblocking(0)
+            peer.sendall(b'hello')
+            self.assertEqual(self.buffer.recv_from(sock, 3), 3)
+            self.assertEqual(self.buffer.recv_from(sock, 8), 2)
+            self.assertEqual(self.buffer.data(8).tobytes(), b'hello')
+            self.buffer.consume(5)
+            # Nothing to read hands the buffer straight back
+            self.assertRaises(socket.error, self.buffer.recv_from, sock, 8)
+            self.assertTrue(self.buffer.view is None)
+        finally:
+            sock.close()
+            peer.close()
+
+
+class RelayTest(unittest.TestCase):
+    def setUp(self):
+        self.sock, self.peer = socket.socketpair()
+        self.peer.settimeout(5)
+        self.chan = FakeChannel()
+        self.closes = []
+        self.relay = Relay(self.sock, self.chan, min_bufsize=16, max_bufsize=64,
+                           on_close=lambda: self.closes.append(True))
+
+    def tearDown(self):
+        self.relay.close()
+        self.peer.close()
+
+    def pump(self, times=10):
+        for i in range(times):
+            self.relay.pump(self.relay.readers(), self.relay.writers())
+
+    def test_upstream(self):
+        data = os.urandom(200)
+        self.peer.sendall(data)
+        self.pump(20)
+        self.assertEqual(bytes(self.chan.sent), data)
+        self.assertTrue(self.relay.to_chan.view is None)
+
+    def test_partial_channel_sends(self):
+        self.chan.window = 10
+        self.peer.sendall(b'x' * 30)
+        self.pump(1)
+        self.assertEqual(len(self.chan.sent), 10)
+        self.assertEqual(len(self.relay.to_chan), 6)
+        self.assertEqual(self.relay.timeout(), portforward.CHANNEL_RETRY_INTERVAL)
+        self.chan.window = 100
+        self.pump()
+        self.assertEqual(bytes(self.chan.sent), b'x' * 30)
+        self.assertEqual(len(self.relay.to_chan), 0)
+
+    def test_full_buffer_stops_reading(self):
+        self.chan.window = 0
+        self.peer.sendall(b'x' * 200)
+        self.pump()
+        self.assertEqual(len(self.relay.to_chan), 64)
+        self.assertFalse(self.sock in self.relay.readers())
+        self.chan.window = 1000
+        self.pump(20)
+        self.assertEqual(len(self.chan.sent), 200)
+
+    def test_downstream_partial_socket_sends(self):
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        data = os.urandom(256 * 1024)
+        self.chan.incoming = data
+        # Fill the socket until it stops taking everything it is given
+        for i in range(len(data) // 16):
+            self.pump(1)
+            if self.relay.to_sock:
+                break
+        self.assertTrue(self.relay.to_sock)
+        self.assertFalse(self.chan in self.relay.readers())
+        self.assertEqual(self.relay.writers(), [self.sock])
+        received = bytearray()
+        while len(received) < len(data):
+            received += self.peer.recv(65536)
+            self.pump(1)
+        self.assertEqual(bytes(received), data)
+
+    def test_socket_eof_delivers_pending_data(self):
+        self.chan.window = 0
+        self.peer.sendall(b'abc')
+        self.peer.shutdown(socket.SHUT_WR)
+        self.pump()
+        self.assertTrue(self.relay.sock_eof)
+        self.assertFalse(self.relay.finished())
+        self.assertFalse(self.sock in self.relay.readers())
+        self.chan.window = 100
+        self.pump(1)
+        self.assertEqual(bytes(self.chan.sent), b'abc')
+        self.assertTrue(self.relay.finished())
+
+    def test_channel_eof(self):
+        self.chan.incoming = b'xyz'
+        self.chan.eof = True
+        self.pump(1)
+        self.assertFalse(self.relay.chan_eof)
+        self.pump(1)
+        self.assertTrue(self.relay.chan_eof)
+        self.assertTrue(self.relay.finished())
+        self.assertEqual(self.peer.recv(16), b'xyz')
+
+    def test_idle_timeout(self):
+        relay = Relay(*socket.socketpair(), idle_timeout=5)
+        try:
+            relay.readers()
+            self.assertEqual(relay.timeout(), portforward.IDLE_CHECK_INTERVAL)
+            self.assertFalse(relay.expire_if_idle(relay.last_active + 1))
+            self.assertFalse(relay.finished())
+            self.assertTrue(relay.expire_if_idle(relay.last_active + 6))
+            self.assertTrue(relay.finished())
+        finally:
+            relay.close()
+
+    def test_close_returns_buffers(self):
+        self.chan.window = 0
+        self.peer.sendall(b'abc')
+        self.pump(1)
+        self.assertTrue(self.relay.to_chan.view is not None)
+        self.relay.close()
+        self.relay.close()
+        self.assertTrue(self.relay.to_chan.view is None)
+        self.assertTrue(self.chan.closed)
+        self.assertEqual(self.closes, [True])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,237 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from SpaceBridge import sbconfig
+from SpaceBridge.sbexceptions import ErrorException
+
+
+class ParseTest(unittest.TestCase):
+    def test_links(self):
+        self.assertEqual(sbconfig.parse_link('1234'), 1234)
+        self.assertEqual(sbconfig.parse_link(1234), 1234)
+        self.assertEqual(sbconfig.parse_link('name:pump:a'), 'name:pump:a')
+        self.assertEqual(sbconfig.parse_link('device:77'), 'device:77')
+        for bad in ('', 'name:', 'device:x', 'foo', 0, -1, True, None):
+            self.assertRaises(ValueError, sbconfig.parse_link, bad)
+
+    def test_rates(self):
+        self.assertEqual(sbconfig.parse_rate('64k'), 65536)
+        self.assertEqual(sbconfig.parse_rate(' 1.5M'), 1572864)
+        self.assertEqual(sbconfig.parse_rate('100'), 100)
+        self.assertEqual(sbconfig.parse_rate(4096), 4096)
+        self.assertEqual(sbconfig.parse_rate('0'), 0)
+        for bad in ('', 'k', 'fast', '-1', -1, True, None,
+                    'inf', '-inf', 'nan', '1e400', '1e308M'):
+            self.assertRaises(ValueError, sbconfig.parse_rate, bad)
+
+    def test_ports(self):
+        self.assertEqual(sbconfig.parse_port('22'), 22)
+        self.assertEqual(sbconfig.parse_port_range('8000-8002'), [8000, 8001, 8002])
+        self.assertEqual(sbconfig.parse_port_range(8000), [8000])
+        for bad in ('0', '65536', 'x', True):
+            self.assertRaises(ValueError, sbconfig.parse_port, bad)
+        self.assertRaises(ValueError, sbconfig.parse_port_range, '8002-8000')
+
+    def test_listen_address(self):
+        self.assertEqual(sbconfig.parse_listen_address('1080', '127.0.0.1'),
+                         ('127.0.0.1', 1080))
+        self.assertEqual(sbconfig.parse_listen_address('0.0.0.0:1080', '127.0.0.1'),
+                         ('0.0.0.0', 1080))
+        self.assertRaises(ErrorException, sbconfig.parse_listen_address,
+                          'host:port', '127.0.0.1')
+
+
+class ForwardStringTest(unittest.TestCase):
+    def test_single(self):
+        self.assertEqual(sbconfig.parse_forward_string('1234:22:2222'),
+                         [[1234, 22, 2222, {}]])
+
+    def test_name_with_colons(self):
+        self.assertEqual(sbconfig.parse_forward_string('name:pump:a:22:2222'),
+                         [['name:pump:a', 22, 2222, {}]])
+
+    def test_rate(self):
+        self.assertEqual(sbconfig.parse_forward_string('1234:22:2222@64k'),
+                         [[1234, 22, 2222, {'rate_limit': 65536}]])
+        self.assertRaises(ErrorException, sbconfig.parse_forward_string,
+                          '1234:22:2222@inf')
+
+    def test_link_range(self):
+        forwards = sbconfig.parse_forward_string('1000-1002:22:20000+')
+        self.assertEqual([f[:3] for f in forwards],
+                         [[1000, 22, 20000], [1001, 22, 20001], [1002, 22, 20002]])
+
+    def test_port_range(self):
+        forwards = sbconfig.parse_forward_string('1234:8000-8001:28000-28001')
+        self.assertEqual([f[:3] for f in forwards],
+                         [[1234, 8000, 28000], [1234, 8001, 28001]])
+
+    def test_errors(self):
+        for bad in ('1234:22', 'x:22:2222', '1234:x:2222',
+                    '1000-1001:8000-8001:20000+', '1000-1002:22:20000-20001',
+                    '1000-1009:22:65530+'):
+            self.assertRaises(ErrorException, sbconfig.parse_forward_string, bad)
+
+
+class ConfigFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, config):
+        path = os.path.join(self.directory, 'forwards.json')
+        with open(path, 'w') as f:
+            json.dump(config, f)
+        return path
+
+    def test_entries(self):
+        path = self.write({
+            'defaults': {'max_channels': 4},
+            'forwards': [
+                '1234:22:2222',
+                {'link': 'name:pump', 'device_port': '80-81', 'local_port': 8080,
+                 'rate_limit': '1M'},
+                {'links': [1, 2], 'device_port': 22, 'local_port': 3000},
+            ]})
+        forwards = sbconfig.read_config(path)
+        self.assertEqual([f[:3] for f in forwards],
+                         [[1234, 22, 2222], ['name:pump', 80, 8080],
+                          ['name:pump', 81, 8081], [1, 22, 3000], [2, 22, 3001]])
+        self.assertEqual(forwards[0][3], {'max_channels': 4})
+        self.assertEqual(forwards[1][3], {'max_channels': 4, 'rate_limit': 1048576})
+
+    def test_errors_reported_together(self):
+        path = self.write({
+            'defaults': {'max_channels': 'many'},
+            'forwards': [
+                {'link': 1, 'device_port': 22},
+                {'link': 1, 'links': [2], 'device_port': 22, 'local_port': 1},
+                {'link': 1, 'device_port': 22, 'local_port': 1, 'colour': 'red'},
+                {'link': 1, 'device_port': 22, 'local_port': 1,
+                 'min_bufsize': 2, 'max_bufsize': 1},
+                {'links': [], 'device_port': 22, 'local_port': 1},
+                7,
+            ]})
+        try:
+            sbconfig.read_config(path)
+        except ErrorException as e:
+            message = str(e)
+        else:
+            self.fail('config was accepted')
+        self.assertIn('has 7 problem(s)', message)
+        self.assertIn('defaults: max_channels must be a int', message)
+        self.assertIn('forwards[0]: missing local_port', message)
+        self.assertIn('forwards[5]: expected a forward string or a table', message)
+
+    def test_ranges(self):
+        path = self.write({
+            'defaults': {'keepalive': -1},
+            'forwards': [
+                {'link': 1, 'device_port': 22, 'local_port': 1, 'min_bufsize': 0},
+                {'link': 1, 'device_port': 22, 'local_port': 2, 'max_channels': -1},
+                {'link': 1, 'device_port': 22, 'local_port': 3, 'warm_ttl': 0.5},
+                {'link': 1, 'device_port': 22, 'local_port': 4, 'idle_timeout': 0,
+                 'warm_channels': 0},
+            ]})
+        try:
+            sbconfig.read_config(path)
+        except ErrorException as e:
+            message = str(e)
+        else:
+            self.fail('config was accepted')
+        self.assertIn('has 4 problem(s)', message)
+        self.assertIn('defaults: keepalive must be at least 0', message)
+        self.assertIn('forwards[0]: min_bufsize must be at least 1', message)
+        self.assertIn('forwards[1]: max_channels must be at least 0', message)
+        self.assertIn('forwards[2]: warm_ttl must be at least 1', message)
+
+    def test_not_a_forwards_list(self):
+        self.assertRaises(ErrorException, sbconfig.read_config, self.write([]))
+        self.assertRaises(ErrorException, sbconfig.read_config,
+                          self.write({'forwards': {}}))
+
+    def test_unreadable(self):
+        path = os.path.join(self.directory, 'broken.json')
+        with open(path, 'w') as f:
+            f.write('{')
+        self.assertRaises(ErrorException, sbconfig.read_config, path)
+        self.assertRaises(ErrorException, sbconfig.read_config,
+                          os.path.join(self.directory, 'missing.json'))
+
+
+class ArgumentsTest(unittest.TestCase):
+    def args(self, **values):
+        args = argparse.Namespace(**dict((key, None) for key in sbconfig.ARGUMENT_MINIMUMS))
+        for key, value in values.items():
+            setattr(args, key, value)
+        return args
+
+    def test_defaults(self):
+        sbconfig.check_arguments(self.args())
+        sbconfig.check_arguments(self.args(max_channels=0, idle_timeout=0,
+                                           queue_timeout=0.5))
+
+    def test_out_of_range(self):
+        try:
+            sbconfig.check_arguments(self.args(min_bufsize=0, max_workers=0,
+                                               warm_channels=-2, queue_timeout=-1.0))
+        except ErrorException as e:
+            message = str(e)
+        else:
+            self.fail('arguments were accepted')
+        self.assertIn('has 4 problem(s)', message)
+        self.assertIn('--min-bufsize must be at least 1', message)
+        self.assertIn('--max-workers must be at least 1', message)
+        self.assertIn('--warm-channels must be at least 0', message)
+        self.assertIn('--queue-timeout must be at least 0', message)
+
+
+class CheckForwardsTest(unittest.TestCase):
+    def test_distinct(self):
+        sbconfig.check_forwards([[1, 22, 2222, {}], [2, 22, 2223, {}],
+                                 [3, 22, 2222, {'local_host': '192.168.1.5'}],
+                                 [4, 22, 2224, {'local_host': '0.0.0.0'}]],
+                                '127.0.0.1', ('127.0.0.1', 1080))
+
+    def test_wildcard_host(self):
+        for wildcard in ('0.0.0.0', '', '::'):
+            self.assertRaises(ErrorException, sbconfig.check_forwards,
+                              [[1, 22, 2222, {}],
+                               [2, 22, 2222, {'local_host': wildcard}]], '127.0.0.1')
+            self.assertRaises(ErrorException, sbconfig.check_forwards,
+                              [[1, 22, 2222, {'local_host': wildcard}],
+                               [2, 22, 2222, {}]], '127.0.0.1')
+            self.assertRaises(ErrorException, sbconfig.check_forwards,
+                              [[1, 22, 1080, {'local_host': wildcard}]],
+                              '127.0.0.1', ('127.0.0.1', 1080))
+        self.assertRaises(ErrorException, sbconfig.check_forwards,
+                          [[1, 22, 1080, {}]], '127.0.0.1', ('0.0.0.0', 1080))
+
+    def test_duplicate_port(self):
+        self.assertRaises(ErrorException, sbconfig.check_forwards,
+                          [[1, 22, 2222, {}], [2, 22, 2222, {}]], '127.0.0.1')
+
+    def test_socks_port(self):
+        self.assertRaises(ErrorException, sbconfig.check_forwards,
+                          [[1, 22, 1080, {}]], '127.0.0.1', ('127.0.0.1', 1080))
+
+    def test_error_count_capped(self):
+        forwards = [[link, 22, 2222, {}] for link in range(1, 50)]
+        try:
+            sbconfig.check_forwards(forwards, '127.0.0.1')
+        except ErrorException as e:
+            message = str(e)
+        else:
+            self.fail('duplicates were accepted')
+        self.assertIn('has 48 problem(s)', message)
+        self.assertIn('... and 28 more', message)
+
+
+if __name__ == '__main__':
+    unittest.main()
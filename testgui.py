@@ -8,7 +8,8 @@ links = [{'id':1,
     'deviceid':7}]
 
 pfg = SpaceBridge.sbgui.PortForwardGui("SpaceBridge v0.1")
-pfresult = pfg.prompt_for_forwards(links)
+# prompt_for_forwards takes the links page by page
+pfresult = pfg.prompt_for_forwards([links])
 print(str(pfresult))
 
 